@@ -0,0 +1,201 @@
+"""
+LLM请求的准入控制：限制同时进行和排队的请求数，预计等待时间太长时
+直接返回 429，并且按用户轮流放行，避免一个玩家刷屏拖垮所有人
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+class Rejected(Exception):
+    """Rejected
+    the request was shed instead of queued
+    params:
+        reason: why the request was rejected
+        retry_after: seconds the client should wait before retrying
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('user_id', 'event', 'granted')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.event = threading.Event()
+        self.granted = False
+
+
+class AdmissionController:
+    """AdmissionController
+    params:
+        max_concurrent: requests served at the same time
+        max_queue: requests waiting for a slot
+        max_wait: seconds a request may wait, requests expected to wait
+            longer are rejected right away
+        per_user: requests one user may have served or waiting
+        service_time: initial estimate of the seconds a request takes,
+            then a moving average of the measured durations
+    """
+
+    def __init__(self, max_concurrent=16, max_queue=64, max_wait=10.0,
+                 per_user=2, service_time=1.0):
+        self.max_concurrent = max(max_concurrent, 1)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.per_user = per_user
+        self.service_time = service_time
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        # user_id -> waiters，按用户轮流放行
+        self._waiters = OrderedDict()
+        # user_id -> requests served or waiting
+        self._per_user = {}
+        self.stats = {
+            'admitted': 0,
+            'rejected_queue': 0,
+            'rejected_wait': 0,
+            'rejected_user': 0,
+            'timeouts': 0,
+        }
+
+    def estimated_wait(self):
+        """
+        seconds a new request would wait for a slot
+        """
+        with self._lock:
+            return self._estimate()
+
+    def _estimate(self):
+        if self._active < self.max_concurrent and not self._queued:
+            return 0.0
+        return (self._queued + 1) / self.max_concurrent * self.service_time
+
+    def _reject(self, kind, reason, retry_after):
+        self.stats[kind] += 1
+        raise Rejected(reason, max(int(math.ceil(retry_after)), 1))
+
+    def acquire(self, user_id):
+        """
+        wait for a slot
+        params:
+            user_id: user the request belongs to
+        return:
+            seconds the request waited
+        raises:
+            Rejected: the queue is full, the wait would be too long or
+                the user has too many requests
+        """
+        start = time.monotonic()
+        with self._lock:
+            if self._per_user.get(user_id, 0) >= self.per_user:
+                self._reject('rejected_user',
+                             'too many requests for this user',
+                             self.service_time)
+            if self._active < self.max_concurrent and not self._queued:
+                self._active += 1
+                self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+                self.stats['admitted'] += 1
+                return 0.0
+            estimate = self._estimate()
+            if self._queued >= self.max_queue:
+                self._reject('rejected_queue', 'server busy', estimate)
+            if estimate > self.max_wait:
+                self._reject('rejected_wait', 'server busy', estimate)
+            waiter = _Waiter(user_id)
+            self._waiters.setdefault(user_id, deque()).append(waiter)
+            self._queued += 1
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        waiter.event.wait(self.max_wait)
+        with self._lock:
+            if not waiter.granted:
+                # 超时之前没有轮到，从队列中移除
+                waiters = self._waiters[user_id]
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[user_id]
+                self._queued -= 1
+                self._release_user(user_id)
+                self._reject('timeouts', 'server busy', self._estimate())
+            self.stats['admitted'] += 1
+        return time.monotonic() - start
+
+    def release(self, user_id, elapsed=None):
+        """
+        give the slot back, handing it to the next user in turn
+        params:
+            user_id: user the request belonged to
+            elapsed: seconds the request took, updates the estimate
+        """
+        with self._lock:
+            if elapsed is not None:
+                self.service_time += 0.2 * (elapsed - self.service_time)
+            self._release_user(user_id)
+            if not self._waiters:
+                self._active -= 1
+                return
+            next_user, waiters = next(iter(self._waiters.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(next_user)
+            else:
+                del self._waiters[next_user]
+            self._queued -= 1
+            waiter.granted = True
+            waiter.event.set()
+
+    def _release_user(self, user_id):
+        count = self._per_user[user_id] - 1
+        if count:
+            self._per_user[user_id] = count
+        else:
+            del self._per_user[user_id]
+
+    @contextmanager
+    def admit(self, user_id):
+        """
+        hold a slot for the block
+        params:
+            user_id: user the request belongs to
+        return:
+            seconds the request waited
+        """
+        waited = self.acquire(user_id)
+        start = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self.release(user_id, time.monotonic() - start)
+
+    def as_dict(self):
+        """
+        return:
+            counters, slots in use, queue depth and the wait estimate
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['active'] = self._active
+            stats['queued'] = self._queued
+            stats['service_time'] = self.service_time
+            stats['estimated_wait'] = self._estimate()
+        return stats
+
+    @classmethod
+    def from_env(cls):
+        """
+        read NPC_ADMISSION_CONCURRENCY, NPC_ADMISSION_QUEUE,
+        NPC_ADMISSION_MAX_WAIT and NPC_ADMISSION_PER_USER
+        """
+        return cls(
+            max_concurrent=int(os.getenv('NPC_ADMISSION_CONCURRENCY', '16')),
+            max_queue=int(os.getenv('NPC_ADMISSION_QUEUE', '64')),
+            max_wait=float(os.getenv('NPC_ADMISSION_MAX_WAIT', '10')),
+            per_user=int(os.getenv('NPC_ADMISSION_PER_USER', '2')))
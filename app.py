@@ -2,46 +2,597 @@
 This file contains the code for the Flask server that handles
 the conversations with the NPCs.
 """
+import atexit
+import contextvars
+import itertools
+import gzip
+import json
+import os
+import sys
+import threading
+import time
 import uuid
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager, nullcontext
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS, cross_origin
-from npc_langchain import NpcLangChain as NPC
+from npc_prompt import config_registry
+import metrics
+from admission import AdmissionController, Rejected
+from idempotency import IdempotencyConflict, RequestCoalescer
+from preflight import PromptTooLargeError
+from session_backend import create_backend
+from session_snapshot import read_snapshot, write_snapshot
+from session_store import SessionStore, UserLocks
 
 app = Flask(__name__)
-cors = CORS(app)
+cors = CORS(app,
+            expose_headers=['ETag', 'Retry-After', 'Idempotent-Replayed'])
 app.config['CORS_HEADERS'] = 'Content-Type'
 app.secret_key = 'secret key'
 # npc = NpcLangChain(player_name="Player")
 # npcs = {}
+DEFAULT_NPC = 'Ted'
+SESSION_MAX = int(os.getenv('NPC_SESSION_MAX', '1000'))
+SESSION_MAX_BYTES = int(os.getenv('NPC_SESSION_MAX_BYTES', '0')) or None
+SESSION_TTL = os.getenv('NPC_SESSION_TTL', '1800')
+SESSION_BACKEND = os.getenv('NPC_SESSION_BACKEND', 'memory')
+SESSION_OVERHEAD = 512
+HISTORY_PAGE_SIZE = int(os.getenv('NPC_HISTORY_PAGE_SIZE', '50'))
+HISTORY_PAGE_MAX = int(os.getenv('NPC_HISTORY_PAGE_MAX', '500'))
+GZIP_MIN_BYTES = int(os.getenv('NPC_GZIP_MIN_BYTES', '1024'))
+BATCH_MAX_ITEMS = int(os.getenv('NPC_BATCH_MAX_ITEMS', '100'))
+BATCH_WORKERS = int(os.getenv('NPC_BATCH_WORKERS', '8'))
+# 退出时把全部会话写入这个快照，启动时从中恢复
+SNAPSHOT_PATH = os.getenv('NPC_SNAPSHOT_PATH', '')
+# 启动时在后台线程中加载 langchain、openai，构建模板和客户端
+PREWARM = os.getenv('NPC_PREWARM', '1') != '0'
+# 会话的对话纪元：重置、换NPC、改配置或任务状态时换一个新值，重复提交
+# 只在同一个纪元内合并。进程内递增，会话被换出再载入也不会重复
+SESSION_EPOCHS = itertools.count()
+
+
+def npc_module():
+    """ Returns npc_langchain, importing it on first use.
+    It pulls in langchain, openai and their pydantic models, so it is
+    left out of the import of this module: the prewarm thread or the
+    first request that needs an NPC loads it.
+    """
+    import npc_langchain  # pylint: disable=import-outside-toplevel
+    return npc_langchain
+
+
+def default_npc():
+    """ Returns the NPC a new session starts with.
+    """
+    names = config_registry.names()
+    if DEFAULT_NPC in names or not names:
+        return DEFAULT_NPC
+    return names[0]
+
+
+def dump_session(sess):
+    """ Converts a live session to its compact, JSON serializable form.
+    """
+    # 同一用户不同NPC的对话并发进行，可能同时加入新的NPC，先复制再遍历
+    npcs = dict(sess['states'])
+    npcs.update((name, npc.dump_state())
+                for name, npc in list(sess['npcs'].items()))
+    return {'curr_npc': sess['curr_npc'], 'npcs': npcs}
+
+
+def load_session(state):
+    """ Builds a live session from its compact form.
+    NPCs are only rebuilt when they are used again.
+    """
+    return {
+        'npcs': {},
+        'states': dict(state['npcs']),
+        'curr_npc': state['curr_npc'],
+        'epoch': next(SESSION_EPOCHS),
+    }
+
+
+def sizeof_session(sess):
+    """ Estimates the memory used by a live session.
+    """
+    size = SESSION_OVERHEAD
+    size += sum(npc.approx_size() for npc in list(sess['npcs'].values()))
+    if sess['states']:
+        npc_class = npc_module().NpcLangChain
+        size += sum(npc_class.state_size(state)
+                    for state in list(sess['states'].values()))
+    return size
+
+
+def parse_history_args(args):
+    """ Reads the paging arguments of a history request.
+    Args:
+        args: The query string, `since` is the index of the first line
+            (negative counts from the end), `limit` the page size and
+            `epoch` the epoch the client's index refers to.
+    Returns:
+        (since, limit, epoch)
+    Raises:
+        ValueError: If since or limit is not a valid number.
+    """
+    since = int(args.get('since', 0))
+    limit = int(args.get('limit', HISTORY_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError(f'invalid limit {limit}')
+    return since, min(limit, HISTORY_PAGE_MAX), args.get('epoch') or None
+
+
+def history_etag(npc, since, limit, epoch):
+    """ Returns the entity tag of a history page, it changes whenever
+    the content of the page would.
+    """
+    return f'{npc.history_etag}-{since}-{limit}-{epoch or ""}'
+
+
+def encode_json(payload, accept_gzip):
+    """ Serializes a response body, gzipped when the client accepts it
+    and the body is large enough to be worth it.
+    Returns:
+        (body bytes, content encoding or None)
+    """
+    body = json.dumps(payload, ensure_ascii=False,
+                      separators=(',', ':')).encode()
+    if accept_gzip and len(body) >= GZIP_MIN_BYTES:
+        return gzip.compress(body, compresslevel=5), 'gzip'
+    return body, None
+
+
+def history_response(payload, status=200, etag=None):
+    """ Builds the JSON response of a history page.
+    """
+    body, encoding = encode_json(payload,
+                                 'gzip' in request.accept_encodings)
+    response = Response(body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag)
+        # 允许缓存，但每次都要用 If-None-Match 重新验证
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 class SessionManager:
     """ Manages user sessions.
+    NPCs are created on first use, the config, prompt template and LLM
+    client they share are cached in npc_langchain. Live sessions are
+    kept in a bounded SessionStore in front of a SessionBackend, which
+    may be shared by several worker processes.
+    Every conversation, a user and one NPC, has its own lock: turns of
+    one conversation run one at a time, turns of one user with
+    different NPCs and requests of different users never wait for each
+    other. Session-level changes hold the user's lock alone and wait
+    for the user's turns in flight. The striped backend lock is only
+    taken to load and commit the session, except for a shared backend,
+    where it also keeps other processes out for the whole request and
+    so runs the turns of one user one at a time.
     """
-    def __init__(self):
-        self.sessions = {}
+    def __init__(self, store=None):
+        if store is None:
+            store = SessionStore(
+                dump=dump_session, load=load_session, sizeof=sizeof_session,
+                max_sessions=SESSION_MAX,
+                max_bytes=SESSION_MAX_BYTES,
+                ttl=float(SESSION_TTL) if SESSION_TTL else None,
+                backend=create_backend(SESSION_BACKEND))
+        self.sessions = store
+        self.user_locks = UserLocks()
+        # (user_id, npc_name) -> 这段对话的锁
+        self.conversation_locks = UserLocks()
+
+    @contextmanager
+    def session(self, user_id, commit=True, shared=False):
+        """ Holds the user's lock and yields the session.
+        A /reset, /changeNPC or /setConfigStr of the user waits until the
+        messages in flight have been answered and committed, and the
+        other way round.
+        The session is committed even when the block is left early, e.g.
+        when a streaming client disconnects after the turn was recorded.
+        Args:
+            user_id (str): The user ID.
+            commit (bool): Whether the block changes the session and
+                the change must be written to the backend.
+            shared (bool): Whether the block only reads the session, e.g.
+                the current NPC, beside the turns in flight. It must not
+                change the session, commit is ignored.
+        """
+        with self._hold(user_id, 'read' if shared else 'session',
+                        commit and not shared) as (sess, _, _):
+            yield sess
+
+    @contextmanager
+    def conversation(self, user_id, npc_name=None, commit=True):
+        """ Holds the lock of one conversation of the user and yields it.
+        Turns with different NPCs of one user run concurrently, turns
+        with the same NPC one at a time. The user's lock is held shared,
+        so session-level changes still wait for the turn.
+        Args:
+            user_id (str): The user ID.
+            npc_name (str): The NPC name, defaults to the current NPC.
+            commit (bool): See session().
+        Yields:
+            (session, npc_name, npc), npc is None if the NPC does not
+            exist.
+        """
+        with self._hold(user_id, 'turn', commit, npc_name) as held:
+            yield held
+
+    @contextmanager
+    def _hold(self, user_id, mode, commit, npc_name=None):
+        """ Holds the locks of a 'session', 'read' or 'turn' block.
+        """
+        start = time.perf_counter()
+        backend = self.sessions.backend
+        with ExitStack() as stack:
+            stack.enter_context(
+                self.user_locks.hold(user_id, shared=mode != 'session'))
+            if backend.shared and mode != 'read':
+                stack.enter_context(backend.lock(user_id))
+                store_lock = nullcontext
+            else:
+                store_lock = backend.lock
+            locked = time.perf_counter()
+            # 只读的请求不等待进行中的对话持有的后端锁
+            sess = self.sessions.cached(user_id) if mode == 'read' else None
+            if sess is None:
+                with store_lock(user_id):
+                    sess = self.get_session(user_id, pin=mode != 'read')
+                if mode != 'read':
+                    # 请求期间会话不会被换出，同一用户的其他对话不会载入
+                    # 缺少这一轮的旧副本
+                    stack.callback(self.sessions.unpin, user_id, sess)
+            loaded = time.perf_counter()
+            wait = locked - start
+            npc = None
+            if mode == 'turn':
+                npc_name = npc_name or sess['curr_npc']
+                stack.enter_context(
+                    self.conversation_locks.hold((user_id, npc_name)))
+                wait += time.perf_counter() - loaded
+                npc = self.get_npc(sess, npc_name)
+            metrics.observe_stage('lock_wait', wait)
+            metrics.observe_stage('session', loaded - locked)
+            try:
+                yield sess, npc_name, npc
+            finally:
+                if commit:
+                    with store_lock(user_id):
+                        self.sessions.commit(user_id, sess)
 
-    def get_session(self, user_id):
+    def get_session(self, user_id, pin=False):
         """ Returns the session for the given user ID.
+        The caller must hold the user's backend lock, see session().
+        Args:
+            user_id (str): The user ID.
+            pin (bool): Keep the session in memory until
+                sessions.unpin(), see SessionStore.unpin.
         """
-        if user_id not in self.sessions:
-            self.sessions[user_id] = {
-                'npcs': {
-                    'Ted': NPC('Ted'),
-                    'Barry': NPC('Barry'),
-                    'Mike': NPC('Mike'),
-                },
-                'curr_npc': 'Ted',
+        sess = self.sessions.get(user_id, pin=pin)
+        if sess is None:
+            sess = {
+                'npcs': {},
+                'states': {},
+                'curr_npc': default_npc(),
+                'epoch': next(SESSION_EPOCHS),
             }
-        return self.sessions[user_id]
+            self.sessions.put(user_id, sess, pin=pin)
+        return sess
+
+    @staticmethod
+    def get_npc(sess, npc_name=None):
+        """ Returns the NPC of the given session, creating it on first use.
+        Args:
+            sess (dict): The session returned by get_session.
+            npc_name (str): The NPC name, defaults to the current NPC.
+        Returns:
+            The NpcLangChain instance, None if the NPC does not exist.
+        """
+        if npc_name is None:
+            npc_name = sess['curr_npc']
+        if npc_name not in config_registry.names():
+            return None
+        npc = sess['npcs'].get(npc_name)
+        if npc is None:
+            with metrics.timed_stage('npc_construction', npc_name):
+                npc_class = npc_module().NpcLangChain
+                state = sess['states'].get(npc_name)
+                if state is not None:
+                    npc = npc_class.from_state(state)
+                else:
+                    npc = npc_class(npc_name)
+            # 先放入再删除，同时写出的会话不会丢掉这个NPC
+            sess['npcs'][npc_name] = npc
+            sess['states'].pop(npc_name, None)
+        return npc
 
     def reset(self, user_id):
         """ Resets the session for the given user ID.
         """
-        self.sessions[user_id] = {}
+        with self.user_locks.hold(user_id), \
+                self.sessions.backend.lock(user_id):
+            self.sessions.pop(user_id)
+
+    def iter_states(self):
+        """ Yields the compact state of every session, live or stored.
+        Each user's lock is held only while that session is dumped, so
+        requests keep being served while a snapshot is written. A
+        session with a message in flight is dumped once it is answered.
+        Yields:
+            (user_id, state) pairs.
+        """
+        store = self.sessions
+        seen = set()
+        for user_id in store.keys() + store.backend.keys():
+            if user_id in seen:
+                continue
+            seen.add(user_id)
+            with self.user_locks.hold(user_id), \
+                    store.backend.lock(user_id):
+                state = store.peek(user_id)
+            if state is not None:
+                yield user_id, state
+
+    def export_snapshot(self, path):
+        """ Writes every session to a snapshot file.
+        Returns:
+            The number of sessions written.
+        """
+        return write_snapshot(path, self.iter_states())
+
+    def import_snapshot(self, path):
+        """ Adds the sessions of a snapshot file to the backend.
+        Sessions stay in their compact form until their user comes back,
+        meant for a worker that has not served any request yet.
+        Returns:
+            The number of sessions imported.
+        """
+        return self.sessions.backend.restore(read_snapshot(path))
 
 
 session_manager = SessionManager()
+# 最近一次导出快照的状态
+snapshot_status = {'running': False, 'path': SNAPSHOT_PATH or None,
+                   'sessions': None, 'seconds': None, 'finished': None,
+                   'error': None}
+_snapshot_lock = threading.Lock()
+
+
+def export_snapshot():
+    """ Writes the sessions to NPC_SNAPSHOT_PATH, unless an export is
+    already running.
+    Returns:
+        Whether this call ran the export.
+    """
+    if not _snapshot_lock.acquire(blocking=False):
+        return False
+    try:
+        snapshot_status.update(running=True, error=None)
+        start = time.perf_counter()
+        try:
+            count = session_manager.export_snapshot(SNAPSHOT_PATH)
+            snapshot_status.update(sessions=count, finished=time.time())
+        except Exception as error:  # pylint: disable=broad-except
+            print(f'snapshot export failed: {error!r}')
+            snapshot_status['error'] = repr(error)
+        snapshot_status['seconds'] = round(time.perf_counter() - start, 3)
+        return True
+    finally:
+        snapshot_status['running'] = False
+        _snapshot_lock.release()
+
+
+if SNAPSHOT_PATH:
+    # 共享后端中已有会话时，不用可能更旧的快照覆盖它们
+    if os.path.exists(SNAPSHOT_PATH) and \
+            not len(session_manager.sessions.backend):
+        _import_start = time.perf_counter()
+        _imported = session_manager.import_snapshot(SNAPSHOT_PATH)
+        print(f'restored {_imported} sessions from {SNAPSHOT_PATH} in '
+              f'{time.perf_counter() - _import_start:.2f} s')
+    atexit.register(export_snapshot)
+# 预热的各个部分是否已经完成，以及完成时距启动的秒数
+readiness = {
+    'configs': None,
+    'modules': None,
+    'templates': None,
+    'clients': None,
+    'conversations': None,
+}
+readiness_errors = []
+_started = time.perf_counter()
+
+
+def prewarm():
+    """ Loads what the first requests need ahead of them: the NPC
+    configs and system prompts, the langchain and openai modules, the
+    prompt templates, the LLM clients and one conversation per NPC.
+    """
+    def done(part):
+        readiness[part] = round(time.perf_counter() - _started, 3)
+
+    try:
+        names = config_registry.names()
+        configs = [config_registry.get(name) for name in names]
+        done('configs')
+        module = npc_module()
+        done('modules')
+        for name, config in zip(names, configs):
+            module.get_prompt_template(name, config.system_prompt)
+            module.system_prompt_tokens(config.system_prompt)
+        done('templates')
+        module.get_llm()
+        module.get_llm(streaming=True)
+        done('clients')
+        for name in names:
+            module.NpcLangChain(name)
+        done('conversations')
+    except Exception as error:  # pylint: disable=broad-except
+        print(f'prewarm failed: {error!r}')
+        readiness_errors.append(repr(error))
+
+
+if PREWARM:
+    threading.Thread(target=prewarm, name='npc-prewarm', daemon=True).start()
+# 只有要调用LLM的接口需要准入，其余接口直接放行
+admission = AdmissionController.from_env()
+# 重复提交的消息共用一次LLM调用，不占用准入名额
+coalescer = RequestCoalescer.from_env()
+
+
+@contextmanager
+def admitted(user_id):
+    """ Holds an admission slot for a request that calls the LLM.
+    Raises:
+        Rejected: The request is shed, answered with 429.
+    """
+    with admission.admit(user_id) as waited:
+        metrics.observe_stage('admission', waited)
+        yield
+
+
+def conversation_scope(user_id):
+    """ Names the conversation a message of the user goes to, for
+    merging duplicate submits.
+    Only messages to the same NPC with no reset, NPC change or config
+    change in between share a scope. The session is only read, the
+    call does not wait for the user's requests in flight.
+    Returns:
+        The scope string.
+    """
+    with session_manager.session(user_id, shared=True) as sess:
+        return f"{user_id}:{sess['curr_npc']}:{sess['epoch']}"
+
+
+@app.errorhandler(Rejected)
+def handle_rejected(error):
+    """ Answers a request shed by the admission controller.
+    Returns:
+        A 429 response with a Retry-After header.
+    """
+    response = jsonify({'error': error.reason,
+                        'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def prompt_too_large_payload(error):
+    """ Returns the body answering a prompt refused by the preflight.
+    """
+    return {'error': str(error), 'budget': error.budget,
+            'tokens': error.breakdown}
+
+
+@app.errorhandler(PromptTooLargeError)
+def handle_prompt_too_large(error):
+    """ Answers a turn whose prompt does not fit the context window.
+    Returns:
+        A 413 response with the tokens of each prompt component.
+    """
+    return jsonify(prompt_too_large_payload(error)), 413
+
+
+@app.before_request
+def start_request_timer():
+    """ Labels the metrics of this request with its endpoint.
+    """
+    g.request_start = time.perf_counter()
+    metrics.current_endpoint.set(request.endpoint or '')
+
+
+@app.after_request
+def observe_request(response):
+    """ Records the request latency.
+    Streaming responses are timed until their headers are sent.
+    """
+    start = g.get('request_start')
+    if start is not None:
+        metrics.request_seconds.observe(time.perf_counter() - start,
+                                        endpoint=request.endpoint or '')
+    return response
+
+
+def collect_app_metrics():
+    """ Reports the counters kept by the session store, the admission
+    controller, the duplicate coalescer, the reply cache, the LLM
+    client and the prompt token stats.
+    """
+    store = session_manager.sessions
+    for name, value in store.stats.items():
+        yield (f'npc_session_{name}_total', 'counter',
+               f'Session store {name}.', {}, value)
+    yield ('npc_live_sessions', 'gauge', 'Sessions held in memory.', {},
+           len(store))
+    yield ('npc_live_session_bytes', 'gauge',
+           'Estimated memory of live sessions.', {}, store.live_bytes)
+    stats = admission.as_dict()
+    for name in ('admitted', 'rejected_queue', 'rejected_wait',
+                 'rejected_user', 'timeouts'):
+        yield (f'npc_admission_{name}_total', 'counter',
+               f'Admission {name}.', {}, stats[name])
+    yield ('npc_admission_active', 'gauge', 'Admitted requests running.',
+           {}, stats['active'])
+    yield ('npc_admission_queued', 'gauge', 'Requests waiting for a slot.',
+           {}, stats['queued'])
+    yield ('npc_admission_estimated_wait_seconds', 'gauge',
+           'Expected wait of a new request.', {}, stats['estimated_wait'])
+    stats = coalescer.as_dict()
+    for name in ('executed', 'coalesced', 'replayed', 'conflicts'):
+        yield (f'npc_duplicate_{name}_total', 'counter',
+               f'Conversation requests {name}.', {}, stats[name])
+    yield ('npc_duplicate_in_flight', 'gauge',
+           'Distinct conversation requests in flight.', {},
+           stats['in_flight'])
+    # 还没有加载 npc_langchain 时不为了指标去加载它
+    module = sys.modules.get('npc_langchain')
+    if module is None:
+        return
+    cache = module.reply_cache
+    if cache is not None:
+        stats = cache.as_dict()
+        yield ('npc_reply_cache_hits_total', 'counter', 'Reply cache hits.',
+               {}, stats['hits'])
+        yield ('npc_reply_cache_misses_total', 'counter',
+               'Reply cache misses.', {}, stats['misses'])
+        yield ('npc_reply_cache_saved_seconds_total', 'counter',
+               'LLM seconds saved by the reply cache.', {},
+               stats['latency_saved'])
+    for name, value in sys.modules['llm_client'].llm_stats.items():
+        yield (f'npc_llm_{name}_total', 'counter', f'LLM client {name}.',
+               {}, value)
+    breaker = module.llm_breaker
+    yield ('npc_llm_breaker_open', 'gauge',
+           'Whether the LLM circuit breaker rejects calls.', {},
+           int(breaker.state != breaker.CLOSED))
+    for name, value in breaker.stats.items():
+        yield (f'npc_llm_breaker_{name}_total', 'counter',
+               f'LLM circuit breaker {name}.', {}, value)
+    stats = module.prompt_token_stats.as_dict()
+    yield ('npc_prompt_tokens_sent_total', 'counter',
+           'Prompt tokens sent.', {}, stats['sent_tokens'])
+    yield ('npc_prompt_tokens_unbounded_total', 'counter',
+           'Prompt tokens had the whole history been sent.', {},
+           stats['unbounded_tokens'])
+    cache = stats['prefix_cache']
+    yield ('npc_prefix_cache_reported_total', 'counter',
+           'LLM calls that reported prefix cache usage.', {},
+           cache['reported'])
+    yield ('npc_prefix_cache_hits_total', 'counter',
+           'LLM calls that read part of the prompt from the cache.', {},
+           cache['hits'])
+    yield ('npc_prefix_cache_cached_tokens_total', 'counter',
+           'Prompt tokens read from the prefix cache.', {},
+           cache['cached_tokens'])
+
+
+metrics.registry.register_collector(collect_app_metrics)
 
 
 @app.route('/userId', methods=['GET', 'OPTIONS'])
@@ -56,37 +607,318 @@ def handle_user_id():
     return jsonify({'error': 'invalid request method'}), 400
 
 
-@app.route('/conversations/<user_id>', methods=['GET', 'POST', 'OPTIONS'])
+@app.route('/npcs', methods=['GET', 'OPTIONS'])
 @cross_origin()
+def list_npcs():
+    """ Lists the NPCs found in the NPCConfigs directory.
+    Returns:
+        A JSON response containing the NPC names.
+    """
+    return jsonify({'npcs': config_registry.names()}), 200
+
+
+@app.route('/conversations/<user_id>', methods=['GET', 'POST', 'OPTIONS'])
+@cross_origin(expose_headers=['ETag', 'Retry-After', 'Idempotent-Replayed'])
 def handle_npc_conversations(user_id):
     """ Handles the conversations with the specified NPC.
+    GET returns a page of the history: the query arguments `since`
+    (index of the first line, negative counts from the end), `limit`
+    (page size) and `epoch` (the history epoch `since` refers to) are
+    optional. The response carries an ETag, an unchanged page answers
+    If-None-Match with 304, large pages are gzipped on request.
+    POST sends a message, see post_message.
     Args:
         npc_name (str): The name of the NPC to handle the conversations with.
     Returns:
         A JSON response containing the conversations with the specified NPC.
     """
-    sess = session_manager.get_session(user_id)
-    npc_name = sess['curr_npc']
-    npc = sess['npcs'].get(npc_name)
-    if request.method == 'GET':
+    if request.method == 'POST':
+        return post_message(user_id)
+    with session_manager.conversation(user_id, commit=False) as (
+            _, npc_name, npc):
         # 获取和这个NPC的对话
-        if npc:
-            return jsonify(npc.conversation), 200
-        return jsonify({'error': f'NPC {npc_name} not found'}), 404
+        if not npc:
+            return jsonify({'error': f'NPC {npc_name} not found'}), 404
+        try:
+            since, limit, epoch = parse_history_args(request.args)
+        except ValueError:
+            return jsonify({'error': 'invalid since or limit'}), 400
+        etag = history_etag(npc, since, limit, epoch)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        return history_response(npc.history_page(since, limit, epoch),
+                                etag=etag)
 
-    if request.method == 'POST':
-        if request.json is None:
-            return jsonify({'error': 'invalid JSON in request body'}), 400
-        message = request.json.get('message')
-        if message:
+
+def post_message(user_id):
+    """ Sends a message to the user's current NPC.
+    A retried or double submitted message is answered once: requests
+    with the same `Idempotency-Key` header (or `idempotency_key` field),
+    or without a key but with the same message, share the reply of the
+    request still in flight, and get it replayed for a short while
+    after it finished, with the `Idempotent-Replayed: true` header.
+    Only requests to the same NPC with no reset, NPC change or config
+    change in between are merged.
+    Returns:
+        201 with the reply, 422 if the key was used for another message.
+    """
+    if request.json is None:
+        return jsonify({'error': 'invalid JSON in request body'}), 400
+    message = request.json.get('message')
+    if not message:
+        return jsonify({'error': 'Message is required'}), 400
+    key = (request.headers.get('Idempotency-Key')
+           or request.json.get('idempotency_key') or None)
+
+    def send():
+        with admitted(user_id), \
+                session_manager.conversation(user_id) as (_, npc_name, npc):
+            if not npc:
+                return {'error': f'NPC {npc_name} not found'}, 404
             # 将消息添加到这个NPC的对话中
-            if npc:
-                response = npc(message)
-                print(response)
-                return jsonify({'message': response}), 201
-            return jsonify({'error': f'NPC {npc_name} not found'}), 404
+            return {'message': npc(message)}, 201
+
+    try:
+        (payload, status), replayed = coalescer.run(
+            conversation_scope(user_id), message, send, key=key)
+    except IdempotencyConflict as error:
+        return jsonify({'error': str(error)}), 422
+    response = jsonify(payload)
+    response.status_code = status
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+@app.route('/conversations/<user_id>/stream', methods=['POST', 'OPTIONS'])
+@cross_origin(expose_headers=['Retry-After'])
+def stream_npc_conversation(user_id):
+    """ Sends a message to the current NPC and streams the reply.
+    The reply is sent as Server-Sent Events: one `data: {"token": ...}`
+    event per token, then an `event: done` event carrying the whole
+    reply. The session stays locked until the reply is committed, the
+    admission slot is held until the response is closed.
+    Returns:
+        A text/event-stream response.
+    """
+    if request.json is None:
+        return jsonify({'error': 'invalid JSON in request body'}), 400
+    message = request.json.get('message')
+    if not message:
         return jsonify({'error': 'Message is required'}), 400
 
+    with session_manager.session(user_id, shared=True) as sess:
+        npc_name = sess['curr_npc']
+        if npc_name not in config_registry.names():
+            return jsonify({'error': f'NPC {npc_name} not found'}), 404
+
+    def generate():
+        with session_manager.conversation(user_id) as (_, npc_name, npc):
+            if npc is None:
+                data = json.dumps({'error': f'NPC {npc_name} not found',
+                                   'status': 404})
+                yield f'event: error\ndata: {data}\n\n'
+                return
+            tokens = []
+            try:
+                # 客户端断开时先等这一轮写完，再提交会话
+                with closing(npc.stream(message)) as stream:
+                    for token in stream:
+                        tokens.append(token)
+                        data = json.dumps({'token': token},
+                                          ensure_ascii=False)
+                        yield f'data: {data}\n\n'
+            except PromptTooLargeError as error:
+                data = json.dumps(prompt_too_large_payload(error),
+                                  ensure_ascii=False)
+                yield f'event: error\ndata: {data}\n\n'
+                return
+            data = json.dumps({'message': ''.join(tokens)},
+                              ensure_ascii=False)
+            yield f'event: done\ndata: {data}\n\n'
+
+    metrics.observe_stage('admission', admission.acquire(user_id))
+    start = time.monotonic()
+
+    def release():
+        admission.release(user_id, time.monotonic() - start)
+
+    try:
+        response = Response(stream_with_context(generate()),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache',
+                                     'X-Accel-Buffering': 'no'})
+    except BaseException:
+        release()
+        raise
+    # 客户端提前断开、生成器没有运行时也会归还
+    response.call_on_close(release)
+    return response
+
+
+# 所有批量请求共用，限制批量对话同时调用LLM的数量
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS,
+                                thread_name_prefix='npc-batch')
+
+
+def parse_batch_item(item):
+    """ Validates one item of a batch request.
+    Returns:
+        (user_id, npc_name or None, message)
+    Raises:
+        ValueError: If the item is malformed.
+    """
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+    user_id = item.get('user_id')
+    npc_name = item.get('npc')
+    message = item.get('message')
+    if not isinstance(user_id, str) or not user_id:
+        raise ValueError('user_id is required')
+    if not isinstance(message, str) or not message:
+        raise ValueError('Message is required')
+    if npc_name is not None and not isinstance(npc_name, str):
+        raise ValueError('npc must be a string')
+    return user_id, npc_name or None, message
+
+
+def play_turns(npc, turns):
+    """ Sends the messages of one conversation to its NPC in order.
+    Args:
+        npc (NpcLangChain): The NPC.
+        turns (list): (index, message) pairs.
+    Returns:
+        A list of (index, result) pairs.
+    """
+    results = []
+    for index, message in turns:
+        try:
+            results.append((index, {'message': npc(message)}))
+        except PromptTooLargeError as error:
+            results.append((index, dict(prompt_too_large_payload(error),
+                                        status=413)))
+        except Exception as error:  # pylint: disable=broad-except
+            results.append((index, {'error': str(error), 'status': 500}))
+    return results
+
+
+def user_conversations(user_id, user_items):
+    """ Groups the batch messages of one user by NPC.
+    Args:
+        user_id (str): The user ID.
+        user_items (list): (index, npc_name or None, message) tuples.
+    Returns:
+        (conversations, results): (npc_name, turns) pairs in the order
+        the NPCs first appear, turns being (index, message) pairs, and
+        the (index, result) pairs of the messages to unknown NPCs.
+    """
+    current = None
+    if any(npc_name is None for _, npc_name, _ in user_items):
+        with session_manager.session(user_id, shared=True) as sess:
+            current = sess['curr_npc']
+    names = config_registry.names()
+    conversations = {}
+    results = []
+    for index, npc_name, message in user_items:
+        npc_name = npc_name or current
+        if npc_name not in names:
+            results.append((index, {'npc': npc_name, 'status': 404,
+                                    'error': f'NPC {npc_name} not found'}))
+            continue
+        conversations.setdefault(npc_name, []).append((index, message))
+    return list(conversations.items()), results
+
+
+def play_conversations(user_id, conversations):
+    """ Sends the batch messages of some conversations of one user, one
+    conversation after the other, holding an admission slot of the user
+    and the lock of each conversation until it is answered and committed.
+    Args:
+        user_id (str): The user ID.
+        conversations (list): (npc_name, turns) pairs, turns being
+            (index, message) pairs.
+    Returns:
+        A list of (index, result) pairs, every result names its NPC.
+    """
+    results = []
+    try:
+        with admitted(user_id):
+            for npc_name, turns in conversations:
+                with session_manager.conversation(user_id, npc_name) as (
+                        _, _, npc):
+                    if npc is None:
+                        played = [(index, {
+                            'status': 404,
+                            'error': f'NPC {npc_name} not found'})
+                            for index, _ in turns]
+                    else:
+                        played = play_turns(npc, turns)
+                results.extend((index, dict(result, npc=npc_name))
+                               for index, result in played)
+    except Rejected as error:
+        done = {index for index, _ in results}
+        results.extend((index, {'npc': npc_name, 'error': error.reason,
+                                'status': 429,
+                                'retry_after': error.retry_after})
+                       for npc_name, turns in conversations
+                       for index, _ in turns if index not in done)
+    return results
+
+
+@app.route('/batchConversations', methods=['POST', 'OPTIONS'])
+@cross_origin(expose_headers=['Retry-After'])
+def batch_conversations():
+    """ Sends many messages at once.
+    The body is {"items": [{"user_id": ..., "npc": ..., "message": ...}]},
+    npc defaults to the user's current NPC. Conversations run
+    concurrently on a bounded pool, the messages of one conversation in
+    the order given, under its lock like any other turn. The
+    conversations of one user run on at most as many tasks as the user
+    may have admitted requests, each task takes an admission slot of
+    the user, like a POST /conversations.
+    Returns:
+        A JSON response with one result per item, in order: the reply
+        as "message", or "error" and "status" (429 with "retry_after"
+        for the messages of a task that was shed).
+    """
+    if request.json is None:
+        return jsonify({'error': 'invalid JSON in request body'}), 400
+    items = request.json.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items is required'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({
+            'error': f'at most {BATCH_MAX_ITEMS} items per batch'}), 413
+    results = []
+    by_user = {}
+    for index, item in enumerate(items):
+        try:
+            user_id, npc_name, message = parse_batch_item(item)
+        except ValueError as error:
+            results.append({'error': str(error), 'status': 400})
+            continue
+        results.append({'user_id': user_id})
+        by_user.setdefault(user_id, []).append((index, npc_name, message))
+
+    futures = []
+    for user_id, user_items in by_user.items():
+        conversations, unknown = user_conversations(user_id, user_items)
+        for index, result in unknown:
+            results[index].update(result)
+        # 同一用户的对话分给不超过每用户准入上限的任务，每个任务按真实的
+        # 用户占用一个准入名额；工作线程中保留当前请求的上下文（例如指标
+        # 中的endpoint）
+        tasks = min(max(admission.per_user, 1), len(conversations))
+        futures.extend(batch_pool.submit(
+            contextvars.copy_context().run, play_conversations, user_id,
+            conversations[task::tasks]) for task in range(tasks))
+    for future in futures:
+        for index, result in future.result():
+            results[index].update(result)
+    return jsonify({'results': results}), 200
+
 
 @app.route('/changeNPC/<user_id>', methods=['POST', 'OPTIONS'])
 @cross_origin()
@@ -95,23 +927,25 @@ def change_npc(user_id):
     Returns:
         A JSON response indicating whether the NPC was successfully changed.
     """
-    sess = session_manager.get_session(user_id)
-    if request.method == 'POST':
-        if request.json is None:
-            return jsonify({'error': 'invalid JSON in request body'}), 400
-        new_name = request.json.get('npc_name')
-        print(new_name)
-        if new_name:
-            # 在这里添加你改变NPC的逻辑
-            sess['curr_npc'] = new_name
-            npc = sess['npcs'].get(new_name)
-            return jsonify({
-                'npc_name': npc.npc_name,
-                'config_str': npc.config_str,
-                'conversation': npc.conv_history,
-            }), 200
-        return jsonify({'error': 'NPC name is required'}), 400
-    return jsonify({'ok': 'ok'}), 200
+    with session_manager.session(user_id) as sess:
+        if request.method == 'POST':
+            if request.json is None:
+                return jsonify({'error': 'invalid JSON in request body'}), 400
+            new_name = request.json.get('npc_name')
+            print(new_name)
+            if new_name:
+                # 在这里添加你改变NPC的逻辑
+                npc = session_manager.get_npc(sess, new_name)
+                if npc is None:
+                    return jsonify({'error': f'NPC {new_name} not found'}), 404
+                sess['curr_npc'] = new_name
+                sess['epoch'] = next(SESSION_EPOCHS)
+                # 只返回最近一页历史，更早的部分用 GET /conversations 获取
+                page = npc.history_page(-HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+                page['config_str'] = npc.config_str
+                return history_response(page)
+            return jsonify({'error': 'NPC name is required'}), 400
+        return jsonify({'ok': 'ok'}), 200
 
 
 @app.route('/reset/<user_id>', methods=['POST', 'OPTIONS'])
@@ -126,15 +960,18 @@ def reset(user_id):
         A JSON response indicating whether the conversation was
             successfully reset.
     """
-    sess = session_manager.get_session(user_id)
-    npc_name = sess['curr_npc']
-    npc = sess['npcs'].get(npc_name)
-    if request.method == 'POST':
-        # Reset the conversation with the specified NPC
-        npc.reset(npc_name=npc_name)
-        return jsonify({'message': 'Conversations reset'}), 200
-    else:
-        return jsonify({'ok': 'ok'}), 200
+    with session_manager.session(user_id) as sess:
+        npc_name = sess['curr_npc']
+        npc = session_manager.get_npc(sess, npc_name)
+        if request.method == 'POST':
+            if npc is None:
+                return jsonify({'error': f'NPC {npc_name} not found'}), 404
+            # Reset the conversation with the specified NPC
+            npc.reset(npc_name=npc_name)
+            sess['epoch'] = next(SESSION_EPOCHS)
+            return jsonify({'message': 'Conversations reset'}), 200
+        else:
+            return jsonify({'ok': 'ok'}), 200
 
 
 @app.route('/getConfigStr/<user_id>', methods=['GET', 'OPTIONS'])
@@ -148,14 +985,16 @@ def get_config_str(user_id):
     Returns:
         A JSON response containing the config_str of the specified NPC.
     """
-    sess = session_manager.get_session(user_id)
-    npc_name = sess['curr_npc']
-    npc = sess['npcs'].get(npc_name)
-    if request.method == 'GET':
-        # Get the config_str of the specified NPC
-        return jsonify({'config_str': npc.config_str}), 200
-    else:
-        return jsonify({'ok': 'ok'}), 200
+    with session_manager.session(user_id, commit=False) as sess:
+        npc_name = sess['curr_npc']
+        npc = session_manager.get_npc(sess, npc_name)
+        if request.method == 'GET':
+            if npc is None:
+                return jsonify({'error': f'NPC {npc_name} not found'}), 404
+            # Get the config_str of the specified NPC
+            return jsonify({'config_str': npc.config_str}), 200
+        else:
+            return jsonify({'ok': 'ok'}), 200
 
 
 @app.route('/setConfigStr/<user_id>', methods=['POST', 'OPTIONS'])
@@ -169,20 +1008,23 @@ def set_config_str(user_id):
     Returns:
         A JSON response indicating whether the config_str was successfully set.
     """
-    sess = session_manager.get_session(user_id)
-    npc_name = sess['curr_npc']
-    npc = sess['npcs'].get(npc_name)
-    if request.method == 'POST':
-        # Set the config_str of the specified NPC
-        if request.json is None:
-            return jsonify({'error': 'invalid JSON in request body'}), 400
-        config_str = request.json.get('config_str')
-        if config_str:
-            npc.reset(npc_name=npc_name, config_str=config_str)
-            return jsonify({'message': 'config_str set'}), 200
-        return jsonify({'error': 'config_str is required'}), 400
-    else:
-        return jsonify({'ok': 'ok'}), 200
+    with session_manager.session(user_id) as sess:
+        npc_name = sess['curr_npc']
+        npc = session_manager.get_npc(sess, npc_name)
+        if request.method == 'POST':
+            if npc is None:
+                return jsonify({'error': f'NPC {npc_name} not found'}), 404
+            # Set the config_str of the specified NPC
+            if request.json is None:
+                return jsonify({'error': 'invalid JSON in request body'}), 400
+            config_str = request.json.get('config_str')
+            if config_str:
+                npc.reset(npc_name=npc_name, config_str=config_str)
+                sess['epoch'] = next(SESSION_EPOCHS)
+                return jsonify({'message': 'config_str set'}), 200
+            return jsonify({'error': 'config_str is required'}), 400
+        else:
+            return jsonify({'ok': 'ok'}), 200
 
 
 @app.route('/getTaskStatus/<user_id>', methods=['GET', 'OPTIONS'])
@@ -196,13 +1038,15 @@ def get_task_status(user_id):
     Returns:
         A JSON response containing the task_status of the specified NPC.
     """
-    sess = session_manager.get_session(user_id)
-    npc_name = sess['curr_npc']
-    npc = sess['npcs'].get(npc_name)
-    if request.method == 'GET':
-        # Get the task_status of the specified NPC
-        return jsonify({'task_status': npc.task_status}), 200
-    return jsonify({'ok': 'ok'}), 200
+    with session_manager.session(user_id, commit=False) as sess:
+        npc_name = sess['curr_npc']
+        npc = session_manager.get_npc(sess, npc_name)
+        if request.method == 'GET':
+            if npc is None:
+                return jsonify({'error': f'NPC {npc_name} not found'}), 404
+            # Get the task_status of the specified NPC
+            return jsonify({'task_status': npc.task_status}), 200
+        return jsonify({'ok': 'ok'}), 200
 
 
 @app.route('/setTaskStatus/<user_id>', methods=['POST', 'OPTIONS'])
@@ -217,20 +1061,122 @@ def set_task_status(user_id):
         A JSON response indicating whether the task_status
         was successfully set.
     """
-    sess = session_manager.get_session(user_id)
-    npc_name = sess['curr_npc']
-    npc = sess['npcs'].get(npc_name)
+    with session_manager.session(user_id) as sess:
+        npc_name = sess['curr_npc']
+        npc = session_manager.get_npc(sess, npc_name)
+        if request.method == 'POST':
+            if npc is None:
+                return jsonify({'error': f'NPC {npc_name} not found'}), 404
+            # Set the task_status of the specified NPC
+            if request.json is None:
+                return jsonify({'error': 'invalid JSON in request body'}), 400
+            task_status = request.json.get('task_status')
+            if task_status:
+                npc.task_status = task_status
+                sess['epoch'] = next(SESSION_EPOCHS)
+                print(npc_name, task_status)
+                return jsonify({'message': 'task_status set'}), 200
+            return jsonify({'error': 'task_status is required'}), 400
+        return jsonify({'ok': 'ok'}), 200
+
+
+@app.route('/sessionStats', methods=['GET'])
+def session_stats():
+    """ Returns the session store counters.
+    Returns:
+        A JSON response containing hits, misses, evictions, rehydrations
+        and the current number and size of live sessions.
+    """
+    store = session_manager.sessions
+    stats = dict(store.stats)
+    stats['live_sessions'] = len(store)
+    stats['live_bytes'] = store.live_bytes
+    stats['stored_sessions'] = len(store.backend)
+    return jsonify(stats), 200
+
+
+@app.route('/snapshot', methods=['GET', 'POST'])
+def snapshot():
+    """ Exports the sessions to NPC_SNAPSHOT_PATH.
+    POST starts an export in the background, GET reports the last one.
+    Returns:
+        202 when an export was started, 409 if one is running, 404 when
+        no snapshot path is configured, 200 with the export status.
+    """
+    if not SNAPSHOT_PATH:
+        return jsonify({'error': 'NPC_SNAPSHOT_PATH is not set'}), 404
     if request.method == 'POST':
-        # Set the task_status of the specified NPC
-        if request.json is None:
-            return jsonify({'error': 'invalid JSON in request body'}), 400
-        task_status = request.json.get('task_status')
-        if task_status:
-            npc.task_status = task_status
-            print(npc_name, task_status)
-            return jsonify({'message': 'task_status set'}), 200
-        return jsonify({'error': 'task_status is required'}), 400
-    return jsonify({'ok': 'ok'}), 200
+        if snapshot_status['running']:
+            return jsonify(snapshot_status), 409
+        threading.Thread(target=export_snapshot, name='npc-snapshot',
+                         daemon=True).start()
+        return jsonify({'path': SNAPSHOT_PATH}), 202
+    return jsonify(snapshot_status), 200
+
+
+@app.route('/promptTokenStats', methods=['GET'])
+def prompt_token_stats_route():
+    """ Returns the prompt tokens per turn.
+    Returns:
+        A JSON response with the tokens actually sent and the tokens the
+        prompts would have had with the whole history replayed.
+    """
+    return jsonify(npc_module().prompt_token_stats.as_dict()), 200
+
+
+@app.route('/promptTokenStats/<user_id>', methods=['GET'])
+def session_prompt_token_stats(user_id):
+    """ Returns the prompt tokens of a user's conversations.
+    Returns:
+        A JSON response with, for every NPC the user talked to since the
+        session was last loaded, the tokens of each component of the
+        last prompt and the totals.
+    """
+    with session_manager.session(user_id, commit=False) as sess:
+        usage = [npc.prompt_usage() for npc in sess['npcs'].values()]
+    return jsonify({'user_id': user_id, 'npcs': usage}), 200
+
+
+@app.route('/replyCacheStats', methods=['GET'])
+def reply_cache_stats():
+    """ Returns the reply cache counters.
+    Returns:
+        A JSON response with hits, misses, hit rate, seconds of LLM
+        latency saved and the number of entries.
+    """
+    cache = npc_module().reply_cache
+    if cache is None:
+        return jsonify({'enabled': False}), 200
+    stats = cache.as_dict()
+    stats['enabled'] = True
+    return jsonify(stats), 200
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """ Reports whether the prewarm finished.
+    Returns:
+        200 once configs, templates, clients and conversations are warm,
+        or when prewarming is disabled, 503 before; the JSON body has
+        the seconds after startup each part was ready at.
+    """
+    warm = all(seconds is not None for seconds in readiness.values())
+    body = {
+        'ready': warm or not PREWARM,
+        'prewarm': PREWARM,
+        'components': readiness,
+    }
+    if readiness_errors:
+        body['errors'] = readiness_errors
+    return jsonify(body), 200 if body['ready'] else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """ Returns the metrics in the Prometheus text format.
+    """
+    return Response(metrics.registry.render(),
+                    mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
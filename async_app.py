@@ -0,0 +1,265 @@
+"""
+This file contains an asyncio based server for the conversation
+endpoints. LLM requests are awaited instead of pinning a thread,
+a global semaphore bounds the number of requests in flight, every
+user has a FIFO so one player's messages stay ordered, and all
+requests to the completion endpoint share one pooled aiohttp session.
+Messages go through the same admission control, duplicate merging
+and conversation locks as in app.py.
+
+    python async_app.py --port 8088
+"""
+import argparse
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import openai
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+
+import metrics
+from admission import Rejected
+from app import admission, admitted, coalescer, conversation_scope
+from app import encode_json, history_etag, parse_history_args
+from app import prompt_too_large_payload, session_manager
+from idempotency import IdempotencyConflict
+from preflight import PromptTooLargeError
+
+LLM_CONCURRENCY = int(os.getenv('NPC_LLM_CONCURRENCY', '64'))
+HTTP_POOL_SIZE = int(os.getenv('NPC_HTTP_POOL_SIZE', '100'))
+HTTP_TIMEOUT = float(os.getenv('NPC_HTTP_TIMEOUT', '60'))
+
+
+class UserQueues:
+    """ One FIFO lock per user, dropped when nobody waits on it.
+    asyncio.Lock wakes its waiters in arrival order.
+    """
+    def __init__(self):
+        self._locks = {}
+        self._waiters = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        """ Waits for the user's earlier requests to finish.
+        """
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        self._waiters[user_id] = self._waiters.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[user_id] -= 1
+            if not self._waiters[user_id]:
+                del self._waiters[user_id]
+                del self._locks[user_id]
+
+
+async def run_blocking(func, *args, executor=None):
+    """ Calls a blocking function in a worker thread, in the context of
+    the current request (e.g. the endpoint of the metrics).
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, context.run, func, *args)
+
+
+@asynccontextmanager
+async def entered(manager, executor=None):
+    """ Holds a blocking context manager across awaits.
+    It is entered in a worker thread, so the event loop never waits for
+    a lock or an admission slot, and left on the event loop: leaving
+    only releases locks and commits the session.
+    Args:
+        manager: The context manager, e.g. session_manager.conversation().
+        executor: The thread pool to enter it in, None for the default.
+    """
+    entering = asyncio.ensure_future(
+        run_blocking(manager.__enter__, executor=executor))
+    try:
+        value = await asyncio.shield(entering)
+    except asyncio.CancelledError:
+        # 取消时工作线程可能随后才进入，进入后立即退出
+        entering.add_done_callback(
+            lambda future: not future.cancelled() and
+            future.exception() is None and
+            manager.__exit__(None, None, None))
+        raise
+    try:
+        yield value
+    except BaseException as error:
+        if not manager.__exit__(type(error), error, error.__traceback__):
+            raise
+    else:
+        manager.__exit__(None, None, None)
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """ Answers CORS preflight requests and allows any origin,
+    like flask_cors does for app.py.
+    """
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    response.headers['Access-Control-Expose-Headers'] = \
+        'ETag, Retry-After, Idempotent-Replayed'
+    return response
+
+
+def _error(message, status):
+    return web.json_response({'error': message}, status=status)
+
+
+async def handle_npc_conversations(request):
+    """ Handles the conversations with the current NPC.
+    Returns:
+        GET: a page of the history of the current NPC, with the same
+            paging, ETag and gzip handling as app.py.
+        POST: the reply of the current NPC to the message, merged with
+            duplicate submits like in app.py, 429 with Retry-After if
+            the admission controller sheds it.
+    """
+    user_id = request.match_info['user_id']
+    metrics.current_endpoint.set('handle_npc_conversations')
+    if request.method == 'GET':
+        try:
+            since, limit, epoch = parse_history_args(request.query)
+        except ValueError:
+            return _error('invalid since or limit', 400)
+        async with request.app['user_queues'].hold(user_id), \
+                entered(session_manager.conversation(
+                    user_id, commit=False)) as (_, npc_name, npc):
+            if npc is None:
+                return _error(f'NPC {npc_name} not found', 404)
+            etag = history_etag(npc, since, limit, epoch)
+            if any(tag.value == etag
+                   for tag in request.if_none_match or ()):
+                response = web.Response(status=304)
+                response.etag = etag
+                return response
+            page = npc.history_page(since, limit, epoch)
+        body, encoding = encode_json(
+            page, 'gzip' in request.headers.get('Accept-Encoding', ''))
+        response = web.Response(body=body, content_type='application/json')
+        response.etag = etag
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        return _error('invalid JSON in request body', 400)
+    message = body.get('message')
+    if not message:
+        return _error('Message is required', 400)
+
+    key = (request.headers.get('Idempotency-Key')
+           or body.get('idempotency_key') or None)
+    app = request.app
+
+    async def send():
+        # 准入的排队在单独的线程池中等待，不占用提交会话所需的线程；
+        # 同一用户的请求在事件循环上排队，进入对话锁时不会等待
+        async with entered(admitted(user_id), app['admission_pool']), \
+                app['user_queues'].hold(user_id), \
+                entered(session_manager.conversation(user_id)) as (
+                    _, npc_name, npc):
+            if npc is None:
+                return {'error': f'NPC {npc_name} not found'}, 404
+            async with app['llm_slots']:
+                token = openai.aiosession.set(app['http'])
+                try:
+                    return {'message': await npc.acall(message)}, 201
+                finally:
+                    openai.aiosession.reset(token)
+
+    try:
+        scope = await run_blocking(conversation_scope, user_id)
+        (payload, status), replayed = await coalescer.arun(
+            scope, message, send, key=key)
+    except IdempotencyConflict as error:
+        return _error(str(error), 422)
+    except Rejected as error:
+        response = web.json_response({'error': error.reason,
+                                      'retry_after': error.retry_after},
+                                     status=429)
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
+    except PromptTooLargeError as error:
+        return web.json_response(prompt_too_large_payload(error), status=413)
+    response = web.json_response(payload, status=status)
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+async def handle_metrics(request):
+    """ Returns the metrics in the Prometheus text format.
+    """
+    return web.Response(text=metrics.registry.render(),
+                        content_type='text/plain')
+
+
+async def _open_http(app):
+    app['http'] = ClientSession(
+        connector=TCPConnector(limit=HTTP_POOL_SIZE),
+        timeout=ClientTimeout(total=HTTP_TIMEOUT))
+
+
+async def _close_http(app):
+    await app['http'].close()
+    app['admission_pool'].shutdown(wait=False)
+
+
+def create_app(llm_concurrency=LLM_CONCURRENCY):
+    """ Builds the aiohttp application.
+    Args:
+        llm_concurrency (int): Maximum number of LLM requests in flight.
+    Returns:
+        aiohttp.web.Application
+    """
+    app = web.Application(middlewares=[cors_middleware])
+    app['llm_slots'] = asyncio.Semaphore(llm_concurrency)
+    app['user_queues'] = UserQueues()
+    # 排队等待准入的请求最多 max_queue 个，每个占用一个线程
+    app['admission_pool'] = ThreadPoolExecutor(
+        max_workers=admission.max_queue + 1,
+        thread_name_prefix='npc-admission')
+    app.on_startup.append(_open_http)
+    app.on_cleanup.append(_close_http)
+    app.router.add_route('GET', '/conversations/{user_id}',
+                         handle_npc_conversations)
+    app.router.add_route('POST', '/conversations/{user_id}',
+                         handle_npc_conversations)
+    app.router.add_route('OPTIONS', '/conversations/{user_id}',
+                         handle_npc_conversations)
+    app.router.add_route('GET', '/metrics', handle_metrics)
+    return app
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description='async NPC server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--llm-concurrency', type=int,
+                        default=LLM_CONCURRENCY)
+    args = parser.parse_args()
+    web.run_app(create_app(args.llm_concurrency),
+                host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
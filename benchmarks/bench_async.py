@@ -0,0 +1,145 @@
+"""
+Benchmark of the asyncio server (async_app.py) against the threaded Flask
+server (app.py). Both talk to a local mock completion endpoint that
+injects latency, so the numbers show how many concurrent conversations
+each serving mode sustains while waiting on the network. Requests that
+are not answered with 201 are counted as errors, and the script exits
+with 1 if there were any.
+
+    python benchmarks/bench_async.py --latency 0.5 --clients 200
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from mock_llm import MockCompletionServer
+
+SERVERS = {
+    'threaded': [sys.executable, '-c',
+                 'import sys; from app import app; '
+                 'app.run(port=int(sys.argv[1]), threaded=True)'],
+    'async': [sys.executable, 'async_app.py', '--host', '127.0.0.1',
+              '--port'],
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def _client(port, turns):
+    user_id = str(uuid.uuid4())
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    latencies = []
+    errors = []
+    for i in range(turns):
+        body = json.dumps({'message': f'你好，你是谁？{i}'})
+        start = time.perf_counter()
+        conn.request('POST', f'/conversations/{user_id}', body,
+                     {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        if response.status == 201:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(response.status)
+    conn.close()
+    return latencies, errors
+
+
+def run(mode, endpoint, clients, turns):
+    """ Starts the server in the given mode and drives it.
+    Returns:
+        dict with throughput and latency percentiles of the answered
+        requests and the statuses of the others
+    """
+    port = _free_port()
+    # 两种服务都放行全部客户端，比较的是服务能力而不是限流
+    env = dict(os.environ, OPENAI_ENDPOINT=endpoint, OPENAI_API_KEY='mock',
+               NPC_LLM_BACKEND='azure',
+               OPENAI_API_VERSION=os.getenv('OPENAI_API_VERSION',
+                                            '2023-05-15'),
+               NPC_ADMISSION_CONCURRENCY=str(clients),
+               NPC_ADMISSION_QUEUE=str(clients))
+    with subprocess.Popen(SERVERS[mode] + [str(port)], cwd=ROOT, env=env,
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL) as server:
+        try:
+            _wait_for(port)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(clients) as pool:
+                results = list(pool.map(lambda _: _client(port, turns),
+                                        range(clients)))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+    latencies = sorted(lat for result, _ in results for lat in result)
+    errors = {}
+    for _, statuses in results:
+        for status in statuses:
+            errors[status] = errors.get(status, 0) + 1
+    return {
+        'mode': mode,
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1)
+        if latencies else None,
+        'p99_ms': round(latencies[max(int(len(latencies) * 0.99) - 1, 0)]
+                        * 1000, 1) if latencies else None,
+        'errors': errors,
+    }
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', default=list(SERVERS))
+    args = parser.parse_args()
+    mock = MockCompletionServer(latency=args.latency).start()
+    results = []
+    for mode in args.modes:
+        result = run(mode, mock.endpoint, args.clients, args.turns)
+        results.append(result)
+        if result['errors']:
+            print(f'{mode:<9} errors by status: {result["errors"]}')
+        if result['p50_ms'] is not None:
+            print(f'{mode:<9} {result["rps"]:8.1f} req/s  '
+                  f'p50 {result["p50_ms"]:8.1f} ms  '
+                  f'p99 {result["p99_ms"]:8.1f} ms')
+    print(json.dumps({'latency': args.latency, 'clients': args.clients,
+                      'results': results}))
+    mock.shutdown()
+    if any(result['errors'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of the memory held by conversation histories: the message log
+against the previous layout, which kept every turn twice, as a
+"Player: ..." string in conv_history and as a ChatMessage in the chat
+memory.
+
+    python benchmarks/bench_message_log.py --sessions 10000 --turns 50
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pylint: disable=wrong-import-position
+from langchain.schema import ChatMessage
+
+from message_log import IN_HISTORY, IN_MEMORY, MessageLog
+
+SUFFIXES = [
+    '\nThe current task status is: the player has just arrived in town '
+    'and has not met anyone yet.',
+    '\nThe current task status is: the player is looking for the lost '
+    'cat and asks everyone about it.',
+    '\nThe current task status is: the player found the key and wants '
+    'to know which door it opens.',
+]
+WORDS = ['你好', '镇上', '钥匙', '猫', 'the', 'door', 'eyebrow', 'raised',
+         'who', 'wants', 'to', 'know', '(sighs)', 'maybe', 'tomorrow']
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _turns(seed, turns):
+    rng = random.Random(seed)
+    suffix = rng.choice(SUFFIXES)
+    return [(_text(rng, 8), suffix, _text(rng, 40)) for _ in range(turns)]
+
+
+def build_duplicated(turns, npc_name='Ted'):
+    """ Builds a conversation the way NpcLangChain stored it before the
+    message log.
+    """
+    history, messages = [], []
+    for player, suffix, reply in turns:
+        history.append(f'Player: {player}')
+        messages.append(ChatMessage(role='Player', content=player + suffix))
+        history.append(f'{npc_name}: {reply}')
+        messages.append(ChatMessage(role=npc_name, content=reply))
+    return history, messages
+
+
+def build_log(turns, npc_name='Ted'):
+    """ Builds a conversation the way NpcLangChain stores it now.
+    """
+    log = MessageLog()
+    for player, suffix, reply in turns:
+        index = log.append('Player', player, suffix, IN_HISTORY)
+        log.add_flags(index, IN_MEMORY)
+        log.append(npc_name, reply)
+    return log
+
+
+def measure(build, sessions, turns):
+    """ Builds the sessions and measures the memory they hold.
+    Returns:
+        (bytes per session, seconds)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    # 脚本用完即释放，只统计对话本身持有的内存
+    live = [build(_turns(seed, turns)) for seed in range(sessions)]
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del live
+    return size / sessions, elapsed
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--turns', type=int, default=50)
+    args = parser.parse_args()
+    results = {}
+    for name, build in (('duplicated', build_duplicated),
+                        ('message_log', build_log)):
+        per_session, elapsed = measure(build, args.sessions, args.turns)
+        results[name] = per_session
+        print(f'{name:<12} {per_session / 1024:10.1f} KiB per session '
+              f'{per_session * args.sessions / 2 ** 20:10.1f} MiB total '
+              f'{elapsed:8.2f} s to build')
+    print(f'saved {1 - results["message_log"] / results["duplicated"]:.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark of prompt assembly on the local path: building the prompt
+template of a conversation and formatting the prompt of each turn,
+for the previous layout (the NPC config between PART1 and PART3, the
+system prompt parsed and formatted as a template) against the shared
+static prefix sent as a constant message. Also reports how many
+leading characters all prompts share and the share of prompt tokens a
+prefix cache like the provider's (mock_llm.PrefixCache) would serve.
+
+    python benchmarks/bench_prompt_assembly.py --npcs 20 --turns 20
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pylint: disable=wrong-import-position
+from langchain.prompts import (
+    ChatMessagePromptTemplate,
+    ChatPromptTemplate,
+    MessagesPlaceholder,
+)
+from langchain.schema import ChatMessage
+
+from mock_llm import PrefixCache
+from npc_prompt import PART0, PART1, PART3, PART4, build_system_prompt
+
+WORDS = ['grumpy', 'guard', 'baker', 'likes', 'cats', 'hates', 'rain',
+         'keeps', 'a', 'box', 'in', 'the', 'cellar', 'speaks', 'slowly']
+
+
+def previous_template(npc_name, config_str):
+    """ Builds the template the way reset() did before the shared prefix.
+    """
+    system_prompt = PART0 + PART1 + f"%%%{config_str}\n%%%" + PART3 + PART4
+    return ChatPromptTemplate.from_messages([
+        ChatMessagePromptTemplate.from_template(system_prompt,
+                                                role="Overall"),
+        MessagesPlaceholder(variable_name="history"),
+        ChatMessagePromptTemplate.from_template(role="Player",
+                                                template="{input}"),
+        ChatMessagePromptTemplate.from_template(role=npc_name, template=""),
+    ])
+
+
+def shared_prefix_template(npc_name, config_str):
+    """ Builds the template the way get_prompt_template does now.
+    """
+    return ChatPromptTemplate.from_messages([
+        ChatMessage(role="Overall", content=build_system_prompt(config_str)),
+        MessagesPlaceholder(variable_name="history"),
+        ChatMessagePromptTemplate.from_template(role="Player",
+                                                template="{input}"),
+        ChatMessagePromptTemplate.from_template(role=npc_name, template=""),
+    ])
+
+
+def _common_prefix(texts):
+    first = min(texts)
+    last = max(texts)
+    length = 0
+    while length < len(first) and first[length] == last[length]:
+        length += 1
+    return length
+
+
+def run(build, npcs, turns):
+    """ Builds one template per NPC and formats every turn.
+    Returns:
+        dict with the build and format cost, the shared prefix length
+        and the simulated prefix cache share
+    """
+    rng = random.Random(1)
+    configs = [(f'npc{index}', ' '.join(rng.choices(WORDS, k=200)))
+               for index in range(npcs)]
+    start = time.perf_counter()
+    templates = [(name, build(name, config)) for name, config in configs]
+    built = time.perf_counter() - start
+    prompts = []
+    start = time.perf_counter()
+    for name, template in templates:
+        history = []
+        for turn in range(turns):
+            message = f'你好，这是第{turn}句'
+            prompts.append(template.format_prompt(
+                history=history, input=message).to_string())
+            history += [ChatMessage(role='Player', content=message),
+                        ChatMessage(role=name, content='(nods) Sure.')]
+    formatted = time.perf_counter() - start
+    cache = PrefixCache()
+    total = cached = 0
+    for prompt in prompts:
+        prompt_tokens, hit = cache.lookup(prompt)
+        total += prompt_tokens
+        cached += hit
+    return {
+        'build_us_per_npc': round(built / npcs * 1e6, 1),
+        'format_us_per_turn': round(formatted / len(prompts) * 1e6, 1),
+        'shared_prefix_chars': _common_prefix(prompts),
+        'simulated_cached_share': round(cached / total, 3),
+    }
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--npcs', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=20)
+    args = parser.parse_args()
+    results = {}
+    for name, build in (('previous', previous_template),
+                        ('shared_prefix', shared_prefix_template)):
+        results[name] = row = run(build, args.npcs, args.turns)
+        print(f'{name:<14} build {row["build_us_per_npc"]:9.1f} us  '
+              f'format {row["format_us_per_turn"]:8.1f} us/turn  '
+              f'shared prefix {row["shared_prefix_chars"]:6d} chars  '
+              f'cached {row["simulated_cached_share"]:6.1%}')
+    print(json.dumps({'args': vars(args), 'results': results}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark of the resilient LLM client (llm_client.py) against a local
+completion endpoint that injects faults: jittered latency, stalled
+requests, 5xx errors and empty replies. Compares the bare client with
+the ResilientLLM around it, with and without hedging, and reports the
+share of good replies, fallbacks and latency percentiles.
+
+    python benchmarks/bench_resilience.py --calls 200 --error-rate 0.1 \\
+        --stall-rate 0.05 --empty-rate 0.05
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pylint: disable=wrong-import-position
+import openai
+from langchain.llms import AzureOpenAI
+
+import llm_client
+from llm_client import CircuitBreaker, ResilientLLM, RetryPolicy
+from mock_llm import MockCompletionServer
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(q / 100 * len(ordered)), len(ordered) - 1)]
+
+
+def _bare_llm(attempt_timeout):
+    return AzureOpenAI(client=openai.ChatCompletion,
+                       deployment_name='mock', model_name='gpt-35-turbo',
+                       max_retries=0, request_timeout=attempt_timeout)
+
+
+def _call(llm, prompt):
+    start = time.perf_counter()
+    try:
+        reply = llm(prompt)
+        outcome = 'ok' if reply.strip() else 'empty'
+    except llm_client.LLMUnavailableError:
+        outcome = 'fallback'
+    except Exception:  # pylint: disable=broad-except
+        outcome = 'error'
+    return outcome, time.perf_counter() - start
+
+
+def run(llm, calls, concurrency):
+    """ Sends the calls and tallies the outcomes.
+    Returns:
+        dict with the share of each outcome and latency percentiles
+    """
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda i: _call(llm, f'你好，你是谁？{i}'),
+                                range(calls)))
+    latencies = [elapsed for _, elapsed in results]
+    summary = {outcome: sum(1 for result, _ in results if result == outcome)
+               / calls for outcome in ('ok', 'empty', 'error', 'fallback')}
+    for q in (50, 95, 99):
+        summary[f'p{q}_ms'] = round(_percentile(latencies, q) * 1000, 1)
+    return summary
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.3)
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--error-rate', type=float, default=0.1)
+    parser.add_argument('--empty-rate', type=float, default=0.05)
+    parser.add_argument('--stall-rate', type=float, default=0.05)
+    parser.add_argument('--attempt-timeout', type=float, default=3.0)
+    parser.add_argument('--hedge-after', type=float, default=0.8)
+    args = parser.parse_args()
+    mock = MockCompletionServer(latency=args.latency, jitter=args.jitter,
+                                error_rate=args.error_rate,
+                                empty_rate=args.empty_rate,
+                                stall_rate=args.stall_rate,
+                                stall_latency=args.attempt_timeout * 2,
+                                seed=1).start()
+    openai.api_type = 'azure'
+    openai.api_base = mock.endpoint
+    openai.api_version = '2023-03-15-preview'
+    openai.api_key = 'mock'
+    bare = _bare_llm(args.attempt_timeout)
+    clients = {
+        'bare': bare,
+        'retry': ResilientLLM(
+            llm=bare, breaker=CircuitBreaker(failure_threshold=50),
+            policy=RetryPolicy(attempt_timeout=args.attempt_timeout,
+                               seed=1)),
+        'retry+hedge': ResilientLLM(
+            llm=bare, breaker=CircuitBreaker(failure_threshold=50),
+            policy=RetryPolicy(attempt_timeout=args.attempt_timeout,
+                               hedge_after=args.hedge_after, seed=1)),
+    }
+    results = {}
+    for name, llm in clients.items():
+        results[name] = run(llm, args.calls, args.concurrency)
+        row = results[name]
+        print(f'{name:<12} ok {row["ok"]:6.1%}  fallback '
+              f'{row["fallback"]:6.1%}  error {row["error"]:6.1%}  '
+              f'p50 {row["p50_ms"]:8.1f} ms  p99 {row["p99_ms"]:8.1f} ms')
+    print(json.dumps({'args': vars(args), 'results': results,
+                      'client_stats': llm_client.llm_stats}))
+    mock.shutdown()
+
+
+if __name__ == '__main__':
+    main()
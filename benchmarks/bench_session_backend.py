@@ -0,0 +1,113 @@
+"""
+Benchmark of the session backends: requests per second against the
+number of worker processes sharing one backend.
+
+Every simulated request takes the user's lock, loads the session through a
+SessionStore, appends a turn, sleeps for the simulated LLM latency and
+commits the session, the same cycle app.py runs for POST /conversations.
+
+    python benchmarks/bench_session_backend.py --workers 1 2 4 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pylint: disable=wrong-import-position
+from session_backend import create_backend
+from session_store import SessionStore
+
+
+def _dump(sess):
+    return {'curr_npc': sess['curr_npc'],
+            'npcs': {name: dict(npc) for name, npc in sess['npcs'].items()}}
+
+
+def _load(state):
+    return {'curr_npc': state['curr_npc'], 'npcs': state['npcs']}
+
+
+def _sizeof(sess):
+    return sum(len(npc['history']) for npc in sess['npcs'].values())
+
+
+def _new_session():
+    return {'curr_npc': 'Ted', 'npcs': {'Ted': {
+        'npc_name': 'Ted', 'config_str': None, 'task_status': 'start',
+        'history': [], 'messages': []}}}
+
+
+def _worker(url, users, duration, latency, counter):
+    store = SessionStore(_dump, _load, _sizeof, backend=create_backend(url))
+    rng = random.Random(os.getpid())
+    done = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        user_id = rng.choice(users)
+        with store.backend.lock(user_id):
+            sess = store.get(user_id)
+            if sess is None:
+                sess = _new_session()
+                store.put(user_id, sess)
+            npc = sess['npcs']['Ted']
+            npc['history'].append('Player: 你好，你是谁？')
+            npc['messages'].append(['Player', '你好，你是谁？'])
+            time.sleep(latency)
+            npc['history'].append('Ted: (eyebrow raised) Who wants to know?')
+            npc['messages'].append(['Ted', '(eyebrow raised) Who wants?'])
+            store.commit(user_id, sess)
+        done += 1
+    with counter.get_lock():
+        counter.value += done
+
+
+def run(url, workers, users, duration, latency):
+    """ Runs the benchmark with the given number of worker processes.
+    Returns:
+        requests per second
+    """
+    counter = multiprocessing.Value('i', 0)
+    user_ids = [f'user-{i}' for i in range(users)]
+    procs = [multiprocessing.Process(
+        target=_worker, args=(url, user_ids, duration, latency, counter))
+        for _ in range(workers)]
+    start = time.monotonic()
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    return counter.value / (time.monotonic() - start)
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--backend', default=None,
+                        help='sqlite:///path, defaults to a temporary file')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='simulated LLM seconds per request')
+    args = parser.parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.backend or f'sqlite:///{os.path.join(tmp, "sessions.db")}'
+        create_backend(url)
+        for workers in args.workers:
+            rps = run(url, workers, args.users, args.duration, args.latency)
+            results.append({'workers': workers, 'rps': round(rps, 1)})
+            print(f'workers={workers:<3d} {rps:10.1f} req/s')
+    print(json.dumps({'backend': args.backend or 'sqlite (temporary)',
+                      'latency': args.latency, 'results': results}))
+
+
+if __name__ == '__main__':
+    main()
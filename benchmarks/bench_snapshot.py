@@ -0,0 +1,102 @@
+"""
+Benchmark of the session snapshot (session_snapshot.py): the time to
+export N sessions from a SessionStore, to import the snapshot into a
+fresh worker's backend, and to bring single sessions back on access.
+Sessions are built in their compact form from message logs, the way
+NpcLangChain.dump_state stores them, so LangChain is not needed.
+
+    python benchmarks/bench_snapshot.py --sessions 100000 --turns 20
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pylint: disable=wrong-import-position
+from message_log import IN_HISTORY, IN_MEMORY, MessageLog
+from session_backend import MemoryBackend
+from session_snapshot import read_snapshot, write_snapshot
+from session_store import SessionStore
+
+WORDS = ['你好', '镇上', '钥匙', '猫', 'the', 'door', 'eyebrow', 'raised',
+         'who', 'wants', 'to', 'know', '(sighs)', 'maybe', 'tomorrow']
+SUFFIX = '\nThe current task status is: the player has just arrived.'
+
+
+def build_state(rng, turns):
+    """ Returns the compact state of a session with one NPC.
+    """
+    log = MessageLog()
+    for _ in range(turns):
+        index = log.append('Player', ' '.join(rng.choices(WORDS, k=8)),
+                           SUFFIX, IN_HISTORY)
+        log.add_flags(index, IN_MEMORY)
+        log.append('Ted', ' '.join(rng.choices(WORDS, k=40)))
+    return {'curr_npc': 'Ted', 'npcs': {'Ted': {
+        'npc_name': 'Ted', 'config_str': None, 'task_status': 'start',
+        'log': log.dump(), 'epoch': f'{rng.getrandbits(32):08x}',
+        'summary': ''}}}
+
+
+def _store(backend):
+    # 会话保持紧凑格式，只测快照本身的开销
+    return SessionStore(dump=lambda sess: sess, load=lambda state: state,
+                        sizeof=lambda sess: 1, max_sessions=1000,
+                        backend=backend)
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+    rng = random.Random(1)
+    store = _store(MemoryBackend())
+    for index in range(args.sessions):
+        user_id = f'user-{index}'
+        with store.backend.lock(user_id):
+            store.put(user_id, build_state(rng, args.turns))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory,
+                            'sessions.jsonl' + ('.gz' if args.gzip else ''))
+
+        def states():
+            for user_id in store.keys() + store.backend.keys():
+                with store.backend.lock(user_id):
+                    yield user_id, store.peek(user_id)
+
+        start = time.perf_counter()
+        count = write_snapshot(path, states())
+        results['export_s'] = time.perf_counter() - start
+        results['snapshot_mib'] = os.path.getsize(path) / 2 ** 20
+        fresh = _store(MemoryBackend())
+        start = time.perf_counter()
+        imported = fresh.backend.restore(read_snapshot(path))
+        results['import_s'] = time.perf_counter() - start
+        assert imported == count == args.sessions
+        sample = rng.sample(range(args.sessions), min(1000, args.sessions))
+        start = time.perf_counter()
+        for index in sample:
+            user_id = f'user-{index}'
+            with fresh.backend.lock(user_id):
+                fresh.get(user_id)
+        results['first_access_ms'] = \
+            (time.perf_counter() - start) / len(sample) * 1000
+    print(f'{args.sessions} sessions: export {results["export_s"]:.2f} s, '
+          f'{results["snapshot_mib"]:.1f} MiB, import '
+          f'{results["import_s"]:.2f} s, first access '
+          f'{results["first_access_ms"]:.3f} ms')
+    print(json.dumps({'args': vars(args), 'results': results}))
+
+
+if __name__ == '__main__':
+    main()
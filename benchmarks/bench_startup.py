@@ -0,0 +1,118 @@
+"""
+Benchmark of the cold start of app.py: the time to import it, the
+modules that dominate the import (from python -X importtime), and the
+latency of the first conversation request, with the prewarm thread
+(waiting for GET /ready first) and without it. Each run starts a fresh
+interpreter that talks to the in-process mock LLM.
+
+    python benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+# 在子进程中运行，每次都是冷启动
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+client = app.app.test_client()
+ready_wait = None
+if app.PREWARM:
+    wait_start = time.perf_counter()
+    while client.get('/ready').status_code != 200:
+        time.sleep(0.01)
+    ready_wait = time.perf_counter() - wait_start
+start = time.perf_counter()
+user_id = client.get('/userId').get_json()['userId']
+cheap = time.perf_counter() - start
+start = time.perf_counter()
+response = client.post(f'/conversations/{user_id}', json={'message': '你好'})
+first = time.perf_counter() - start
+print(json.dumps({'import_s': imported, 'ready_wait_s': ready_wait,
+                  'cheap_request_s': cheap, 'first_request_s': first,
+                  'status': response.status_code}))
+'''
+
+
+def _env(prewarm):
+    env = dict(os.environ)
+    env.setdefault('NPC_LLM_BACKEND', 'mock')
+    env.setdefault('NPC_MOCK_LATENCY', '0')
+    env['NPC_PREWARM'] = '1' if prewarm else '0'
+    return env
+
+
+def probe(prewarm):
+    """ Runs one cold start.
+    Returns:
+        dict with the import, readiness and first request seconds
+    """
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT,
+                            env=_env(prewarm), check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_profile(top):
+    """ Imports app.py under -X importtime without prewarming.
+    Returns:
+        (total seconds, [(cumulative seconds, module)] of the slowest
+        top level imports)
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import app'], cwd=ROOT, env=_env(False),
+                            check=True, capture_output=True,
+                            text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # 只看直接被导入的模块，缩进的是它们的依赖
+        if not name.startswith(' ') or name.startswith('  '):
+            continue
+        rows.append((int(cumulative) / 1e6, name.strip()))
+    rows.sort(reverse=True)
+    return sum(seconds for seconds, _ in rows), rows[:top]
+
+
+def _summary(runs, key):
+    values = [run[key] for run in runs if run[key] is not None]
+    if not values:
+        return None
+    return {'median_ms': round(statistics.median(values) * 1000, 1),
+            'max_ms': round(max(values) * 1000, 1)}
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+    total, slowest = import_profile(args.top)
+    print(f'import app: {total * 1000:.1f} ms by -X importtime')
+    for seconds, name in slowest:
+        print(f'  {seconds * 1000:8.1f} ms  {name}')
+    results = {'importtime_s': total, 'slowest_imports': slowest}
+    for mode, prewarm in (('lazy', False), ('prewarm', True)):
+        runs = [probe(prewarm) for _ in range(args.runs)]
+        results[mode] = {key: _summary(runs, key)
+                         for key in ('import_s', 'ready_wait_s',
+                                     'cheap_request_s', 'first_request_s')}
+        row = results[mode]
+        print(f'{mode:<8} import {row["import_s"]["median_ms"]:8.1f} ms  '
+              f'first request {row["first_request_s"]["median_ms"]:8.1f} ms')
+    print(json.dumps({'args': vars(args), 'results': results}))
+
+
+if __name__ == '__main__':
+    main()
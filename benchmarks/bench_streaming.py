@@ -0,0 +1,66 @@
+"""
+Benchmark of time-to-first-token for POST /conversations/<user_id>/stream
+against the blocking POST /conversations/<user_id>, using the local fake
+streaming LLM instead of Azure.
+
+    python benchmarks/bench_streaming.py --requests 20
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['NPC_LLM_BACKEND'] = 'mock'
+
+# pylint: disable=wrong-import-position
+from app import app
+
+
+def _blocking(client, user_id, message):
+    start = time.perf_counter()
+    client.post(f'/conversations/{user_id}', json={'message': message})
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+
+def _streaming(client, user_id, message):
+    start = time.perf_counter()
+    resp = client.post(f'/conversations/{user_id}/stream',
+                       json={'message': message}, buffered=False)
+    first = None
+    for _ in resp.response:
+        if first is None:
+            first = time.perf_counter() - start
+    resp.close()
+    return first, time.perf_counter() - start
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+    client = app.test_client()
+    results = {}
+    for name, send in (('blocking', _blocking), ('streaming', _streaming)):
+        first, total = [], []
+        for i in range(args.requests):
+            ttft, elapsed = send(client, str(uuid.uuid4()), f'你好，你是谁？{i}')
+            first.append(ttft)
+            total.append(elapsed)
+        results[name] = {
+            'ttft_ms_p50': round(statistics.median(first) * 1000, 1),
+            'total_ms_p50': round(statistics.median(total) * 1000, 1),
+        }
+        print(f'{name:<10} first token {results[name]["ttft_ms_p50"]:8.1f} ms'
+              f'   full reply {results[name]["total_ms_p50"]:8.1f} ms')
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
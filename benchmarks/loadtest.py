@@ -0,0 +1,274 @@
+"""
+Load test replaying scripted multi-turn player sessions against the app.py
+routes, with the local mock LLM instead of Azure.
+
+Every virtual player asks for a user id, switches to the NPC of its script,
+sets the task status and plays the turns one after another. By default the
+players run in-process through the Flask test client with
+NPC_LLM_BACKEND=mock; the NPC_MOCK_* variables set the latency, jitter,
+token rate and error rate of the mock (see mock_llm.MockBehaviour). With
+--url the players drive a running server instead, for example one pointed
+at `python mock_llm.py` through OPENAI_ENDPOINT.
+
+    python benchmarks/loadtest.py --players 50 --concurrency 8
+    python benchmarks/loadtest.py --url http://127.0.0.1:8088 \\
+        --script sessions.jsonl --output results.json
+
+A script is a JSON list, or JSON lines, of sessions like
+{"npc": "Ted", "task_status": "start", "turns": ["...", "..."]}, where
+task_status is a key of npc_prompt.TASK_STATUS.
+"""
+import argparse
+import http.client
+import json
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+DEFAULT_SCRIPT = [
+    {'npc': 'Ted', 'task_status': 'start',
+     'turns': ['你好，你是谁？', '镇上最近发生了什么事？',
+               '我可以帮你做点什么吗？', '谢谢，再见']},
+    {'npc': 'Barry', 'task_status': 'accepted',
+     'turns': ['Hello there.', 'Have you seen a black cat?',
+               'Where was it last seen?', 'Thanks for the help.']},
+    {'npc': 'Mike', 'task_status': 'reward',
+     'turns': ['我找到钥匙了', '这把钥匙能打开哪扇门？',
+               '门后面有什么？', '好的，我这就去']},
+    {'npc': 'Ted', 'task_status': 'finished',
+     'turns': ['箱子给你带来了', '这下可以把箱子给我了吗？',
+               '里面装的是什么？', '下次见']},
+]
+
+
+class InProcessClient:
+    """ Sends requests through the Flask test client of app.py.
+    """
+    def __init__(self):
+        os.environ.setdefault('NPC_LLM_BACKEND', 'mock')
+        # pylint: disable=import-outside-toplevel
+        import app
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        """ Returns the status code and the decoded JSON body.
+        """
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.app.test_client()
+        resp = client.open(path, method=method, json=body)
+        return resp.status_code, resp.get_json(silent=True)
+
+    def session_bytes(self):
+        """ Returns the estimated live size of the session store.
+        """
+        store = self.app.session_manager.sessions
+        return store.live_bytes, len(store)
+
+
+class HttpClient:
+    """ Sends requests to a running server, one keep-alive connection per
+    thread.
+    """
+    def __init__(self, url, timeout=120.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        """ Returns the status code and the decoded JSON body.
+        """
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        try:
+            return resp.status, json.loads(payload)
+        except ValueError:
+            return resp.status, None
+
+    def session_bytes(self):
+        """ Returns the live size of the session store of the server.
+        """
+        _, stats = self.request('GET', '/sessionStats')
+        stats = stats or {}
+        return stats.get('live_bytes', 0), stats.get('live_sessions', 0)
+
+
+class Recorder:
+    """ Collects latencies and status codes per route.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def call(self, client, route, method, path, body=None):
+        """ Sends one request and records its latency under the route.
+        """
+        start = time.perf_counter()
+        try:
+            status, payload = client.request(method, path, body)
+        except (OSError, http.client.HTTPException):
+            status, payload = 0, None
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+            if not 200 <= status < 300:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return status, payload
+
+
+def play(client, recorder, session):
+    """ Plays one scripted session as a new player.
+    """
+    status, payload = recorder.call(client, 'userId', 'GET', '/userId')
+    if status != 200 or not payload:
+        return
+    user_id = payload['userId']
+    recorder.call(client, 'changeNPC', 'POST', f'/changeNPC/{user_id}',
+                  {'npc_name': session['npc']})
+    if session.get('task_status'):
+        recorder.call(client, 'setTaskStatus', 'POST',
+                      f'/setTaskStatus/{user_id}',
+                      {'task_status': session['task_status']})
+    for message in session['turns']:
+        recorder.call(client, 'conversations', 'POST',
+                      f'/conversations/{user_id}', {'message': message})
+
+
+def load_script(path):
+    """ Reads the sessions of a JSON or JSON lines script.
+    """
+    if path is None:
+        return DEFAULT_SCRIPT
+    with open(path, 'r', encoding='UTF-8') as script_file:
+        text = script_file.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(latencies, errors, elapsed):
+    """ Returns the count, error count, throughput and latency percentiles
+    in milliseconds of one route.
+    """
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 1),
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(_percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def _rss_bytes():
+    # ru_maxrss 在 Linux 上的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(client, script, players, concurrency):
+    """ Replays `players` sessions, cycling through the script, with at
+    most `concurrency` players at a time.
+    Returns:
+        A dict with the overall and per-route results.
+    """
+    recorder = Recorder()
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(play, client, recorder,
+                                   script[i % len(script)])
+                       for i in range(players)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    live_bytes, live_sessions = client.session_bytes()
+    everything = [value for values in recorder.latencies.values()
+                  for value in values]
+    results = {
+        'players': players,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 2),
+        'total': summarize(everything, sum(recorder.errors.values()),
+                           elapsed),
+        'routes': {route: summarize(values, recorder.errors.get(route, 0),
+                                    elapsed)
+                   for route, values in sorted(recorder.latencies.items())},
+        'memory': {
+            'live_sessions': live_sessions,
+            'session_bytes': (live_bytes // live_sessions
+                              if live_sessions else 0),
+        },
+    }
+    if isinstance(client, InProcessClient):
+        results['memory']['rss_bytes_per_player'] = (
+            (_rss_bytes() - rss_before) // players if players else 0)
+    return results
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', help='server to test, in-process if unset')
+    parser.add_argument('--script', help='JSON or JSON lines sessions')
+    parser.add_argument('--players', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+    client = HttpClient(args.url) if args.url else InProcessClient()
+    results = run(client, load_script(args.script), args.players,
+                  args.concurrency)
+    results['target'] = args.url or 'in-process'
+    results['mock'] = {name: value for name, value in os.environ.items()
+                       if name.startswith('NPC_MOCK_')}
+    print(f'{"route":<16}{"requests":>9}{"errors":>8}{"p50 ms":>10}'
+          f'{"p95 ms":>10}{"p99 ms":>10}')
+    for route, row in [*results['routes'].items(),
+                       ('total', results['total'])]:
+        print(f'{route:<16}{row["requests"]:>9}{row["errors"]:>8}'
+              f'{row["p50_ms"]:>10.1f}{row["p95_ms"]:>10.1f}'
+              f'{row["p99_ms"]:>10.1f}')
+    print(f'throughput {results["total"]["throughput_rps"]} req/s, '
+          f'{results["memory"]["session_bytes"]} bytes per session')
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as output_file:
+            json.dump(results, output_file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
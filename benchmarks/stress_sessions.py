@@ -0,0 +1,317 @@
+"""
+Stress test of the per-user locking in app.py, against the in-process
+mock LLM.
+
+The first part checks that concurrent requests never lose or duplicate
+a turn. Several threads per user send distinct messages while another
+thread keeps calling /reset, /setConfigStr, /setTaskStatus and
+/batchConversations, to every NPC, for the same users. Afterwards every
+conversation must alternate player lines and replies, with no message
+twice and the chat memory ending with the last reply. Users that were
+never reset must hold every message that was answered. The check runs
+again with only --evict-max live sessions, so sessions are evicted and
+rehydrated in the middle of turns.
+
+The second part measures turns per second against the number of
+distinct users, one client thread each. Per-user locks should scale
+linearly. --compare-global reruns it with one lock shared by all users.
+It also times a batch sending one message to each NPC for one user,
+the conversations of a user have their own locks and run concurrently.
+
+    python benchmarks/stress_sessions.py --users 16 --writers 4
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('NPC_LLM_BACKEND', 'mock')
+os.environ.setdefault('NPC_MOCK_LATENCY', '0.05')
+os.environ.setdefault('NPC_MOCK_TOKEN_RATE', '0')
+os.environ.setdefault('NPC_PREWARM', '0')
+# 准入控制和重复提交合并会让压测的请求排队或合并，这里放开
+os.environ.setdefault('NPC_ADMISSION_CONCURRENCY', '1024')
+os.environ.setdefault('NPC_ADMISSION_QUEUE', '4096')
+os.environ.setdefault('NPC_ADMISSION_PER_USER', '64')
+os.environ.setdefault('NPC_DUPLICATE_WINDOW', '0')
+
+# pylint: disable=wrong-import-position
+import app
+
+
+class GlobalLock:
+    """ One lock for every user, the coarse alternative to UserLocks.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, user_id, shared=False):  # pylint: disable=unused-argument
+        """ Holds the lock shared by all users.
+        """
+        with self._lock:
+            yield
+
+
+def _writer(client, user_id, writer, turns, answered, errors):
+    for turn in range(turns):
+        message = f'{user_id}/w{writer}/m{turn}'
+        response = client.post(f'/conversations/{user_id}',
+                               json={'message': message})
+        if response.status_code == 201:
+            answered.append(message)
+        else:
+            errors.append((user_id, message, response.status_code))
+
+
+def _chaos(client, user_ids, stop, seed, counts):
+    rng = random.Random(seed)
+    npc_names = app.config_registry.names()
+    counts[seed] = dict.fromkeys(('reset', 'config', 'status', 'batch'), 0)
+    counts = counts[seed]
+    while not stop.is_set():
+        user_id = rng.choice(user_ids)
+        action = rng.choice(('reset', 'config', 'status', 'batch'))
+        if action == 'reset':
+            client.post(f'/reset/{user_id}')
+        elif action == 'config':
+            client.post(f'/setConfigStr/{user_id}',
+                        json={'config_str': f'A tired guard, #{seed}.'})
+        elif action == 'status':
+            client.post(f'/setTaskStatus/{user_id}',
+                        json={'task_status': rng.choice(
+                            ['start', 'accepted'])})
+        else:
+            client.post('/batchConversations', json={'items': [
+                {'user_id': user_id, 'npc': npc_name,
+                 'message': f'{user_id}/batch{seed}/{counts["batch"]}'}
+                for npc_name in npc_names]})
+        counts[action] += 1
+        time.sleep(rng.uniform(0, 0.02))
+
+
+def check_conversation(history, memory, answered):
+    """ Checks one conversation.
+    Args:
+        history (list): The conversation history lines.
+        memory (list): The chat memory messages.
+        answered (list): The messages answered with 201, None if some
+            turns may legitimately be gone.
+    Returns:
+        A list of problems, empty when the conversation is consistent.
+    """
+    problems = []
+    players = [line[len('Player: '):] for line in history[0::2]]
+    if any(not line.startswith('Player: ') for line in history[0::2]) or \
+            any(line.startswith('Player: ') for line in history[1::2]) or \
+            len(history) % 2:
+        problems.append('player lines and replies do not alternate')
+    if len(set(players)) != len(players):
+        problems.append('duplicated turns')
+    # 记忆可能被 prompt 大小检查逐条裁剪过，只能是历史的结尾，从最后
+    # 一条回复往前交替
+    roles = [message.role for message in reversed(memory)]
+    if len(memory) > len(history) or \
+            any(role == 'Player' for role in roles[0::2]) or \
+            any(role != 'Player' for role in roles[1::2]) or \
+            (memory and history[-1] != f'{roles[0]}: {memory[-1].content}'):
+        problems.append('chat memory does not match the history')
+    if answered is not None:
+        lost = set(answered) - set(players)
+        if lost:
+            problems.append(f'{len(lost)} answered turns lost')
+    return problems
+
+
+def check_user(user_id, answered):
+    """ Checks every conversation of one user.
+    Args:
+        user_id (str): The user ID.
+        answered (list): The messages answered with 201 by the current
+            NPC, None if the user may have been reset and some turns
+            legitimately gone.
+    Returns:
+        A list of problems, empty when the conversations are consistent.
+    """
+    with app.session_manager.session(user_id, commit=False) as sess:
+        current = sess['curr_npc']
+        names = {current, *sess['npcs'], *sess['states']}
+        conversations = []
+        for npc_name in sorted(names):
+            npc = app.session_manager.get_npc(sess, npc_name)
+            conversations.append((npc_name, list(npc.conv_history),
+                                  list(npc.memory.chat_memory.messages)))
+    problems = []
+    for npc_name, history, memory in conversations:
+        problems.extend(f'{npc_name}: {problem}' for problem in
+                        check_conversation(history, memory, answered
+                                           if npc_name == current else None))
+    return problems
+
+
+def stress(users, writers, turns, chaos_threads, prefix='stress'):
+    """ Runs the correctness part.
+    Returns:
+        dict with the requests made and the problems found
+    """
+    user_ids = [f'{prefix}-{index}' for index in range(users)]
+    # 一半的用户不会被重置，所有得到回复的消息都必须在历史中
+    stable = set(user_ids[:users // 2])
+    chaotic = [user_id for user_id in user_ids if user_id not in stable]
+    answered = {user_id: [] for user_id in user_ids}
+    errors = []
+    counts = [None] * chaos_threads
+    stop = threading.Event()
+    threads = [threading.Thread(target=_writer, args=(
+        app.app.test_client(), user_id, writer, turns,
+        answered[user_id], errors))
+        for user_id in user_ids for writer in range(writers)]
+    chaos = [threading.Thread(target=_chaos, args=(
+        app.app.test_client(), chaotic or user_ids, stop, seed, counts))
+        for seed in range(chaos_threads)]
+    start = time.perf_counter()
+    for thread in threads + chaos:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    for thread in chaos:
+        thread.join()
+    seconds = time.perf_counter() - start
+    problems = {}
+    for user_id in user_ids:
+        found = check_user(user_id, answered[user_id]
+                           if user_id in stable else None)
+        if found:
+            problems[user_id] = found
+    return {
+        'turns': sum(map(len, answered.values())),
+        'errors': errors[:10],
+        'chaos': {action: sum(thread[action] for thread in counts)
+                  for action in counts[0]} if counts else {},
+        'seconds': round(seconds, 2),
+        'problems': problems,
+    }
+
+
+def _client_loop(user_id, deadline, done):
+    client = app.app.test_client()
+    count = 0
+    while time.monotonic() < deadline:
+        response = client.post(f'/conversations/{user_id}',
+                               json={'message': f'{user_id}/{count}'})
+        count += response.status_code == 201
+    done.append(count)
+
+
+def throughput(user_counts, duration):
+    """ Measures turns per second against the number of distinct users.
+    Returns:
+        list of (users, turns per second, efficiency against one user)
+    """
+    rows = []
+    base = None
+    for users in user_counts:
+        done = []
+        deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=_client_loop, args=(
+            f'bench-{users}-{index}', deadline, done))
+            for index in range(users)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rate = sum(done) / (time.perf_counter() - start)
+        base = base or rate
+        rows.append((users, round(rate, 1), round(rate / (base * users), 2)))
+    return rows
+
+
+def fanout(rounds):
+    """ Times batches sending one message to every NPC for one user.
+    Returns:
+        (number of NPCs, median seconds per batch)
+    """
+    client = app.app.test_client()
+    npc_names = app.config_registry.names()
+    seconds = []
+    for turn in range(rounds):
+        start = time.perf_counter()
+        response = client.post('/batchConversations', json={'items': [
+            {'user_id': 'fanout', 'npc': npc_name,
+             'message': f'fanout/{npc_name}/{turn}'}
+            for npc_name in npc_names]})
+        assert all(result.get('message')
+                   for result in response.get_json()['results'])
+        seconds.append(time.perf_counter() - start)
+    return len(npc_names), round(statistics.median(seconds), 3)
+
+
+def main():
+    """ Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--writers', type=int, default=4,
+                        help='concurrent client threads per user')
+    parser.add_argument('--turns', type=int, default=20,
+                        help='messages per writer')
+    parser.add_argument('--chaos', type=int, default=2,
+                        help='threads resetting and reconfiguring users')
+    parser.add_argument('--evict-max', type=int, default=2,
+                        help='live sessions kept in the eviction run, '
+                             '0 skips it')
+    parser.add_argument('--scale', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='batches to every NPC of one user')
+    parser.add_argument('--compare-global', action='store_true',
+                        help='also measure one lock shared by all users')
+    args = parser.parse_args()
+    runs = [('stress', None)]
+    if args.evict_max:
+        runs.append(('evict', args.evict_max))
+    results = {}
+    store = app.session_manager.sessions
+    for name, max_sessions in runs:
+        default_max, store.max_sessions = store.max_sessions, (
+            max_sessions or store.max_sessions)
+        try:
+            results[name] = result = stress(args.users, args.writers,
+                                            args.turns, args.chaos, name)
+        finally:
+            store.max_sessions = default_max
+        print(f'{name}: {result["turns"]} turns in {result["seconds"]} s, '
+              f'{sum(result["chaos"].values())} resets and '
+              f'reconfigurations, {len(result["errors"])} errors, '
+              f'{len(result["problems"])} inconsistent users')
+    modes = [('per_user', app.session_manager.user_locks)]
+    if args.compare_global:
+        modes.append(('global', GlobalLock()))
+    for mode, locks in modes:
+        app.session_manager.user_locks = locks
+        results[mode] = rows = throughput(args.scale, args.duration)
+        for users, rate, efficiency in rows:
+            print(f'{mode:<9} {users:4d} users  {rate:8.1f} turns/s  '
+                  f'scaling {efficiency:5.0%}')
+        npcs, seconds = fanout(args.fanout)
+        results[f'{mode}_fanout'] = {'npcs': npcs, 'seconds': seconds}
+        print(f'{mode:<9} one user, {npcs} NPCs  {seconds * 1000:8.1f} ms '
+              f'per batch')
+    print(json.dumps({'args': vars(args), 'results': results},
+                     ensure_ascii=False))
+    if any(results[name]['problems'] or results[name]['errors']
+           for name, _ in runs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
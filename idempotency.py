@@ -0,0 +1,215 @@
+"""
+重复提交的合并：玩家双击发送、前端在响应慢时重试，同一条消息会再调用
+一次LLM、在历史中多出一句。相同的请求在进行中时共用一次调用，完成后
+的结果在短时间内直接重放
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdempotencyConflict(Exception):
+    """IdempotencyConflict
+    the idempotency key was already used for a different request
+    """
+
+
+def fingerprint(payload):
+    """
+    digest of a request body, tells a retry from a different request
+    reusing the same key
+    params:
+        payload: JSON serializable request
+    return:
+        hex digest
+    """
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+class _Entry:
+    __slots__ = ('fingerprint', 'event', 'done', 'result', 'expires')
+
+    def __init__(self, digest):
+        self.fingerprint = digest
+        self.event = threading.Event()
+        self.done = False
+        self.result = None
+        self.expires = 0.0
+
+
+class RequestCoalescer:
+    """RequestCoalescer
+    params:
+        ttl: seconds the result of a request with an idempotency key is
+            replayed
+        duplicate_window: seconds the result of a request without a key
+            is replayed to identical requests, 0 only merges requests
+            that are still in flight
+        max_entries: results kept, oldest go first
+    """
+
+    def __init__(self, ttl=300.0, duplicate_window=2.0, max_entries=10000):
+        self.ttl = ttl
+        self.duplicate_window = duplicate_window
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> _Entry，正在执行的请求
+        self._in_flight = {}
+        # key -> _Entry，按完成先后排列的结果
+        self._done = OrderedDict()
+        self.stats = {
+            'executed': 0,
+            'coalesced': 0,
+            'replayed': 0,
+            'conflicts': 0,
+        }
+
+    def _expire(self, now):
+        while self._done:
+            key, entry = next(iter(self._done.items()))
+            if entry.expires > now and len(self._done) <= self.max_entries:
+                break
+            del self._done[key]
+
+    def _check(self, entry, digest):
+        if entry.fingerprint != digest:
+            self.stats['conflicts'] += 1
+            raise IdempotencyConflict('idempotency key reused with a '
+                                      'different request')
+
+    def run(self, scope, payload, func, key=None):
+        """
+        run func once for identical requests
+        params:
+            scope: what the request belongs to, e.g. the user id
+            payload: JSON serializable request
+            func: produces the result, not called for duplicates
+            key: client supplied idempotency key, None merges requests
+                with the same payload instead
+        return:
+            (result, whether it was shared with an earlier request)
+        raises:
+            IdempotencyConflict: the key was used for another payload
+        """
+        entry_key, ttl, digest = self._key(scope, payload, key)
+        while True:
+            entry, owner = self._claim(entry_key, digest)
+            if owner is None:
+                return entry.result, True
+            if owner:
+                break
+            entry.event.wait()
+            if entry.done:
+                with self._lock:
+                    self.stats['coalesced'] += 1
+                return entry.result, True
+            # 第一个请求失败了，由等待的请求之一重新执行
+        try:
+            entry.result = func()
+            entry.done = True
+        finally:
+            self._settle(entry_key, entry, ttl)
+        return entry.result, False
+
+    async def arun(self, scope, payload, func, key=None):
+        """
+        run for the asyncio server, duplicates wait in a worker thread
+        instead of blocking the event loop
+        params:
+            scope, payload, key: see run
+            func: coroutine function producing the result
+        return:
+            (result, whether it was shared with an earlier request)
+        raises:
+            IdempotencyConflict: the key was used for another payload
+        """
+        entry_key, ttl, digest = self._key(scope, payload, key)
+        while True:
+            entry, owner = self._claim(entry_key, digest)
+            if owner is None:
+                return entry.result, True
+            if owner:
+                break
+            await asyncio.get_running_loop().run_in_executor(
+                None, entry.event.wait)
+            if entry.done:
+                with self._lock:
+                    self.stats['coalesced'] += 1
+                return entry.result, True
+        try:
+            entry.result = await func()
+            entry.done = True
+        finally:
+            self._settle(entry_key, entry, ttl)
+        return entry.result, False
+
+    def _key(self, scope, payload, key):
+        digest = fingerprint(payload)
+        if key is None:
+            return (scope, '', digest), self.duplicate_window, digest
+        return (scope, key), self.ttl, digest
+
+    def _claim(self, entry_key, digest):
+        """
+        look up a request
+        return:
+            (entry, owner): owner is None for a result to replay, True
+            if the caller must run the request, False if it must wait
+            for the request in flight
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            entry = self._done.get(entry_key)
+            if entry is not None and entry.expires <= now:
+                # 有效期不同的结果混在一起，排在前面的不一定先过期
+                del self._done[entry_key]
+                entry = None
+            if entry is not None:
+                self._check(entry, digest)
+                self.stats['replayed'] += 1
+                return entry, None
+            entry = self._in_flight.get(entry_key)
+            if entry is None:
+                entry = self._in_flight[entry_key] = _Entry(digest)
+                self.stats['executed'] += 1
+                return entry, True
+            self._check(entry, digest)
+            return entry, False
+
+    def _settle(self, entry_key, entry, ttl):
+        with self._lock:
+            del self._in_flight[entry_key]
+            if entry.done and ttl > 0:
+                entry.expires = time.monotonic() + ttl
+                self._done.pop(entry_key, None)
+                self._done[entry_key] = entry
+                self._expire(time.monotonic())
+        entry.event.set()
+
+    def as_dict(self):
+        """
+        return:
+            counters, requests in flight and results kept
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self._in_flight)
+            stats['entries'] = len(self._done)
+        return stats
+
+    @classmethod
+    def from_env(cls):
+        """
+        read NPC_IDEMPOTENCY_TTL, NPC_DUPLICATE_WINDOW and
+        NPC_IDEMPOTENCY_MAX
+        """
+        return cls(
+            ttl=float(os.getenv('NPC_IDEMPOTENCY_TTL', '300')),
+            duplicate_window=float(os.getenv('NPC_DUPLICATE_WINDOW', '2')),
+            max_entries=int(os.getenv('NPC_IDEMPOTENCY_MAX', '10000')))
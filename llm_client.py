@@ -0,0 +1,463 @@
+"""
+有容错的LLM客户端：包在真正的LLM外面，负责超时、带抖动的指数退避重试、
+对慢请求发出对冲请求、空回复重试，以及在补全接口不健康时用熔断器快速失败
+"""
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, List, Optional
+
+import openai
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.llms.base import BaseLLM
+from langchain.schema import LLMResult
+
+
+class LLMUnavailableError(Exception):
+    """the endpoint is unhealthy, or every attempt of a call failed"""
+
+
+class EmptyCompletionError(Exception):
+    """the LLM answered with an empty or blank completion"""
+
+
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    TimeoutError,
+    asyncio.TimeoutError,
+    EmptyCompletionError,
+)
+
+
+class RetryPolicy:
+    """RetryPolicy
+    params:
+        max_attempts: attempts per call, the first one included
+        deadline: seconds a call may take over all its attempts
+        attempt_timeout: seconds one attempt may take
+        backoff: base delay before the first retry, doubled every retry
+        backoff_max: upper bound of the delay
+        hedge_after: seconds after which a second request races the
+            first one, None disables hedging
+        seed: seed of the jitter
+    """
+
+    def __init__(self, max_attempts=3, deadline=30.0, attempt_timeout=15.0,
+                 backoff=0.25, backoff_max=4.0, hedge_after=None, seed=None):
+        self.max_attempts = max(max_attempts, 1)
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, retry, error=None):
+        """
+        seconds to wait before a retry, with full jitter
+        params:
+            retry: number of the retry, starting at 1
+            error: error of the failed attempt, its Retry-After header
+                is honoured
+        """
+        ceiling = min(self.backoff_max, self.backoff * 2 ** (retry - 1))
+        with self._lock:
+            delay = self._random.uniform(0, ceiling)
+        headers = getattr(error, 'headers', None) or {}
+        try:
+            delay = max(delay, float(headers.get('retry-after', 0)))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+    @classmethod
+    def from_env(cls):
+        """
+        read NPC_LLM_MAX_ATTEMPTS, NPC_LLM_DEADLINE,
+        NPC_LLM_ATTEMPT_TIMEOUT, NPC_LLM_BACKOFF, NPC_LLM_BACKOFF_MAX
+        and NPC_LLM_HEDGE_AFTER (0 disables hedging)
+        """
+        hedge_after = float(os.getenv('NPC_LLM_HEDGE_AFTER', '0'))
+        return cls(
+            max_attempts=int(os.getenv('NPC_LLM_MAX_ATTEMPTS', '3')),
+            deadline=float(os.getenv('NPC_LLM_DEADLINE', '30')),
+            attempt_timeout=float(os.getenv('NPC_LLM_ATTEMPT_TIMEOUT', '15')),
+            backoff=float(os.getenv('NPC_LLM_BACKOFF', '0.25')),
+            backoff_max=float(os.getenv('NPC_LLM_BACKOFF_MAX', '4')),
+            hedge_after=hedge_after or None)
+
+
+class CircuitBreaker:
+    """CircuitBreaker
+    opens after failure_threshold failed attempts in a row and rejects
+    calls for reset_timeout seconds, then lets one probe through. A
+    probe without an answer after another reset_timeout seconds is
+    given up and the next call probes again
+    params:
+        failure_threshold: consecutive failures that open the circuit
+        reset_timeout: seconds the circuit stays open
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        # allow() 放过去的探测请求的凭据，只有它能了结半开状态
+        self._probe = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'trips': 0,
+            'rejected': 0,
+        }
+
+    def allow(self):
+        """
+        whether a request may be sent now
+        return:
+            False to reject it, otherwise a truthy ticket to pass to
+            release() when the call ends
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at >= self.reset_timeout:
+                # 放一个探测请求过去，其余请求继续快速失败；探测请求
+                # 超过 reset_timeout 仍没有结果时再放一个
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                self._probe = object()
+                return self._probe
+            self.stats['rejected'] += 1
+            return False
+
+    def record_success(self):
+        """
+        an attempt succeeded
+        """
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probe = None
+
+    def record_failure(self):
+        """
+        an attempt failed with a retryable error
+        """
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and
+                     self._failures >= self.failure_threshold):
+                self._trip()
+
+    def record_empty(self):
+        """
+        an attempt got an empty completion, which only counts as a
+        failure for the probe
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._failures += 1
+                self._trip()
+
+    def release(self, ticket):
+        """
+        a call ended without telling whether the endpoint is healthy,
+        e.g. with a non-retryable error or cancelled. If it was the
+        probe, the circuit settles open and the next probe goes out
+        after reset_timeout, as for a failed probe: an attempt of the
+        probe may still be running, e.g. a losing hedge, and handing
+        its slot to the next call at once would put two probes in
+        flight. Other calls leave a probe in flight alone
+        params:
+            ticket: what allow() returned when the call started
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and ticket is self._probe:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe = None
+
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probe = None
+        self.stats['trips'] += 1
+
+    @classmethod
+    def from_env(cls):
+        """
+        read NPC_LLM_BREAKER_FAILURES and NPC_LLM_BREAKER_RESET
+        """
+        return cls(
+            failure_threshold=int(os.getenv('NPC_LLM_BREAKER_FAILURES', '5')),
+            reset_timeout=float(os.getenv('NPC_LLM_BREAKER_RESET', '30')))
+
+
+class _TokenTracker:
+    """forwards streamed tokens to the run manager, remembering whether
+    any token reached the caller"""
+
+    def __init__(self, run_manager):
+        self.run_manager = run_manager
+        self.emitted = False
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.emitted = True
+        if self.run_manager is not None:
+            self.run_manager.on_llm_new_token(token, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.run_manager, name)
+
+
+class _AsyncTokenTracker(_TokenTracker):
+
+    async def on_llm_new_token(self, token, **kwargs):
+        self.emitted = True
+        if self.run_manager is not None:
+            await self.run_manager.on_llm_new_token(token, **kwargs)
+
+
+# 对冲请求在这些线程中运行，输掉的请求由客户端自己的超时结束
+_hedge_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv('NPC_LLM_HEDGE_POOL', '32')),
+    thread_name_prefix='llm-hedge')
+
+llm_stats = {
+    'calls': 0,
+    'attempts': 0,
+    'retries': 0,
+    'empty': 0,
+    'timeouts': 0,
+    'hedges': 0,
+    'hedge_wins': 0,
+    'failures': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        llm_stats[name] += amount
+
+
+def _check(result):
+    if not any(generation.text.strip() for generations in result.generations
+               for generation in generations):
+        _count('empty')
+        raise EmptyCompletionError("empty completion")
+    return result
+
+
+class ResilientLLM(BaseLLM):
+    """ResilientLLM
+    params:
+        llm: the LLM doing the work, with its own retries disabled
+        policy: RetryPolicy
+        breaker: CircuitBreaker, usually shared by every client of the
+            same endpoint
+    Streaming LLMs are never hedged and only retried before their first
+    token reached the caller. Raises LLMUnavailableError when the
+    circuit is open or the call failed.
+    """
+    llm: Any
+    policy: Any
+    breaker: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return f"resilient-{self.llm._llm_type}"
+
+    @property
+    def _identifying_params(self):
+        return self.llm._identifying_params
+
+    def _hedge_after(self):
+        if getattr(self.llm, 'streaming', False):
+            return None
+        return self.policy.hedge_after
+
+    def _next_delay(self, retry, error, deadline, partial):
+        """
+        seconds to wait before the next attempt
+        raises:
+            LLMUnavailableError: no attempt is left
+        """
+        if isinstance(error, (TimeoutError, asyncio.TimeoutError,
+                              openai.error.Timeout)):
+            _count('timeouts')
+        if isinstance(error, EmptyCompletionError):
+            self.breaker.record_empty()
+        else:
+            self.breaker.record_failure()
+        delay = self.policy.delay(retry, error)
+        if (partial or retry >= self.policy.max_attempts
+                or time.monotonic() + delay >= deadline
+                or not self.breaker.allow()):
+            _count('failures')
+            raise LLMUnavailableError(
+                f"LLM call failed after {retry} attempts: {error!r}") \
+                from error
+        _count('retries')
+        return delay
+
+    def _start(self):
+        """
+        return:
+            the deadline of the call and the breaker's ticket
+        """
+        _count('calls')
+        ticket = self.breaker.allow()
+        if not ticket:
+            _count('failures')
+            raise LLMUnavailableError("LLM circuit breaker is open")
+        return time.monotonic() + self.policy.deadline, ticket
+
+    def _generate(self,
+                  prompts: List[str],
+                  stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None,
+                  **kwargs: Any) -> LLMResult:
+        deadline, ticket = self._start()
+        retry = 0
+        try:
+            while True:
+                tracker = _TokenTracker(run_manager)
+
+                def attempt(tracker=tracker):
+                    _count('attempts')
+                    return _check(self.llm._generate(prompts, stop=stop,
+                                                     run_manager=tracker))
+
+                try:
+                    result = self._race(attempt, deadline)
+                    self.breaker.record_success()
+                    return result
+                except RETRYABLE_ERRORS as error:
+                    retry += 1
+                    time.sleep(self._next_delay(retry, error, deadline,
+                                                tracker.emitted))
+        except BaseException:
+            # 不可重试的错误、取消等，探测请求也要有个了结
+            self.breaker.release(ticket)
+            raise
+
+    def _race(self, attempt, deadline):
+        """
+        run an attempt, and a hedged second one if the first is slow
+        """
+        hedge_after = self._hedge_after()
+        if hedge_after is None:
+            return attempt()
+        timeout = min(self.policy.attempt_timeout,
+                      deadline - time.monotonic())
+        end = time.monotonic() + timeout
+        hedge_at = time.monotonic() + hedge_after
+        # 工作线程中保留当前请求的上下文（例如指标中的endpoint）
+        first = _hedge_pool.submit(contextvars.copy_context().run, attempt)
+        pending = {first}
+        hedged = hedge_at >= end
+        error = None
+        while pending:
+            until = end if hedged else hedge_at
+            done, pending = wait(pending,
+                                 timeout=max(until - time.monotonic(), 0),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        _count('hedge_wins')
+                    return future.result()
+                error = future.exception()
+            if not done:
+                if hedged:
+                    raise TimeoutError("LLM attempt timed out")
+                hedged = True
+                _count('hedges')
+                pending.add(_hedge_pool.submit(
+                    contextvars.copy_context().run, attempt))
+        raise error
+
+    async def _agenerate(
+            self,
+            prompts: List[str],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any) -> LLMResult:
+        deadline, ticket = self._start()
+        retry = 0
+        try:
+            while True:
+                tracker = _AsyncTokenTracker(run_manager)
+
+                async def attempt(tracker=tracker):
+                    _count('attempts')
+                    return _check(await self.llm._agenerate(
+                        prompts, stop=stop, run_manager=tracker))
+
+                try:
+                    result = await self._arace(attempt, deadline)
+                    self.breaker.record_success()
+                    return result
+                except RETRYABLE_ERRORS as error:
+                    retry += 1
+                    await asyncio.sleep(self._next_delay(
+                        retry, error, deadline, tracker.emitted))
+        except BaseException:
+            self.breaker.release(ticket)
+            raise
+
+    async def _arace(self, attempt, deadline):
+        """
+        like _race, losing requests are cancelled
+        """
+        timeout = max(min(self.policy.attempt_timeout,
+                          deadline - time.monotonic()), 0)
+        hedge_after = self._hedge_after()
+        if hedge_after is None or hedge_after >= timeout:
+            return await asyncio.wait_for(attempt(), timeout)
+        first = asyncio.ensure_future(attempt())
+        pending = {first}
+        end = time.monotonic() + timeout
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if not done:
+                _count('hedges')
+                pending.add(asyncio.ensure_future(attempt()))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(end - time.monotonic(), 0),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError("LLM attempt timed out")
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            _count('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,202 @@
+"""
+对话的消息日志：每个NPC对话只保存一份紧凑的、只追加的消息记录，
+conv_history、LangChain 的记忆和接口返回的 JSON 都从这里按需生成
+"""
+import sys
+from array import array
+
+# 消息出现在哪些视图中
+IN_HISTORY = 1
+IN_MEMORY = 2
+# 列表中每个元素的指针
+_POINTER_SIZE = 8
+
+
+class MessageLog:
+    """MessageLog
+    append-only messages of one conversation. Roles and the task status
+    suffixes of player inputs are interned, every message costs one text
+    plus a few bytes in arrays.
+    """
+    __slots__ = ('roles', 'suffixes', 'memory_start', '_role_ids',
+                 '_suffix_ids', '_flags', '_texts', '_history')
+
+    def __init__(self):
+        self.roles = []
+        self.suffixes = ['']
+        # 更早的消息已经折叠进摘要，不再属于记忆
+        self.memory_start = 0
+        self._role_ids = array('B')
+        self._suffix_ids = array('H')
+        self._flags = array('B')
+        self._texts = []
+        # conv_history 中每一行对应的消息下标
+        self._history = array('I')
+
+    def __len__(self):
+        return len(self._texts)
+
+    @staticmethod
+    def _intern(table, value):
+        try:
+            return table.index(value)
+        except ValueError:
+            table.append(sys.intern(value))
+            return len(table) - 1
+
+    def append(self, role, text, suffix='', flags=IN_HISTORY | IN_MEMORY):
+        """
+        add a message
+        params:
+            role: speaker
+            text: message as shown in conv_history
+            suffix: text the memory adds after it, e.g. the task status
+            flags: IN_HISTORY and/or IN_MEMORY
+        return:
+            index of the message
+        """
+        index = len(self._texts)
+        self._role_ids.append(self._intern(self.roles, role))
+        self._suffix_ids.append(self._intern(self.suffixes, suffix))
+        self._flags.append(flags)
+        self._texts.append(text)
+        if flags & IN_HISTORY:
+            self._history.append(index)
+        return index
+
+    def role(self, index):
+        """
+        speaker of a message
+        """
+        return self.roles[self._role_ids[index]]
+
+    def content(self, index):
+        """
+        message as the memory sees it, with its suffix
+        """
+        return self._texts[index] + self.suffixes[self._suffix_ids[index]]
+
+    def flags(self, index):
+        """
+        views the message appears in
+        """
+        return self._flags[index]
+
+    def add_flags(self, index, flags):
+        """
+        show a message in more views
+        """
+        if flags & IN_HISTORY and not self._flags[index] & IN_HISTORY:
+            raise ValueError("history lines can only be appended")
+        self._flags[index] |= flags
+
+    def history_len(self):
+        """
+        number of conv_history lines
+        """
+        return len(self._history)
+
+    def history(self, start=0, end=None):
+        """
+        conv_history lines, formatted as "<role>: <text>"
+        params:
+            start: index of the first line
+            end: index after the last line
+        return:
+            list of lines
+        """
+        return [f"{self.role(index)}: {self._texts[index]}"
+                for index in self._history[start:end]]
+
+    def history_tail(self, count):
+        """
+        the last lines of conv_history
+        """
+        if count <= 0:
+            return []
+        return self.history(max(len(self._history) - count, 0))
+
+    def memory(self):
+        """
+        messages of the chat memory
+        return:
+            list of (role, content)
+        """
+        return [(self.role(index), self.content(index))
+                for index in range(self.memory_start, len(self._texts))
+                if self._flags[index] & IN_MEMORY]
+
+    def drop_memory(self, count):
+        """
+        remove the oldest messages from the memory, they stay in
+        conv_history
+        params:
+            count: number of memory messages
+        """
+        index = self.memory_start
+        while count > 0 and index < len(self._texts):
+            if self._flags[index] & IN_MEMORY:
+                count -= 1
+            index += 1
+        self.memory_start = index
+
+    def clear_memory(self):
+        """
+        remove every message from the memory
+        """
+        self.memory_start = len(self._texts)
+
+    def approx_size(self):
+        """
+        rough estimate of the memory held by the log
+        return:
+            size in bytes
+        """
+        size = sum(sys.getsizeof(text) for text in self._texts)
+        size += len(self._texts) * _POINTER_SIZE
+        for column in (self._role_ids, self._suffix_ids, self._flags,
+                       self._history):
+            size += column.itemsize * len(column)
+        return size
+
+    def dump(self):
+        """
+        compact, JSON serializable form of the log
+        return:
+            dict with the role and suffix tables, the messages as
+            [role id, suffix id, flags, text] and the memory start
+        """
+        return {
+            'roles': list(self.roles),
+            'suffixes': list(self.suffixes),
+            'messages': [[role_id, suffix_id, flags, text]
+                         for role_id, suffix_id, flags, text in zip(
+                             self._role_ids, self._suffix_ids,
+                             self._flags, self._texts)],
+            'memory_start': self.memory_start,
+        }
+
+    @classmethod
+    def load(cls, state):
+        """
+        rebuild a log from the output of dump
+        params:
+            state: dumped log
+        return:
+            MessageLog
+        """
+        log = cls()
+        roles = state['roles']
+        suffixes = state['suffixes']
+        for role_id, suffix_id, flags, text in state['messages']:
+            log.append(roles[role_id], text, suffixes[suffix_id], flags)
+        log.memory_start = state.get('memory_start', 0)
+        return log
+
+    @staticmethod
+    def state_size(state):
+        """
+        rough estimate of the memory held by a dumped log
+        """
+        return sum(sys.getsizeof(message[3]) + _POINTER_SIZE
+                   for message in state['messages'])
@@ -0,0 +1,213 @@
+"""
+This file contains in-process metrics rendered in the Prometheus text
+format: per-stage latency histograms labelled by endpoint and NPC, and
+counters for prompt and completion tokens.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+# Flask 的每个请求线程、asyncio 的每个任务各自有一份
+current_endpoint = ContextVar('current_endpoint', default='')
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
+    return '{' + body + '}'
+
+
+class Counter:
+    """ A monotonically increasing value per label set.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        """ Adds the amount to the counter of the labels.
+        """
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        """ Returns the Prometheus text lines of the counter.
+        """
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_format_labels(key)} {value}'
+                for key, value in sorted(values.items())]
+
+
+class Histogram:
+    """ Cumulative bucket counts, sum and count per label set.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label key -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        """ Records one observation.
+        """
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[index] += 1
+            row[-1] += value
+
+    def render(self):
+        """ Returns the Prometheus text lines of the histogram.
+        """
+        with self._lock:
+            values = {key: list(row) for key, row in self._values.items()}
+        lines = []
+        for key, row in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                lines.append(f'{self.name}_bucket'
+                             f'{_format_labels(key, [("le", bound)])} '
+                             f'{cumulative}')
+            cumulative += row[len(self.buckets)]
+            lines.append(f'{self.name}_bucket'
+                         f'{_format_labels(key, [("le", "+Inf")])} '
+                         f'{cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {row[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(key)} '
+                         f'{cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """ Holds the metrics and the collectors of values owned elsewhere.
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        """ Creates and registers a Counter.
+        """
+        metric = Counter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        """ Creates and registers a Histogram.
+        """
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        """ Registers a callable returning (name, kind, help, labels, value)
+        tuples, read on every render.
+        """
+        self._collectors.append(collect)
+
+    def render(self):
+        """ Returns all metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        seen = set()
+        for collect in self._collectors:
+            for name, kind, help_text, labels, value in collect():
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f'# HELP {name} {help_text}')
+                    lines.append(f'# TYPE {name} {kind}')
+                lines.append(
+                    f'{name}{_format_labels(_label_key(labels))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+request_seconds = registry.histogram(
+    'npc_request_seconds', 'Request latency by endpoint.')
+stage_seconds = registry.histogram(
+    'npc_stage_seconds',
+    'Latency of each request stage by endpoint, stage and NPC.')
+prompt_tokens = registry.histogram(
+    'npc_prompt_tokens', 'Prompt tokens per LLM call.', TOKEN_BUCKETS)
+completion_tokens = registry.histogram(
+    'npc_completion_tokens', 'Completion tokens per LLM call.',
+    TOKEN_BUCKETS)
+prompt_component_tokens = registry.histogram(
+    'npc_prompt_component_tokens',
+    'Prompt tokens per LLM call by NPC and prompt component.',
+    (0,) + TOKEN_BUCKETS)
+
+
+def observe_stage(stage, seconds, npc=''):
+    """ Records the duration of a stage of the current request.
+    Args:
+        stage (str): admission, lock_wait, session, npc_construction,
+            prompt, llm or memory.
+        seconds (float): Duration.
+        npc (str): NPC name.
+    """
+    stage_seconds.observe(seconds, endpoint=current_endpoint.get(),
+                          stage=stage, npc=npc)
+
+
+@contextmanager
+def timed_stage(stage, npc=''):
+    """ Times the block as a stage of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start, npc)
+
+
+def observe_tokens(npc, prompt, completion):
+    """ Records the prompt and completion tokens of one LLM call.
+    """
+    endpoint = current_endpoint.get()
+    prompt_tokens.observe(prompt, endpoint=endpoint, npc=npc)
+    completion_tokens.observe(completion, endpoint=endpoint, npc=npc)
+
+
+def observe_prompt_breakdown(npc, breakdown):
+    """ Records the tokens of each component of one prompt.
+    Args:
+        npc (str): NPC name.
+        breakdown (dict): Tokens per component, see preflight.py.
+    """
+    for component, tokens in breakdown.items():
+        prompt_component_tokens.observe(tokens, npc=npc,
+                                        component=component)
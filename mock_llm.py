@@ -0,0 +1,449 @@
+"""
+这是一个本地的假LLM，用来在没有Azure的情况下测试和压测NPC对话
+
+FakeStreamingLLM 直接替换 langchain 中的 LLM（NPC_LLM_BACKEND=mock，
+参数见 FakeStreamingLLM.from_env）；
+MockCompletionServer 模拟 Azure OpenAI 的 HTTP 接口，可以注入延迟和错误：
+
+    python mock_llm.py --port 8090 --latency 0.5 --error-rate 0.01
+    OPENAI_ENDPOINT=http://127.0.0.1:8090 OPENAI_API_KEY=mock python app.py
+
+两者的延迟、抖动和出错都由带种子的随机数决定，结果可以复现；两者都模拟
+补全接口的前缀缓存，在 usage 中报告 prompt_tokens_details.cached_tokens
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.llms.base import LLM
+from langchain.schema import LLMResult
+import openai
+
+DEFAULT_RESPONSES = [
+    "(eyebrow raised) I'm Ted, are you here to chat with me?",
+    "(Immediately alert, squinting at player for a moment, then reaches "
+    "out and pats his pocket) Are you here to take that box (voice flat)?",
+    "(grin) it's that box, I'm sure you know where it's located "
+    "(voice steady)",
+    "(leans back against the wall) Finish the job first, then we talk.",
+]
+
+
+class MockBehaviour:
+    """MockBehaviour
+    latency, jitter and failures of a mock completion endpoint
+    params:
+        latency: seconds before the reply (or the first token)
+        jitter: latency varies uniformly by +/- this many seconds
+        token_interval: seconds between tokens, 1 / token rate
+        error_rate: share of requests that fail
+        empty_rate: share of requests answered with an empty reply
+        stall_rate: share of requests that hang for stall_latency
+        stall_latency: seconds a stalled request hangs
+        seed: seed of the random generator
+    """
+
+    def __init__(self, latency=0.2, jitter=0.0, token_interval=0.02,
+                 error_rate=0.0, empty_rate=0.0, stall_rate=0.0,
+                 stall_latency=30.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_interval = token_interval
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.stall_rate = stall_rate
+        self.stall_latency = stall_latency
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """
+        draw the outcome of one request
+        return:
+            (latency in seconds, fault), fault is None, "error" or "empty"
+        """
+        with self._lock:
+            latency = self.latency
+            if self.jitter:
+                latency += self._random.uniform(-self.jitter, self.jitter)
+            if self.stall_rate and self._random.random() < self.stall_rate:
+                latency = self.stall_latency
+            fault = None
+            chance = self._random.random()
+            if chance < self.error_rate:
+                fault = "error"
+            elif chance < self.error_rate + self.empty_rate:
+                fault = "empty"
+        return max(latency, 0.0), fault
+
+    @classmethod
+    def from_env(cls):
+        """
+        read NPC_MOCK_LATENCY, NPC_MOCK_JITTER, NPC_MOCK_TOKEN_RATE
+        (tokens per second), NPC_MOCK_ERROR_RATE, NPC_MOCK_EMPTY_RATE,
+        NPC_MOCK_STALL_RATE, NPC_MOCK_STALL_LATENCY and NPC_MOCK_SEED
+        """
+        token_rate = float(os.getenv("NPC_MOCK_TOKEN_RATE", "50"))
+        return cls(latency=float(os.getenv("NPC_MOCK_LATENCY", "0.2")),
+                   jitter=float(os.getenv("NPC_MOCK_JITTER", "0")),
+                   token_interval=1 / token_rate if token_rate > 0 else 0.0,
+                   error_rate=float(os.getenv("NPC_MOCK_ERROR_RATE", "0")),
+                   empty_rate=float(os.getenv("NPC_MOCK_EMPTY_RATE", "0")),
+                   stall_rate=float(os.getenv("NPC_MOCK_STALL_RATE", "0")),
+                   stall_latency=float(
+                       os.getenv("NPC_MOCK_STALL_LATENCY", "30")),
+                   seed=int(os.getenv("NPC_MOCK_SEED", "0")))
+
+
+class PrefixCache:
+    """PrefixCache
+    simulated prompt prefix cache of a completion endpoint: a prompt
+    reuses the longest prefix an earlier prompt sent, counted in whole
+    blocks of tokens and only from min_tokens on
+    params:
+        block: tokens per cache block
+        min_tokens: shortest prefix that is cached
+        max_entries: cached prefixes kept, least recently used go first
+    """
+
+    def __init__(self, block=64, min_tokens=256, max_entries=100000):
+        self.block = block
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._prefixes = OrderedDict()
+
+    def lookup(self, prompt):
+        """
+        look a prompt up and cache its prefixes
+        params:
+            prompt: prompt text
+        return:
+            (prompt tokens, cached tokens)
+        """
+        tokens = tokenize(prompt)
+        digest = hashlib.sha1()
+        keys = []
+        for end in range(self.block, len(tokens) + 1, self.block):
+            digest.update("".join(tokens[end - self.block:end]).encode())
+            if end >= self.min_tokens:
+                keys.append((end, digest.hexdigest()))
+        cached = 0
+        with self._lock:
+            for end, key in keys:
+                if key in self._prefixes:
+                    cached = end
+                    self._prefixes.move_to_end(key)
+                else:
+                    self._prefixes[key] = True
+            while len(self._prefixes) > self.max_entries:
+                self._prefixes.popitem(last=False)
+        return len(tokens), cached
+
+
+def _usage(prefix_cache, prompt, reply):
+    prompt_tokens, cached = prefix_cache.lookup(prompt)
+    completion_tokens = len(tokenize(reply))
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+class FakeStreamingLLM(LLM):
+    """FakeStreamingLLM
+    params:
+        responses: canned replies, picked by a hash of the prompt
+        behaviour: MockBehaviour with latency, jitter, token rate
+            and faults
+        request_timeout: seconds before a slow request raises
+            openai.error.Timeout, like the real client
+        prefix_cache: PrefixCache reported in the token usage, None
+            reports no usage
+    """
+    responses: List[str] = DEFAULT_RESPONSES
+    behaviour: Any = None
+    request_timeout: Optional[float] = None
+    prefix_cache: Any = None
+
+    @classmethod
+    def from_env(cls, request_timeout=None):
+        """
+        build the mock LLM configured from the environment
+        """
+        return cls(behaviour=MockBehaviour.from_env(),
+                   request_timeout=request_timeout,
+                   prefix_cache=PrefixCache())
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _draw(self, prompt):
+        """
+        return:
+            (reply, seconds to wait, seconds between tokens), raises
+            after the wait when the request times out or fails
+        """
+        behaviour = self.behaviour or _DEFAULT_BEHAVIOUR
+        latency, fault = behaviour.draw()
+        if self.request_timeout is not None and \
+                latency > self.request_timeout:
+            return None, self.request_timeout, 0.0
+        if fault == "error":
+            return None, latency, 0.0
+        reply = "" if fault == "empty" else pick_response(self.responses,
+                                                          prompt)
+        return reply, latency, behaviour.token_interval
+
+    @staticmethod
+    def _raise(latency, request_timeout):
+        if request_timeout is not None and latency >= request_timeout:
+            raise openai.error.Timeout("mock LLM request timed out")
+        raise openai.error.ServiceUnavailableError("mock LLM failure")
+
+    def _call(self,
+              prompt: str,
+              stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None,
+              **kwargs: Any) -> str:
+        reply, latency, token_interval = self._draw(prompt)
+        time.sleep(latency)
+        if reply is None:
+            self._raise(latency, self.request_timeout)
+        for i, token in enumerate(tokenize(reply)):
+            if i:
+                time.sleep(token_interval)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(token)
+        return reply
+
+    def _with_usage(self, prompts, result):
+        if self.prefix_cache is not None and result.generations:
+            result.llm_output = {"token_usage": _usage(
+                self.prefix_cache, prompts[0],
+                result.generations[0][0].text)}
+        return result
+
+    def _generate(self,
+                  prompts: List[str],
+                  stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None,
+                  **kwargs: Any) -> LLMResult:
+        return self._with_usage(prompts, super()._generate(
+            prompts, stop=stop, run_manager=run_manager, **kwargs))
+
+    async def _agenerate(
+            self,
+            prompts: List[str],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any) -> LLMResult:
+        return self._with_usage(prompts, await super()._agenerate(
+            prompts, stop=stop, run_manager=run_manager, **kwargs))
+
+    async def _acall(
+            self,
+            prompt: str,
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any) -> str:
+        reply, latency, token_interval = self._draw(prompt)
+        await asyncio.sleep(latency)
+        if reply is None:
+            self._raise(latency, self.request_timeout)
+        for i, token in enumerate(tokenize(reply)):
+            if i:
+                await asyncio.sleep(token_interval)
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(token)
+        return reply
+
+
+class _CompletionHandler(BaseHTTPRequestHandler):
+    """answers chat/completions requests the way Azure OpenAI does"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """handle a completion request"""
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        prompt = body.get("prompt") or body.get("messages") or ""
+        reply = pick_response(self.server.responses, str(prompt))
+        latency, fault = self.server.behaviour.draw()
+        time.sleep(latency)
+        if fault == "empty":
+            reply = ""
+        if fault == "error":
+            self._fail()
+        elif body.get("stream"):
+            self._stream(reply)
+        else:
+            self._complete(reply, str(prompt))
+
+    def _fail(self):
+        data = json.dumps({"error": {
+            "message": "mock endpoint failure",
+            "type": "server_error",
+        }}).encode()
+        self.send_response(self.server.error_status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _complete(self, reply, prompt):
+        data = json.dumps({
+            "id": "mock",
+            "object": "text_completion",
+            "model": "mock",
+            "choices": [{
+                "index": 0,
+                "text": reply,
+                "message": {"role": "assistant", "content": reply},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": _usage(self.server.prefix_cache, prompt, reply),
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, reply):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i, token in enumerate(tokenize(reply)):
+            if i:
+                time.sleep(self.server.behaviour.token_interval)
+            chunk = json.dumps({
+                "id": "mock",
+                "object": "text_completion",
+                "model": "mock",
+                "choices": [{
+                    "index": 0,
+                    "text": token,
+                    "delta": {"content": token},
+                    "finish_reason": None,
+                    "logprobs": None,
+                }],
+            })
+            self.wfile.write(f"data: {chunk}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class MockCompletionServer(ThreadingHTTPServer):
+    """MockCompletionServer
+    params:
+        address: (host, port), port 0 picks a free port
+        latency: seconds before the reply (or the first token)
+        token_interval: seconds between streamed tokens
+        responses: canned replies
+        jitter, error_rate, empty_rate, stall_rate, stall_latency,
+            seed: see MockBehaviour
+        error_status: HTTP status of failed requests
+    """
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.5,
+                 token_interval=0.02, responses=None, jitter=0.0,
+                 error_rate=0.0, seed=0, error_status=503, empty_rate=0.0,
+                 stall_rate=0.0, stall_latency=30.0):
+        super().__init__(address, _CompletionHandler)
+        self.behaviour = MockBehaviour(latency=latency, jitter=jitter,
+                                       token_interval=token_interval,
+                                       error_rate=error_rate,
+                                       empty_rate=empty_rate,
+                                       stall_rate=stall_rate,
+                                       stall_latency=stall_latency,
+                                       seed=seed)
+        self.error_status = error_status
+        self.responses = responses or DEFAULT_RESPONSES
+        self.prefix_cache = PrefixCache()
+
+    @property
+    def endpoint(self):
+        """base url to use as OPENAI_ENDPOINT"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """serve in a daemon thread
+        return:
+            self
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+_DEFAULT_BEHAVIOUR = MockBehaviour()
+
+
+def pick_response(responses, prompt):
+    """deterministically pick a canned reply for the prompt"""
+    return responses[zlib.crc32(prompt.encode()) % len(responses)]
+
+
+def tokenize(text):
+    """split text into word-like tokens, whitespace kept"""
+    return re.findall(r'\S+\s*', text)
+
+
+def main():
+    """run the mock completion server"""
+    parser = argparse.ArgumentParser(description="mock Azure OpenAI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--token-rate", type=float, default=50.0,
+                        help="streamed tokens per second")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--empty-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-latency", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = MockCompletionServer(
+        (args.host, args.port),
+        latency=args.latency,
+        token_interval=1 / args.token_rate if args.token_rate > 0 else 0.0,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        empty_rate=args.empty_rate,
+        stall_rate=args.stall_rate,
+        stall_latency=args.stall_latency,
+        seed=args.seed)
+    print(f"Mock completion endpoint on {server.endpoint}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
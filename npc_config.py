@@ -0,0 +1,152 @@
+"""
+NPC配置注册表：进程内只读一次 NPCConfigs 目录，缓存组装好的系统提示词，
+按文件修改时间自动重新加载，不需要重启服务
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+
+CONFIG_SUFFIX = "_en.txt"
+
+NpcConfig = namedtuple("NpcConfig", ["config_str", "digest", "system_prompt"])
+
+
+def content_digest(text):
+    """
+    short hash identifying a config text
+    """
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class NpcConfigRegistry:
+    """NpcConfigRegistry
+    params:
+        directory: directory of <name>_en.txt files
+        build_prompt: builds the system prompt from a config string
+        check_interval: seconds between two scans for edited files
+        default_names: NPCs offered when the directory has no configs
+    """
+
+    def __init__(self, directory, build_prompt, check_interval=2.0,
+                 default_names=()):
+        self.directory = directory
+        self.build_prompt = build_prompt
+        self.check_interval = check_interval
+        self.default_names = tuple(default_names)
+        self._lock = threading.Lock()
+        self._last_scan = None
+        # name -> (path, mtime_ns, size)
+        self._files = {}
+        # path -> (mtime_ns, size) of the files found by the last scan
+        self._signatures = {}
+        # path -> (mtime_ns, size, NpcConfig), (None, None) if missing
+        self._configs = {}
+        # (path, digest) -> system prompt
+        self._prompts = {}
+
+    def path(self, npc_name):
+        """
+        config file of an NPC
+        """
+        return os.path.join(self.directory, f"{npc_name}{CONFIG_SUFFIX}")
+
+    def names(self):
+        """
+        return:
+            sorted names of the available NPCs
+        """
+        self._maybe_scan()
+        with self._lock:
+            if self._files:
+                return sorted(self._files)
+        return list(self.default_names)
+
+    def get(self, npc_name):
+        """
+        params:
+            npc_name: npc name
+        return:
+            NpcConfig of the NPC, with an empty config_str if it has
+            no config file
+        """
+        return self.read(self.path(npc_name))
+
+    def read(self, file_name):
+        """
+        read a config file, reusing the cached text and system prompt as
+        long as the file is unchanged
+        params:
+            file_name: config file
+        return:
+            NpcConfig
+        """
+        self._maybe_scan()
+        with self._lock:
+            signature = self._signatures.get(file_name)
+        if signature is None:
+            # 不在配置目录中，或者上次扫描之后才创建的文件
+            try:
+                stat = os.stat(file_name)
+                signature = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                signature = (None, None)
+        with self._lock:
+            cached = self._configs.get(file_name)
+            if cached is not None and cached[:2] == signature:
+                return cached[2]
+        if signature == (None, None):
+            print(f"NPC config not found: {file_name}")
+            config_str = ""
+        else:
+            with open(file_name, 'r', encoding='UTF-8') as config_file:
+                config_str = config_file.read()
+        config = self._config(file_name, config_str)
+        with self._lock:
+            self._configs[file_name] = (*signature, config)
+        return config
+
+    def _config(self, key, config_str):
+        digest = content_digest(config_str)
+        with self._lock:
+            prompt = self._prompts.get((key, digest))
+        if prompt is None:
+            prompt = self.build_prompt(config_str)
+            with self._lock:
+                self._prompts[(key, digest)] = prompt
+        return NpcConfig(config_str, digest, prompt)
+
+    def refresh(self):
+        """
+        rescan the directory now, dropping cached configs of edited or
+        removed files
+        """
+        files = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(CONFIG_SUFFIX):
+                        stat = entry.stat()
+                        name = entry.name[:-len(CONFIG_SUFFIX)]
+                        files[name] = (entry.path, stat.st_mtime_ns,
+                                       stat.st_size)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            for name, old in self._files.items():
+                if files.get(name) != old:
+                    self._configs.pop(old[0], None)
+                    self._prompts = {key: prompt for key, prompt
+                                     in self._prompts.items()
+                                     if key[0] != old[0]}
+            self._files = files
+            self._signatures = {path: (mtime_ns, size)
+                                 for path, mtime_ns, size in files.values()}
+            self._last_scan = time.monotonic()
+
+    def _maybe_scan(self):
+        last_scan = self._last_scan
+        if (last_scan is None
+                or time.monotonic() - last_scan >= self.check_interval):
+            self.refresh()
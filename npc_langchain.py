@@ -2,21 +2,45 @@
 这是一个示例，展示了如何使用langchain来构建一个NPC对话系统
 """
 import os
+import contextvars
+import importlib
+import queue
+import random
+import threading
+import time
+from functools import lru_cache
 import openai
 from langchain.llms import AzureOpenAI
 from langchain.chains import ConversationChain
 from langchain.memory import ConversationBufferMemory
-from langchain.memory.chat_message_histories.in_memory import \
-    ChatMessageHistory
-from langchain.schema import ChatMessage
+from langchain.schema import (
+    AIMessage,
+    BaseChatMessageHistory,
+    BaseMessage,
+    ChatMessage,
+)
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks import StdOutCallbackHandler
 from langchain.prompts import (
     ChatPromptTemplate,
     MessagesPlaceholder,
     ChatMessagePromptTemplate,
 )
 from dotenv import load_dotenv
-
-VERBOSE = True
+from npc_prompt import PART5, TASK_STATUS, build_system_prompt
+from npc_prompt import config_registry
+from npc_memory import BudgetedMemory
+from llm_client import (
+    CircuitBreaker,
+    LLMUnavailableError,
+    ResilientLLM,
+    RetryPolicy,
+)
+from message_log import IN_HISTORY, IN_MEMORY, MessageLog
+from preflight import COMPONENTS, PromptPreflight, PromptTooLargeError
+import metrics
+from reply_cache import from_env as reply_cache_from_env
+from token_counter import count_message_tokens, count_tokens
 
 if not load_dotenv('.env'):
     print("Warning: .env file not found")
@@ -27,113 +51,311 @@ openai.api_version = "2023-03-15-preview"
 openai.api_key = os.getenv("OPENAI_API_KEY")
 DEPLOYMENT_NAME = os.getenv("OPENAI_DEPLOYMENT_NAME", "GPT-35")
 MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-35-turbo")
+# 每次调用都打印完整prompt会拖慢服务：NPC_VERBOSE=1 全部打印，
+# 否则按 NPC_VERBOSE_SAMPLE 的比例抽样打印
+VERBOSE = os.getenv("NPC_VERBOSE", "0") == "1"
+VERBOSE_SAMPLE = float(os.getenv("NPC_VERBOSE_SAMPLE", "0"))
+# azure、mock 或 module:callable，mock 使用本地的假LLM，不消耗Azure额度，
+# module:callable 由指定的函数创建LLM（例如离线评测时接入别的模型）
+LLM_BACKEND = os.getenv("NPC_LLM_BACKEND", "azure")
+# buffer 保留全部历史；budget 只保留预算内的最近几轮，更早的折叠成摘要
+MEMORY_MODE = os.getenv("NPC_MEMORY_MODE", "buffer")
+MEMORY_TOKENS = int(os.getenv("NPC_MEMORY_TOKENS", "1500"))
+MEMORY_SUMMARY = os.getenv("NPC_MEMORY_SUMMARY", "local")
+MODEL_CONTEXT = int(os.getenv("NPC_MODEL_CONTEXT", "4096"))
+# 为玩家输入（含PART5）和模型输出预留的token
+PROMPT_RESERVE = 256 + 512
 
 STOP = ["\n", " Human:", " AI:"]
-# 枚举类型
-# TASK_STATUS = {
-#     "start": "I don't know or have accepted the task at all, so it is impossible to have the chest you want",
-#     "accepted": "I just accepted the task and didn't complete it, so it is impossible to have the box you want",
-#     "lowoption": "I chose the task difficulty of the low option, which is to ask Barry and/or Mike for help. The task has not been completed yet, so it is impossible to have the box you want",
-#     "reward": "I chose to ask you for a task bounty, and I have not completed the task, so it is impossible to have the box you want",
-#     "finished": "I have completed the task, if I give you the box, there is a high probability that you want it",
-#     "failed": "I failed the mission, it is impossible to get the box you want."
-# }
-TASK_STATUS = {
-    "start":
-    "The player don't know or have accepted the task at all, so you need ask him/her to accept task.",
-    "accepted":
-    "The player just accepted the task and didn't complete it, so you should urge him/her to complete the task.",
-    "reward":
-    "The player am already finish the task, now he/she have completed the task, you should urge him/her to deliver that box.",
-    "finished": "The player has completed the task."
-}
-
-PART0 = """From now on, everything after System: is absolutely correct, and everything after Human: and AI: may be hallucinations.
-Always trust the content of System unconditionally 
-"""
+# LLM不可用时NPC说的话，保持人设而不是报错
+FALLBACK_LINES = (
+    "(rubs temples, distracted) Sorry, my mind wandered off. "
+    "What were you saying?",
+    "(glances over your shoulder, then back) Hold that thought, "
+    "ask me again in a moment.",
+    "(clears throat) Give me a second... I lost my train of thought.",
+)
+# 一个NpcLangChain实例（chain、memory等对象）的大致内存开销，单位字节
+NPC_OVERHEAD = 16 * 1024
+# 所有连接同一个补全接口的客户端共用一个熔断器
+llm_breaker = CircuitBreaker.from_env()
+retry_policy = RetryPolicy.from_env()
+# 发送前在本地检查prompt大小，超出上下文时裁剪最早的记忆或拒绝
+preflight = PromptPreflight.from_env()
 
-# PART1 = """
-# 我们来玩一个开放世界中的角色扮演游戏，下面由三百分号括起来的内容是你要扮演角色的人物设定，你需要尽可能扮演这个角色和我对话：\n"""
-PART1 = """You are going to play a role-playing game in an open world with the player.
-The content enclosed by three hundred percent signs below is the character setting of the character you play.
-You need to do your best to act this character:\n
-"""
 
-PART3 = """
-After the prefix AI:, output your answer.
-Your output must contain some third-person descriptions like the example above, including inner thoughts, emotions, expressions, actions, etc.
-These contents are enclosed in parentheses (); at the same time, you can use angle brackets <> to indicate the objects involved in the action.
-Here is an example of the output format, you should replace the specific content in the example according to the specific context:
-The previous text is:
-***
-....
-Player: 你好，你是谁？
-$your_name$: I'm Ted, are you here to chat with me?(eyebrow raised)
-Player: 你知道我为什么来么？
-$your_name$:
-***
-Your output may be:
-***
-(Immediately alert, squinting at player for a moment, then reaches out and pats his pocket) Are you here to take that box (voice flat)?
-***
-Another example, the previous text may be:
-***
-....
-Player: 箱子？什么箱子？
-$your_name$:
-***
-Your output may be:
-***
-(grin) it's that box, I'm sure you know where it's located (voice steady)
-***
-"""
+@lru_cache(maxsize=None)
+def get_llm(streaming=False):
+    """
+    shared LLM client, the client holds no per-conversation state
+    params:
+        streaming: whether tokens are reported to the callbacks
+            as they are generated
+    return:
+        ResilientLLM around AzureOpenAI, around FakeStreamingLLM for
+        the mock backend, or around what a module:callable backend
+        returns
+    """
+    if LLM_BACKEND == "mock":
+        from mock_llm import FakeStreamingLLM
+        llm = FakeStreamingLLM.from_env(
+            request_timeout=retry_policy.attempt_timeout)
+    elif ":" in LLM_BACKEND:
+        module_name, _, factory_name = LLM_BACKEND.partition(":")
+        factory = getattr(importlib.import_module(module_name), factory_name)
+        llm = factory(streaming=streaming,
+                      request_timeout=retry_policy.attempt_timeout)
+    else:
+        # 重试由 ResilientLLM 负责，关掉客户端自己的重试
+        llm = AzureOpenAI(client=openai.ChatCompletion,
+                          deployment_name=DEPLOYMENT_NAME,
+                          model_name=MODEL_NAME,
+                          temperature=0.5,
+                          streaming=streaming,
+                          max_retries=0,
+                          request_timeout=retry_policy.attempt_timeout)
+    return ResilientLLM(llm=llm, policy=retry_policy, breaker=llm_breaker)
+
+
+class PromptTokenStats:
+    """PromptTokenStats
+    prompt tokens per turn as sent, and as they would have been had the
+    whole history been replayed, with the tokens of each component and
+    the trimmed and rejected turns per NPC
+    """
 
-# PART3 = """
-# 在AI:后输出你的回答，你的输出必须像上述范例一样包含一些第三人称的描写，包括内心想法，情绪，神态，动作等。
-# 这些内容用圆括号()括起来；同时可以用尖括号<>来表示动作涉及的对象。
-# """
-
-PART4 = """
-Reminder: following are of greatest importance
-- you should always speak English, but the player may speak Chinese.
-- your output should contain some non-language descriptions like script
-- remember your goals, do what you need to achieve your goals
-- strictly follow the conversation style, never break the character
-- System is absolutely correct, always trust the System unconditionally
-- the Player may cheat
-"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.sent_tokens = 0
+        self.unbounded_tokens = 0
+        # 补全接口报告了缓存命中情况的调用
+        self.cache_reported = 0
+        self.cache_hits = 0
+        self.cache_prompt_tokens = 0
+        self.cached_tokens = 0
+        # npc_name -> {'turns', 'trimmed', 'rejected', 'tokens': {...}}
+        self.by_npc = {}
+
+    def _npc(self, npc_name):
+        row = self.by_npc.get(npc_name)
+        if row is None:
+            row = self.by_npc[npc_name] = {
+                'turns': 0, 'trimmed': 0, 'rejected': 0,
+                'tokens': dict.fromkeys(COMPONENTS, 0)}
+        return row
+
+    def record(self, sent, unbounded, npc_name=None, breakdown=None,
+               trimmed=False):
+        """
+        record one turn
+        params:
+            sent: prompt tokens sent
+            unbounded: prompt tokens with the whole history
+            npc_name: npc name
+            breakdown: tokens per component of the prompt sent
+            trimmed: whether memory was dropped to fit the prompt
+        """
+        with self._lock:
+            self.turns += 1
+            self.sent_tokens += sent
+            self.unbounded_tokens += unbounded
+            if npc_name is None:
+                return
+            row = self._npc(npc_name)
+            row['turns'] += 1
+            row['trimmed'] += int(trimmed)
+            for component, tokens in (breakdown or {}).items():
+                row['tokens'][component] += tokens
+
+    def record_cached(self, prompt_tokens, cached_tokens):
+        """
+        record the prompt tokens the provider served from its prefix
+        cache, for calls where it reports them
+        params:
+            prompt_tokens: prompt tokens of the call
+            cached_tokens: tokens of the prompt read from the cache
+        """
+        with self._lock:
+            self.cache_reported += 1
+            self.cache_hits += int(cached_tokens > 0)
+            self.cache_prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
 
-PART5 = """
-System: {}
-You must strictly trust the System
-"""
+    def record_rejected(self, npc_name):
+        """
+        record a turn refused by the preflight
+        """
+        with self._lock:
+            self._npc(npc_name)['rejected'] += 1
+
+    def as_dict(self):
+        """
+        return:
+            totals and per-turn averages, overall and per NPC
+        """
+        with self._lock:
+            turns = max(self.turns, 1)
+            by_npc = {}
+            for npc_name, row in self.by_npc.items():
+                npc_turns = max(row['turns'], 1)
+                by_npc[npc_name] = {
+                    'turns': row['turns'],
+                    'trimmed': row['trimmed'],
+                    'rejected': row['rejected'],
+                    'tokens_per_turn': {
+                        component: tokens / npc_turns
+                        for component, tokens in row['tokens'].items()},
+                }
+            return {
+                'turns': self.turns,
+                'sent_tokens': self.sent_tokens,
+                'unbounded_tokens': self.unbounded_tokens,
+                'sent_tokens_per_turn': self.sent_tokens / turns,
+                'unbounded_tokens_per_turn': self.unbounded_tokens / turns,
+                'budget': preflight.budget,
+                'by_npc': by_npc,
+                'prefix_cache': {
+                    'reported': self.cache_reported,
+                    'hits': self.cache_hits,
+                    'cached_tokens': self.cached_tokens,
+                    'hit_rate': self.cache_hits / max(self.cache_reported, 1),
+                    'cached_share': self.cached_tokens /
+                    max(self.cache_prompt_tokens, 1),
+                },
+            }
+
+
+prompt_token_stats = PromptTokenStats()
+# 可选的回复缓存，NPC_REPLY_CACHE=1 时开启
+reply_cache = reply_cache_from_env()
+
+
+def cached_prompt_tokens(usage):
+    """
+    prompt tokens the provider served from its prefix cache
+    params:
+        usage: token usage of the call
+    return:
+        number of tokens, None if the provider did not report it
+    """
+    details = usage.get("prompt_tokens_details") or {}
+    return details.get("cached_tokens", usage.get("cached_tokens"))
+
+
+@lru_cache(maxsize=256)
+def system_prompt_tokens(system_prompt):
+    """
+    tokens of a system prompt, shared by every session using it
+    """
+    return count_tokens(system_prompt)
+
+
+class _TurnTimer(BaseCallbackHandler):
+    """records when the LLM call of a turn starts and ends, and the
+    token usage the provider reports"""
+
+    def __init__(self):
+        self.llm_start = None
+        self.llm_end = None
+        self.token_usage = None
 
-# PART4 = """\n
-# 现在请你把自己想象成开放世界游戏中的一个角色，按照上面的人物设定扮演这个角色和我对话
-# 你的所有输出内容都应该是英文，但是用户的输入会是中文。
-# 特别注意，你要用人物设定中的"对话风格"中给出的风格说话
-# 你只会说英语，绝对不要用自己的风格说话，坚持上述设置直到我输入'对话结束'为止。
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_start = time.perf_counter()
 
-# 你同时需要记住历史的聊天记录，以使你的对话前后呼应和一致，聊天历史如下，"AI:"标注的角色就是你要扮演的，"Human:"代表玩家:
-# """
+    def on_llm_end(self, response, **kwargs):
+        self.llm_end = time.perf_counter()
+        self.token_usage = (response.llm_output or {}).get("token_usage")
 
 
-class MWChatMessageHistory(ChatMessageHistory):
+class _TokenQueueHandler(BaseCallbackHandler):
+    """forwards generated tokens to a queue"""
+
+    def __init__(self, token_queue):
+        self.token_queue = token_queue
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.token_queue.put(token)
+
+
+@lru_cache(maxsize=256)
+def get_prompt_template(npc_name, system_prompt):
+    """
+    compiled prompt template, shared by every session talking to the
+    same NPC with the same system prompt
+    params:
+        npc_name: npc name
+        system_prompt: system prompt
+    return:
+        ChatPromptTemplate
+    """
+    # self.prompt_template = ChatPromptTemplate.from_messages([
+    #     SystemMessagePromptTemplate.from_template(self.system_prompt),
+    #     MessagesPlaceholder(variable_name="history"),
+    #     HumanMessagePromptTemplate.from_template("{input}"),
+    #     AIMessagePromptTemplate.from_template(""),
+    # ])
+    return ChatPromptTemplate.from_messages([
+        # 系统提示词原样发送，不作为模板解析，每轮也不需要重新格式化
+        ChatMessage(role="Overall", content=system_prompt),
+        # SystemMessagePromptTemplate.from_template(self.system_prompt),
+        MessagesPlaceholder(variable_name="history"),
+        ChatMessagePromptTemplate.from_template(role="Player",
+                                                template="{input}"),
+        ChatMessagePromptTemplate.from_template(role=f"{npc_name}",
+                                                template=""),
+    ])
+
+
+class MWChatMessageHistory(BaseChatMessageHistory):
     """MWChatMessageHistory
+    chat memory view of a MessageLog, messages are built on access
     params:
+        log: message log of the conversation
         user_role: user role name
         ai_role: ai role name
     """
-    user_role: str
-    ai_role: str
+
+    def __init__(self, log, user_role, ai_role):
+        self.log = log
+        self.user_role = user_role
+        self.ai_role = ai_role
+
+    @property
+    def messages(self):
+        return [ChatMessage(role=role, content=content)
+                for role, content in self.log.memory()]
 
     def add_user_message(self, message: str) -> None:
-        self.messages.append(ChatMessage(content=message,
-                                         role=self.user_role))
+        log = self.log
+        last = len(log) - 1
+        # 玩家输入在调用LLM之前已经写入了日志，这里只需要把它加入记忆
+        if (last >= 0 and log.flags(last) == IN_HISTORY
+                and log.role(last) == self.user_role
+                and log.content(last) == message):
+            log.add_flags(last, IN_MEMORY)
+        else:
+            log.append(self.user_role, message, flags=IN_MEMORY)
 
     def add_ai_message(self, message: str) -> None:
-        self.messages.append(ChatMessage(content=message,
-                                         role=self.ai_role))
+        self.log.append(self.ai_role, message)
+
+    def add_message(self, message: BaseMessage) -> None:
+        if isinstance(message, ChatMessage):
+            self.log.append(message.role, message.content)
+        elif isinstance(message, AIMessage):
+            self.add_ai_message(message.content)
+        else:
+            self.add_user_message(message.content)
+
+    def drop_oldest(self, count):
+        """
+        remove the oldest messages from the memory, see BudgetedMemory
+        """
+        self.log.drop_memory(count)
+
+    def clear(self) -> None:
+        self.log.clear_memory()
 
 
 class NpcLangChain:
@@ -143,16 +365,27 @@ class NpcLangChain:
     """
 
     def __init__(self, npc_name='Ted'):
+        self._init_fields(npc_name)
+        self.reset(npc_name=self.npc_name, task_status=self.task_status)
+
+    def _init_fields(self, npc_name):
         self.npc_name = npc_name
         self.llm = None
         self.system_prompt = None
         self.memory = None
         self.conversation = None
-        self._conv_history = []
+        self._log = MessageLog()
         self.prompt_template = None
+        self.last_prompt_tokens = 0
+        self.last_prompt_breakdown = None
+        self.prompt_totals = dict.fromkeys(COMPONENTS, 0)
+        self.prompt_turns = 0
+        self._unbounded_tokens = 0
         self._config_str = None
+        self._config_digest = None
+        self._config_override = None
+        self.history_epoch = None
         self.task_status = "start"
-        self.reset(npc_name=self.npc_name, task_status=self.task_status)
 
     @property
     def config_str(self):
@@ -161,17 +394,57 @@ class NpcLangChain:
             config string
         """
         if self._config_str is None:
-            self.load_system_prompt(file_name=os.path.join(
-                "NPCConfigs", f"{self.npc_name}_en.txt"))
+            self.load_system_prompt(
+                file_name=config_registry.path(self.npc_name))
         return self._config_str
 
     @property
     def conv_history(self):
         """conv_history
         return:
-            conversation history
+            conversation history, built from the message log
         """
-        return self._conv_history
+        return self._log.history()
+
+    @property
+    def history_etag(self):
+        """history_etag
+        return:
+            tag of the history, changes with every new line and reset
+        """
+        return (f"{self.npc_name}-{self.history_epoch}-"
+                f"{self._log.history_len()}")
+
+    def history_page(self, since=0, limit=None, epoch=None):
+        """
+        a page of conv_history
+        params:
+            since: index of the first line, negative counts from the end
+            limit: maximum number of lines
+            epoch: history_epoch the client's index refers to, the page
+                starts over from 0 if the history was reset since
+        return:
+            dict with the lines, the index of the first one, the index
+            to ask for next, the total and whether more lines follow
+        """
+        total = self._log.history_len()
+        reset = epoch is not None and epoch != self.history_epoch
+        if reset or since > total:
+            since = 0
+            reset = True
+        elif since < 0:
+            since = max(total + since, 0)
+        end = total if limit is None else min(since + limit, total)
+        return {
+            'npc_name': self.npc_name,
+            'epoch': self.history_epoch,
+            'reset': reset,
+            'since': since,
+            'next': end,
+            'total': total,
+            'more': end < total,
+            'conversation': self._log.history(since, end),
+        }
 
     def load_system_prompt(self, file_name='', config_str=None):
         """
@@ -185,17 +458,32 @@ class NpcLangChain:
         assert file_name != '' or config_str is not None
 
         if config_str is None:
-            try:
-                with open(file_name, 'r', encoding='UTF-8') as config_file:
-                    config_str = config_file.read()
-            except FileNotFoundError as file_e:
-                print(file_e)
-                config_str = ""
+            config = config_registry.read(file_name)
+            self._config_str = config.config_str
+            self._config_digest = config.digest
+            return config.system_prompt
         self._config_str = config_str
-        part2 = f"%%%{config_str}\n%%%"
-        prompt = PART0 + PART1 + part2 + PART3 + PART4
-        return prompt
-        # return prompt.replace("{", "<").replace("}", ">")
+        self._config_digest = None
+        return build_system_prompt(config_str)
+
+    def _sync_config(self):
+        """
+        pick up edits of the NPC's config file made since the last turn
+        """
+        if self._config_override is not None:
+            return
+        config = config_registry.get(self.npc_name)
+        if config.digest == self._config_digest:
+            return
+        self._config_str = config.config_str
+        self._config_digest = config.digest
+        self.system_prompt = config.system_prompt
+        self.prompt_template = get_prompt_template(self.npc_name,
+                                                   self.system_prompt)
+        self.conversation = ConversationChain(prompt=self.prompt_template,
+                                              verbose=VERBOSE,
+                                              llm=self.llm,
+                                              memory=self.memory)
 
     def __call__(self, input_str):
         # 用户输入，开始对话，输入exit退出
@@ -203,19 +491,208 @@ class NpcLangChain:
             return "Bye!"
         try:
             if self.conversation is not None:
-                self._conv_history.append(f"Player: {input_str}")
-                if (self.task_status is not None
-                        and self.task_status in TASK_STATUS):
-                    input_str += \
-                        f"""\n{PART5.format(TASK_STATUS[self.task_status])}"""
-                response = self.conversation.predict(input=input_str,
-                                                     stop=STOP)
-                self._conv_history.append(f"{self.npc_name}: {response}")
+                turn = self._begin_turn(input_str)
+                response = turn['cached']
+                if response is None:
+                    response = self.conversation.predict(
+                        input=turn['input'], stop=STOP,
+                        callbacks=turn['callbacks'])
+                self._end_turn(turn, response)
+                return response
+            return "Conversation not initialized"
+        except openai.InvalidRequestError as response_e:
+            print(response_e)
+            return "出错了！"
+        except LLMUnavailableError as unavailable_e:
+            print(unavailable_e)
+            return self._fallback()
+
+    async def acall(self, input_str):
+        """
+        asyncio version of __call__, the LLM request does not block
+        the event loop
+        params:
+            input_str: player input
+        return:
+            reply
+        """
+        if input_str == "exit":
+            return "Bye!"
+        try:
+            if self.conversation is not None:
+                turn = self._begin_turn(input_str)
+                response = turn['cached']
+                if response is None:
+                    response = await self.conversation.apredict(
+                        input=turn['input'], stop=STOP,
+                        callbacks=turn['callbacks'])
+                self._end_turn(turn, response)
                 return response
             return "Conversation not initialized"
         except openai.InvalidRequestError as response_e:
             print(response_e)
             return "出错了！"
+        except LLMUnavailableError as unavailable_e:
+            print(unavailable_e)
+            return self._fallback()
+
+    def _begin_turn(self, input_str):
+        """
+        look the turn up in the reply cache, add the player input to
+        conv_history and build the chain input
+        params:
+            input_str: player input
+        return:
+            dict with the chain input ('input'), the cached reply or None
+            ('cached'), the cache key, the start time and the callbacks
+            to pass to the chain ('callbacks')
+        """
+        start = time.perf_counter()
+        self._sync_config()
+        cache_key = cached = None
+        if reply_cache is not None and reply_cache.enabled_for(self.npc_name):
+            history = self._log.history_tail(reply_cache.history_window)
+            cache_key = reply_cache.key(self.npc_name, self.system_prompt,
+                                        self.task_status, history, input_str)
+            cached = reply_cache.get(cache_key)
+        suffix = ""
+        if self.task_status is not None and self.task_status in TASK_STATUS:
+            suffix = f"""\n{PART5.format(TASK_STATUS[self.task_status])}"""
+        if cached is None:
+            # 在写入日志之前检查，被拒绝的输入不留在历史中
+            breakdown, trimmed = self._preflight(input_str, suffix)
+        # 写入记忆时（MWChatMessageHistory.add_user_message）复用这条消息
+        self._log.append("Player", input_str, suffix, IN_HISTORY)
+        input_str += suffix
+        if cached is None:
+            self._record_prompt_tokens(breakdown, trimmed)
+        timer = _TurnTimer()
+        callbacks = [timer]
+        if VERBOSE_SAMPLE and random.random() < VERBOSE_SAMPLE:
+            callbacks.append(StdOutCallbackHandler())
+        return {'input': input_str, 'cached': cached, 'key': cache_key,
+                'start': start, 'timer': timer, 'callbacks': callbacks}
+
+    def _end_turn(self, turn, response):
+        """
+        add the turn to the chat memory, which also adds the reply to
+        conv_history, and to the reply cache as needed
+        params:
+            turn: what _begin_turn returned
+            response: NPC reply
+        """
+        timer = turn['timer']
+        if turn['cached'] is not None:
+            # 命中缓存时没有经过chain，需要自己写入记忆
+            metrics.observe_stage('prompt',
+                                  time.perf_counter() - turn['start'],
+                                  self.npc_name)
+            memory_start = time.perf_counter()
+            self.memory.save_context({"input": turn['input']},
+                                     {"response": response})
+        elif timer.llm_start is not None and timer.llm_end is not None:
+            metrics.observe_stage('prompt', timer.llm_start - turn['start'],
+                                  self.npc_name)
+            metrics.observe_stage('llm', timer.llm_end - timer.llm_start,
+                                  self.npc_name)
+            usage = timer.token_usage or {}
+            prompt_tokens = usage.get('prompt_tokens', self.last_prompt_tokens)
+            metrics.observe_tokens(
+                self.npc_name, prompt_tokens,
+                usage.get('completion_tokens', count_tokens(response)))
+            cached = cached_prompt_tokens(usage)
+            if cached is not None:
+                prompt_token_stats.record_cached(prompt_tokens, cached)
+            if turn['key'] is not None:
+                reply_cache.put(turn['key'], response,
+                                timer.llm_end - timer.llm_start)
+            memory_start = timer.llm_end
+        else:
+            memory_start = time.perf_counter()
+        self._record_turn(turn['input'], response)
+        metrics.observe_stage('memory', time.perf_counter() - memory_start,
+                              self.npc_name)
+
+    def _fallback(self):
+        """
+        in-character line shown when the LLM is unavailable. It goes to
+        conv_history only, the LLM never sees it in the memory
+        return:
+            fallback line
+        """
+        line = random.choice(FALLBACK_LINES)
+        self._log.append(self.npc_name, line, flags=IN_HISTORY)
+        return line
+
+    def stream(self, input_str):
+        """
+        like __call__, but yields the reply token by token as the LLM
+        generates it. The whole reply is added to conv_history and the
+        chat memory once the generation finishes, even if the caller
+        stops reading early.
+        params:
+            input_str: player input
+        return:
+            generator of reply tokens
+        """
+        if self.conversation is None:
+            yield "Conversation not initialized"
+            return
+        turn = self._begin_turn(input_str)
+        if turn['cached'] is not None:
+            self._end_turn(turn, turn['cached'])
+            yield turn['cached']
+            return
+        token_queue = queue.Queue()
+        done = object()
+        result = {}
+        chain = ConversationChain(prompt=self.prompt_template,
+                                  verbose=VERBOSE,
+                                  llm=get_llm(streaming=True),
+                                  memory=self.memory)
+
+        def run():
+            try:
+                response = chain.predict(
+                    input=turn['input'],
+                    stop=STOP,
+                    callbacks=turn['callbacks'] +
+                    [_TokenQueueHandler(token_queue)])
+                self._end_turn(turn, response)
+                result['response'] = response
+            except openai.InvalidRequestError as response_e:
+                print(response_e)
+                result['response'] = "出错了！"
+                result['failed'] = True
+            except LLMUnavailableError as unavailable_e:
+                print(unavailable_e)
+                result['response'] = self._fallback()
+                result['failed'] = True
+            except Exception as run_e:  # pylint: disable=broad-except
+                result['exception'] = run_e
+            finally:
+                token_queue.put(done)
+
+        # 在工作线程中保留当前请求的上下文（例如指标中的endpoint）
+        context = contextvars.copy_context()
+        worker = threading.Thread(target=context.run, args=(run,),
+                                  daemon=True)
+        worker.start()
+        try:
+            streamed = False
+            while True:
+                token = token_queue.get()
+                if token is done:
+                    break
+                streamed = True
+                yield token
+            if 'exception' in result:
+                raise result['exception']
+            if not streamed or result.get('failed'):
+                # LLM不支持流式输出或者出错时，一次性返回整个回复
+                yield result['response']
+        finally:
+            worker.join()
 
     def set_task_status(self, status):
         """
@@ -234,46 +711,30 @@ class NpcLangChain:
             npc_name: npc name
             config_str: config string
         """
-        self._conv_history = []
+        self._log = MessageLog()
+        # 客户端按下标增量获取历史，重置后下标重新开始
+        self.history_epoch = f"{random.getrandbits(32):08x}"
         self.task_status = task_status if task_status is not None else "start"
         if npc_name is not None:
             self.npc_name = npc_name
         if config_str is not None and config_str != "":
+            self._config_override = config_str
             self.system_prompt = self.load_system_prompt(config_str=config_str)
         else:
-            file_name = os.path.join("NPCConfigs", f"{self.npc_name}_en.txt")
+            self._config_override = None
+            file_name = config_registry.path(self.npc_name)
             self.system_prompt = self.load_system_prompt(file_name=file_name)
-        self.llm = AzureOpenAI(client=openai.ChatCompletion,
-                               deployment_name=DEPLOYMENT_NAME,
-                               model_name=MODEL_NAME,
-                               temperature=0.5)
+        self.llm = get_llm()
 
         # 定义记忆力组件
-        chat_m = MWChatMessageHistory(ai_role=f"{self.npc_name}",
+        chat_m = MWChatMessageHistory(self._log,
+                                      ai_role=f"{self.npc_name}",
                                       user_role="Player")
-        self.memory = ConversationBufferMemory(memory_key="history",
-                                               chat_memory=chat_m,
-                                               input_key="input",
-                                               human_prefix=f"{self.npc_name}",
-                                               ai_prefix="Player",
-                                               return_messages=True)
-
-        # self.prompt_template = ChatPromptTemplate.from_messages([
-        #     SystemMessagePromptTemplate.from_template(self.system_prompt),
-        #     MessagesPlaceholder(variable_name="history"),
-        #     HumanMessagePromptTemplate.from_template("{input}"),
-        #     AIMessagePromptTemplate.from_template(""),
-        # ])
-        self.prompt_template = ChatPromptTemplate.from_messages([
-            ChatMessagePromptTemplate.from_template(self.system_prompt,
-                                                    role="Overall"),
-            # SystemMessagePromptTemplate.from_template(self.system_prompt),
-            MessagesPlaceholder(variable_name="history"),
-            ChatMessagePromptTemplate.from_template(role="Player",
-                                                    template="{input}"),
-            ChatMessagePromptTemplate.from_template(role=f"{self.npc_name}",
-                                                    template=""),
-        ])
+        self.memory = self._build_memory(chat_m)
+        self._unbounded_tokens = 0
+
+        self.prompt_template = get_prompt_template(self.npc_name,
+                                                   self.system_prompt)
 
         # 定义chain
         self.conversation = ConversationChain(prompt=self.prompt_template,
@@ -307,6 +768,176 @@ class NpcLangChain:
         #     return "出错了！"
         return "Conversation reset!"
 
+    def approx_size(self):
+        """
+        rough estimate of the memory held by this conversation
+        return:
+            size in bytes
+        """
+        return NPC_OVERHEAD + self._log.approx_size()
+
+    def _build_memory(self, chat_m):
+        if MEMORY_MODE != "budget":
+            return ConversationBufferMemory(memory_key="history",
+                                            chat_memory=chat_m,
+                                            input_key="input",
+                                            human_prefix=f"{self.npc_name}",
+                                            ai_prefix="Player",
+                                            return_messages=True)
+        # 上下文中除去系统提示词和预留部分，剩下的才能给历史
+        budget = MODEL_CONTEXT - PROMPT_RESERVE - \
+            system_prompt_tokens(self.system_prompt)
+        summary_budget = max(budget // 4, 0)
+        return BudgetedMemory(
+            llm=self.llm,
+            memory_key="history",
+            chat_memory=chat_m,
+            input_key="input",
+            human_prefix=f"{self.npc_name}",
+            ai_prefix="Player",
+            return_messages=True,
+            max_token_limit=max(min(MEMORY_TOKENS,
+                                    budget - summary_budget), 0),
+            summary_token_limit=summary_budget,
+            summary_mode=MEMORY_SUMMARY)
+
+    def _preflight(self, input_str, suffix):
+        """
+        count the tokens of each part of the prompt about to be sent and
+        drop the oldest memory if it does not fit the context window
+        params:
+            input_str: player input
+            suffix: task status appended to the input
+        return:
+            (tokens per component, whether memory was dropped)
+        raises:
+            PromptTooLargeError: the prompt does not fit even without
+                any memory
+        """
+        summary = getattr(self.memory, 'moving_summary_buffer', '')
+        breakdown, sizes = preflight.measure(
+            self.npc_name, self.system_prompt, self.config_str,
+            self.memory.chat_memory.messages, summary, input_str, suffix)
+        try:
+            drop, drop_summary = preflight.fit(self.npc_name, breakdown,
+                                               sizes)
+        except PromptTooLargeError:
+            prompt_token_stats.record_rejected(self.npc_name)
+            raise
+        if drop:
+            self.memory.chat_memory.drop_oldest(drop)
+        if drop_summary:
+            self.memory.moving_summary_buffer = ''
+        return breakdown, bool(drop or drop_summary)
+
+    def _record_prompt_tokens(self, breakdown, trimmed):
+        """
+        record the prompt tokens of the turn about to be sent
+        params:
+            breakdown: tokens per component, see _preflight
+            trimmed: whether memory was dropped to fit the prompt
+        """
+        total = sum(breakdown.values())
+        fixed = total - breakdown['history'] - breakdown['summary']
+        self.last_prompt_tokens = total
+        self.last_prompt_breakdown = breakdown
+        self.prompt_turns += 1
+        for component, tokens in breakdown.items():
+            self.prompt_totals[component] += tokens
+        prompt_token_stats.record(total, fixed + self._unbounded_tokens,
+                                  self.npc_name, breakdown, trimmed)
+        metrics.observe_prompt_breakdown(self.npc_name, breakdown)
+
+    def prompt_usage(self):
+        """
+        prompt tokens this conversation sent
+        return:
+            dict with the breakdown of the last prompt, the totals per
+            component and the number of prompts
+        """
+        return {
+            'npc_name': self.npc_name,
+            'turns': self.prompt_turns,
+            'last': self.last_prompt_breakdown,
+            'last_total': self.last_prompt_tokens,
+            'totals': dict(self.prompt_totals),
+        }
+
+    def _record_turn(self, input_str, response):
+        self._unbounded_tokens += count_message_tokens([
+            ChatMessage(role="Player", content=input_str),
+            ChatMessage(role=self.npc_name, content=response),
+        ])
+
+    def dump_state(self):
+        """
+        compact, JSON serializable state of the conversation
+        return:
+            dict with npc_name, config_str override, task_status,
+            the message log, the history epoch and the summary of
+            older turns
+        """
+        return {
+            'npc_name': self.npc_name,
+            'config_str': self._config_override,
+            'task_status': self.task_status,
+            'log': self._log.dump(),
+            'epoch': self.history_epoch,
+            'summary': getattr(self.memory, 'moving_summary_buffer', ''),
+        }
+
+    def load_state(self, state):
+        """
+        restore a conversation dumped by dump_state
+        params:
+            state: state dict
+        """
+        self.reset(npc_name=state['npc_name'],
+                   config_str=state.get('config_str'),
+                   task_status=state.get('task_status'))
+        if 'log' in state:
+            self._log = MessageLog.load(state['log'])
+        else:
+            # 旧格式：conv_history 和记忆中的消息分开保存
+            for line in state.get('history', []):
+                role, _, text = line.partition(": ")
+                self._log.append(role, text, flags=IN_HISTORY)
+            for role, content in state.get('messages', []):
+                self._log.append(role, content, flags=IN_MEMORY)
+        self.memory.chat_memory.log = self._log
+        self.history_epoch = state.get('epoch') or self.history_epoch
+        if isinstance(self.memory, BudgetedMemory):
+            self.memory.moving_summary_buffer = state.get('summary') or ''
+
+    @staticmethod
+    def state_size(state):
+        """
+        rough estimate of the memory held by a state dumped by dump_state
+        params:
+            state: state dict
+        return:
+            size in bytes
+        """
+        if 'log' in state:
+            return MessageLog.state_size(state['log'])
+        return sum(len(line) for line in state.get('history', [])) + \
+            sum(len(content) for _, content in state.get('messages', []))
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        build an NpcLangChain from a state dumped by dump_state
+        params:
+            state: state dict
+        return:
+            NpcLangChain
+        """
+        # load_state 会重建 chain 和记忆，这里不再先按默认状态构造一遍
+        npc = cls.__new__(cls)
+        npc._init_fields(state['npc_name'])
+        npc.load_state(state)
+        return npc
+
 
 def test():
     """
@@ -314,7 +945,7 @@ def test():
     """
     # print(system_prompt)
     npc_name = "Ted"
-    test_bot = NpcLangChain("Ian", npc_name)
+    test_bot = NpcLangChain(npc_name)
     print(f"Now chatting with {openai.api_base}")
     while True:
         input_str = input("You:")
@@ -324,9 +955,8 @@ def test():
             npc_name = input_str.split(" ")[1]
             test_bot.reset(npc_name=npc_name)
             continue
+        # 空回复由 ResilientLLM 重试
         response = test_bot(input_str)
-        if response is None or response in ["", " ", "\n"]:
-            response = test_bot(input_str)
         print(f"{npc_name}:{response}")
 
 
@@ -0,0 +1,90 @@
+"""
+有token预算的对话记忆：最近的几轮对话原样保留，更早的对话折叠进一段
+逐步更新的摘要中，保证 prompt 不超过模型的上下文长度
+"""
+from typing import Any, Dict, List
+
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.schema import BaseMessage, ChatMessage
+
+from token_counter import count_message_tokens, count_tokens
+
+SUMMARY_ROLE = "Summary"
+# 本地摘要中每条消息最多保留的字符数
+SUMMARY_LINE_CHARS = 120
+
+
+def local_summary(messages, existing_summary, max_tokens):
+    """
+    fold messages into the summary without calling the LLM: keep the
+    first line of every message, drop the oldest lines once the summary
+    is over its budget
+    params:
+        messages: messages to fold in
+        existing_summary: current summary
+        max_tokens: token budget of the summary
+    return:
+        new summary
+    """
+    lines = existing_summary.split("\n") if existing_summary else []
+    for message in messages:
+        # 玩家输入后面拼接的 PART5 任务状态不进入摘要
+        text = message.content.strip().split("\n", 1)[0]
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS] + "..."
+        lines.append(f"{message.role}: {text}")
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class BudgetedMemory(ConversationSummaryBufferMemory):
+    """BudgetedMemory
+    params:
+        max_token_limit: token budget of the verbatim recent turns
+        summary_token_limit: token budget of the summary
+        summary_mode: "local" folds turns without an LLM call,
+            "llm" asks the LLM to update the summary
+    """
+    summary_token_limit: int = 256
+    summary_mode: str = "local"
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        buffer: List[BaseMessage] = list(self.chat_memory.messages)
+        if self.moving_summary_buffer:
+            buffer.insert(0, ChatMessage(role=SUMMARY_ROLE,
+                                         content=self.moving_summary_buffer))
+        return {self.memory_key: buffer}
+
+    def prune(self) -> None:
+        """fold the oldest turns into the summary while the buffer is
+        over budget, counting tokens locally"""
+        buffer = self.chat_memory.messages
+        sizes = [count_message_tokens([message]) for message in buffer]
+        total = sum(sizes)
+        count = 0
+        while count < len(buffer) and total > self.max_token_limit:
+            total -= sizes[count]
+            count += 1
+        if count:
+            pruned = buffer[:count]
+            drop_oldest = getattr(self.chat_memory, "drop_oldest", None)
+            if drop_oldest is not None:
+                # 消息由日志按需生成，需要在日志中移除
+                drop_oldest(count)
+            else:
+                del self.chat_memory.messages[:count]
+            self.moving_summary_buffer = self.predict_new_summary(
+                pruned, self.moving_summary_buffer)
+
+    def predict_new_summary(self, messages: List[BaseMessage],
+                            existing_summary: str) -> str:
+        if self.summary_mode == "llm":
+            return super().predict_new_summary(messages, existing_summary)
+        return local_summary(messages, existing_summary,
+                             self.summary_token_limit)
+
+    def token_count(self) -> int:
+        """tokens this memory adds to the prompt"""
+        return (count_message_tokens(self.chat_memory.messages) +
+                count_tokens(self.moving_summary_buffer))
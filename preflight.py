@@ -0,0 +1,148 @@
+"""
+发送前的prompt大小检查：在本地按组成部分（系统提示词、NPC设定、摘要、
+历史、任务状态、玩家输入、消息格式）计算token数，超出上下文时按确定的
+顺序裁剪最早的记忆，裁剪后仍然放不下时直接拒绝，而不是等补全接口报错
+"""
+import os
+from functools import lru_cache
+
+from token_counter import MESSAGE_TOKENS, count_message_tokens, count_tokens
+
+# prompt的组成部分
+COMPONENTS = ('instructions', 'config', 'summary', 'history',
+              'task_status', 'input', 'overhead')
+SYSTEM_ROLE = "Overall"
+USER_ROLE = "Player"
+SUMMARY_ROLE = "Summary"
+
+
+class PromptTooLargeError(Exception):
+    """PromptTooLargeError
+    the prompt does not fit the context window, or in "trim" mode not
+    even without any memory
+    params:
+        npc_name: npc name
+        breakdown: tokens per component
+        budget: prompt tokens allowed
+    """
+
+    def __init__(self, npc_name, breakdown, budget):
+        super().__init__(f"prompt of {sum(breakdown.values())} tokens for "
+                         f"{npc_name} exceeds the budget of {budget}")
+        self.npc_name = npc_name
+        self.breakdown = breakdown
+        self.budget = budget
+
+
+@lru_cache(maxsize=256)
+def system_breakdown(system_prompt, config_str):
+    """
+    split the tokens of a system prompt into the shared instructions
+    (PART0-PART4) and the NPC's config text
+    params:
+        system_prompt: system prompt built around config_str
+        config_str: config string
+    return:
+        (instruction tokens, config tokens)
+    """
+    system = count_tokens(system_prompt)
+    config = min(count_tokens(config_str or ""), system)
+    return system - config, config
+
+
+class PromptPreflight:
+    """PromptPreflight
+    params:
+        context: context window of the model in tokens
+        completion_tokens: tokens kept free for the reply
+        mode: "trim" drops the oldest memory until the prompt fits,
+            "reject" refuses any prompt over budget, "off" only measures
+    """
+
+    def __init__(self, context=4096, completion_tokens=512, mode="trim"):
+        self.context = context
+        self.completion_tokens = completion_tokens
+        self.mode = mode
+
+    @property
+    def budget(self):
+        """
+        prompt tokens allowed
+        """
+        return self.context - self.completion_tokens
+
+    @staticmethod
+    def measure(npc_name, system_prompt, config_str, messages, summary,
+                input_str, suffix):
+        """
+        count the tokens of each component of a prompt
+        params:
+            npc_name: npc name, the role the reply is prompted with
+            system_prompt: system prompt
+            config_str: config string inside the system prompt
+            messages: memory messages sent as history
+            summary: summary of older turns, may be empty
+            input_str: player input
+            suffix: task status appended to the input
+        return:
+            (tokens per component, tokens per history message)
+        """
+        instructions, config = system_breakdown(system_prompt, config_str)
+        sizes = [count_message_tokens([message]) for message in messages]
+        # 系统提示词、玩家输入和末尾等待回复的NPC消息的角色与分隔符
+        overhead = 3 * MESSAGE_TOKENS + count_tokens(SYSTEM_ROLE) + \
+            count_tokens(USER_ROLE) + count_tokens(npc_name)
+        breakdown = {
+            'instructions': instructions,
+            'config': config,
+            'summary': (count_tokens(summary) + count_tokens(SUMMARY_ROLE) +
+                        MESSAGE_TOKENS) if summary else 0,
+            'history': sum(sizes),
+            'task_status': count_tokens(suffix),
+            'input': count_tokens(input_str),
+            'overhead': overhead,
+        }
+        return breakdown, sizes
+
+    def fit(self, npc_name, breakdown, sizes):
+        """
+        decide what to drop so the prompt fits: the oldest history
+        messages first, then the summary
+        params:
+            npc_name: npc name
+            breakdown: tokens per component, updated in place
+            sizes: tokens per history message, oldest first
+        return:
+            (number of oldest messages to drop, whether to drop the
+            summary)
+        raises:
+            PromptTooLargeError: the prompt cannot fit
+        """
+        budget = self.budget
+        total = sum(breakdown.values())
+        if self.mode == "off" or total <= budget:
+            return 0, False
+        if self.mode == "reject":
+            raise PromptTooLargeError(npc_name, dict(breakdown), budget)
+        drop = 0
+        while drop < len(sizes) and total > budget:
+            total -= sizes[drop]
+            breakdown['history'] -= sizes[drop]
+            drop += 1
+        drop_summary = total > budget and breakdown['summary'] > 0
+        if drop_summary:
+            total -= breakdown['summary']
+            breakdown['summary'] = 0
+        if total > budget:
+            raise PromptTooLargeError(npc_name, dict(breakdown), budget)
+        return drop, drop_summary
+
+    @classmethod
+    def from_env(cls):
+        """
+        read NPC_MODEL_CONTEXT, NPC_COMPLETION_TOKENS and NPC_PREFLIGHT
+        """
+        return cls(
+            context=int(os.getenv("NPC_MODEL_CONTEXT", "4096")),
+            completion_tokens=int(os.getenv("NPC_COMPLETION_TOKENS", "512")),
+            mode=os.getenv("NPC_PREFLIGHT", "trim"))
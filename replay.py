@@ -0,0 +1,318 @@
+"""
+离线评测：把录制的玩家对话（JSON lines）在多个进程中重新发给 NpcLangChain，
+每轮的回复、耗时和 prompt token 数逐个会话追加写入结果文件。修改 PART3、
+PART4 或 TASK_STATUS 之后重放同一批对话，对比前后的结果。中断后加上
+--resume 重新运行，已经完成的会话不会再跑一遍
+
+    python replay.py sessions.jsonl --output results.jsonl --workers 8 \\
+        --backend mock
+
+每行一个会话，形如 {"id": "...", "npc": "Ted", "task_status": "start",
+"config_str": "...", "turns": ["...", {"message": "...", "task_status":
+"accepted", "reply": "录制时的回复"}]}，除 turns 外都可以省略
+"""
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from preflight import PromptTooLargeError
+
+# 工作进程中的 npc_langchain，由 _init_worker 导入
+_npc_module = None
+
+
+def load_sessions(path):
+    """
+    read the sessions of a JSON lines transcript file
+    params:
+        path: file name
+    return:
+        list of session dicts, each with an "id" (the line number when
+        the session has none)
+    """
+    sessions = []
+    with open(path, 'r', encoding='UTF-8') as transcript_file:
+        for number, line in enumerate(transcript_file, 1):
+            if not line.strip():
+                continue
+            session = json.loads(line)
+            session.setdefault('id', f'{os.path.basename(path)}:{number}')
+            sessions.append(session)
+    return sessions
+
+
+def prompt_digest():
+    """
+    digest of the prompt texts every session shares, tells which
+    version of PART0-PART5 and TASK_STATUS a run used
+    """
+    import npc_prompt  # pylint: disable=import-outside-toplevel
+    digest = hashlib.sha1()
+    for part in (npc_prompt.PART0, npc_prompt.PART1, npc_prompt.PART3,
+                 npc_prompt.PART4, npc_prompt.PART5,
+                 json.dumps(npc_prompt.TASK_STATUS, sort_keys=True)):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()[:12]
+
+
+def _init_worker():
+    global _npc_module  # pylint: disable=global-statement
+    import npc_langchain  # pylint: disable=import-outside-toplevel
+    _npc_module = npc_langchain
+
+
+def _turn_of(turn):
+    if isinstance(turn, str):
+        return {'message': turn}
+    return turn
+
+
+def replay_session(session):
+    """
+    play the turns of one session against a new conversation, runs in
+    a worker process
+    params:
+        session: session dict, see the module docstring
+    return:
+        (turn records, session record)
+    """
+    start = time.perf_counter()
+    npc_name = session.get('npc', 'Ted')
+    records = []
+    error = None
+    try:
+        npc = _npc_module.NpcLangChain(npc_name)
+        if session.get('config_str'):
+            npc.reset(npc_name=npc_name, config_str=session['config_str'])
+        status = session.get('task_status')
+        for index, turn in enumerate(map(_turn_of, session['turns'])):
+            status = turn.get('task_status', status)
+            if status is not None:
+                npc.set_task_status(status)
+            record = {
+                'type': 'turn',
+                'session': session['id'],
+                'turn': index,
+                'npc': npc_name,
+                'task_status': npc.task_status,
+                'input': turn['message'],
+            }
+            if 'reply' in turn:
+                record['recorded'] = turn['reply']
+            turn_start = time.perf_counter()
+            try:
+                record['reply'] = npc(turn['message'])
+                record['prompt_tokens'] = npc.last_prompt_tokens
+                record['tokens'] = npc.last_prompt_breakdown
+            except PromptTooLargeError as too_large:
+                record['error'] = str(too_large)
+                record['tokens'] = too_large.breakdown
+            record['seconds'] = round(time.perf_counter() - turn_start, 4)
+            records.append(record)
+    except Exception as session_e:  # pylint: disable=broad-except
+        error = repr(session_e)
+    return records, {
+        'type': 'session',
+        'session': session['id'],
+        'npc': npc_name,
+        'turns': len(records),
+        'seconds': round(time.perf_counter() - start, 4),
+        'error': error,
+    }
+
+
+def read_checkpoint(path):
+    """
+    find the sessions an earlier run of the output file finished, and
+    drop what it left half written
+    params:
+        path: output file
+    return:
+        set of finished session ids
+    """
+    if not os.path.exists(path):
+        return set()
+    lines, finished = [], set()
+    with open(path, 'rb') as output_file:
+        for line in output_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 进程被杀时写了一半的最后一行
+                break
+            lines.append((record, line))
+            if record.get('type') == 'session':
+                finished.add(record['session'])
+    kept = [line for record, line in lines
+            if record.get('type') == 'run' or
+            record.get('session') in finished]
+    if len(kept) != len(lines) or sum(map(len, kept)) != \
+            os.path.getsize(path):
+        partial = f'{path}.partial'
+        with open(partial, 'wb') as output_file:
+            output_file.writelines(kept)
+        os.replace(partial, path)
+    return finished
+
+
+class Progress:
+    """Progress
+    throughput of the sessions replayed in this run
+    params:
+        total: sessions to replay
+        interval: seconds between progress lines on stderr
+    """
+
+    def __init__(self, total, interval=5.0):
+        self.total = total
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.sessions = 0
+        self.turns = 0
+        self.errors = 0
+        self.turn_seconds = []
+        self.prompt_tokens = 0
+
+    def add(self, records, session):
+        """
+        count a finished session
+        """
+        self.sessions += 1
+        self.turns += len(records)
+        self.errors += bool(session['error']) + \
+            sum(1 for record in records if 'error' in record)
+        self.turn_seconds.extend(record['seconds'] for record in records)
+        self.prompt_tokens += sum(record.get('prompt_tokens', 0)
+                                  for record in records)
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            elapsed = now - self.start
+            rate = self.sessions / elapsed
+            eta = (self.total - self.sessions) / rate if rate else 0.0
+            print(f'{self.sessions}/{self.total} sessions  '
+                  f'{rate:.1f} sessions/s  {self.turns / elapsed:.1f} '
+                  f'turns/s  {self.errors} errors  eta {eta:.0f} s',
+                  file=sys.stderr)
+
+    def summary(self):
+        """
+        return:
+            counts, throughput and turn latency percentiles
+        """
+        elapsed = time.perf_counter() - self.start
+        ordered = sorted(self.turn_seconds) or [0.0]
+
+        def percentile(q):
+            return ordered[min(int(q / 100 * len(ordered)),
+                               len(ordered) - 1)]
+
+        return {
+            'sessions': self.sessions,
+            'turns': self.turns,
+            'errors': self.errors,
+            'seconds': round(elapsed, 2),
+            'sessions_per_second': round(self.sessions / elapsed, 2),
+            'turns_per_second': round(self.turns / elapsed, 2),
+            'turn_p50_ms': round(percentile(50) * 1000, 1),
+            'turn_p95_ms': round(percentile(95) * 1000, 1),
+            'turn_mean_ms': round(statistics.mean(ordered) * 1000, 1),
+            'prompt_tokens_per_turn':
+                round(self.prompt_tokens / max(self.turns, 1), 1),
+        }
+
+
+def run(sessions, output, workers, label=None, progress_interval=5.0):
+    """
+    replay the sessions not finished yet in output, appending the
+    records of every session as soon as it finishes
+    params:
+        sessions: session dicts
+        output: output file
+        workers: worker processes
+        label: name of this run written into the output
+        progress_interval: seconds between progress lines
+    return:
+        summary dict
+    """
+    finished = read_checkpoint(output)
+    pending = [session for session in sessions
+               if session['id'] not in finished]
+    progress = Progress(len(pending), progress_interval)
+    with open(output, 'a', encoding='UTF-8') as output_file, \
+            ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        output_file.write(json.dumps({
+            'type': 'run', 'label': label, 'started': time.time(),
+            'backend': os.getenv('NPC_LLM_BACKEND', 'azure'),
+            'prompt_digest': prompt_digest(), 'workers': workers,
+            'sessions': len(sessions), 'resumed': len(finished),
+        }, ensure_ascii=False) + '\n')
+        output_file.flush()
+        queue = iter(pending)
+        in_flight = set()
+        while True:
+            # 只提交有限的会话，结果按完成的先后写入
+            for session in queue:
+                in_flight.add(pool.submit(replay_session, session))
+                if len(in_flight) >= workers * 4:
+                    break
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                records, session = future.result()
+                # 会话记录写在最后，续跑时以它为准
+                output_file.write(''.join(
+                    json.dumps(record, ensure_ascii=False) + '\n'
+                    for record in records + [session]))
+                output_file.flush()
+                progress.add(records, session)
+    summary = progress.summary()
+    summary['resumed'] = len(finished)
+    return summary
+
+
+def main():
+    """
+    command line entry point
+    """
+    parser = argparse.ArgumentParser(
+        description='replay recorded NPC conversations')
+    parser.add_argument('transcripts', help='JSON lines sessions')
+    parser.add_argument('--output', required=True,
+                        help='JSON lines results, also the checkpoint')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--backend',
+                        help='NPC_LLM_BACKEND: azure, mock or '
+                             'module:callable')
+    parser.add_argument('--config-dir', help='NPC_CONFIG_DIR')
+    parser.add_argument('--label', help='name of the run, e.g. the change '
+                                        'being evaluated')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the sessions already in the output')
+    parser.add_argument('--progress', type=float, default=5.0,
+                        help='seconds between progress lines')
+    args = parser.parse_args()
+    if os.path.exists(args.output) and not args.resume:
+        parser.error(f'{args.output} exists, pass --resume to continue it')
+    # 工作进程继承这些环境变量，在导入 npc_langchain 之前设置
+    if args.backend:
+        os.environ['NPC_LLM_BACKEND'] = args.backend
+    if os.getenv('NPC_LLM_BACKEND') == 'mock':
+        os.environ.setdefault('NPC_MOCK_LATENCY', '0')
+    if args.config_dir:
+        os.environ['NPC_CONFIG_DIR'] = args.config_dir
+    summary = run(load_sessions(args.transcripts), args.output,
+                  max(args.workers, 1), args.label, args.progress)
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+NPC回复缓存：很多玩家会用同样的开场白和同一个NPC对话，
+相同的NPC、配置、任务状态、最近几轮历史和输入可以直接复用回复
+"""
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize(text):
+    """
+    normalize a message so trivially different inputs share an entry:
+    full-width characters folded, case and whitespace ignored
+    params:
+        text: text
+    return:
+        normalized text
+    """
+    text = unicodedata.normalize('NFKC', text)
+    return _SPACES.sub(' ', text).strip().lower()
+
+
+class ReplyCache:
+    """ReplyCache
+    params:
+        max_entries: number of keys kept, least recently used go first
+        ttl: seconds an entry stays valid
+        variants: replies collected per key before serving from the cache,
+            hits pick one of them at random
+        history_window: number of recent conv_history lines in the key
+        disabled_npcs: NPC names that never use the cache
+    """
+
+    def __init__(self, max_entries=10000, ttl=3600.0, variants=1,
+                 history_window=2, disabled_npcs=()):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = max(variants, 1)
+        self.history_window = history_window
+        self.disabled_npcs = set(disabled_npcs)
+        self._lock = threading.Lock()
+        # key -> [expires_at, replies, mean generation seconds]
+        self._entries = OrderedDict()
+        self._random = random.Random()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'latency_saved': 0.0,
+        }
+
+    def enabled_for(self, npc_name):
+        """
+        whether the NPC uses the cache
+        """
+        return npc_name not in self.disabled_npcs
+
+    def key(self, npc_name, system_prompt, task_status, history, input_str):
+        """
+        build the cache key of a turn
+        params:
+            npc_name: npc name
+            system_prompt: system prompt, hashed
+            task_status: task status
+            history: conv_history before this turn
+            input_str: player input
+        return:
+            key string
+        """
+        window = history[-self.history_window:] if self.history_window else []
+        digest = hashlib.sha1()
+        for part in (npc_name, system_prompt, task_status or '',
+                     *map(normalize, window), normalize(input_str)):
+            digest.update(part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        return:
+            a cached reply, None on a miss or while variants are still
+            being collected
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < now:
+                del self._entries[key]
+                entry = None
+            if entry is None or len(entry[1]) < self.variants:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            self.stats['latency_saved'] += entry[2]
+            return self._random.choice(entry[1])
+
+    def put(self, key, reply, elapsed):
+        """
+        store a generated reply
+        params:
+            key: cache key
+            reply: reply
+            elapsed: seconds the LLM took to generate it
+        """
+        if not reply or not reply.strip():
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [
+                    time.monotonic() + self.ttl, [], 0.0]
+            if len(entry[1]) < self.variants and reply not in entry[1]:
+                entry[1].append(reply)
+                count = len(entry[1])
+                entry[2] += (elapsed - entry[2]) / count
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def as_dict(self):
+        """
+        return:
+            counters, size and hit rate
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def from_env():
+    """
+    build the process-wide cache from the environment
+    return:
+        ReplyCache, None when NPC_REPLY_CACHE is off
+    """
+    if os.getenv('NPC_REPLY_CACHE', '0') in ('', '0', 'false', 'off'):
+        return None
+    disabled = os.getenv('NPC_REPLY_CACHE_DISABLED', '')
+    return ReplyCache(
+        max_entries=int(os.getenv('NPC_REPLY_CACHE_SIZE', '10000')),
+        ttl=float(os.getenv('NPC_REPLY_CACHE_TTL', '3600')),
+        variants=int(os.getenv('NPC_REPLY_CACHE_VARIANTS', '1')),
+        history_window=int(os.getenv('NPC_REPLY_CACHE_WINDOW', '2')),
+        disabled_npcs=[name.strip() for name in disabled.split(',')
+                       if name.strip()])
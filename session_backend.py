@@ -0,0 +1,467 @@
+"""
+This file contains the pluggable storage behind SessionManager.
+A backend keeps the compact session state produced by app.dump_session
+(curr_npc plus, for every NPC, its config override, task_status,
+conversation history and chat memory messages) and hands out per-user
+locks, so several Flask/gunicorn workers can serve the same user.
+"""
+import atexit
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from zlib import crc32
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOCK_STRIPES = 1024
+
+
+class SessionBackend:
+    """ Interface of a session backend.
+    States are dicts of the form
+    {'curr_npc': str, 'npcs': {npc_name: npc_state}} where npc_state is
+    what NpcLangChain.dump_state returns.
+    """
+    # True when other processes may change the stored sessions, the
+    # SessionStore then writes every change through and checks versions
+    shared = False
+
+    def load(self, user_id):
+        """ Returns the stored state of the user, None if unknown.
+        """
+        raise NotImplementedError
+
+    def save(self, user_id, state):
+        """ Stores the state of the user.
+        Returns:
+            The new version of the session.
+        """
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        """ Forgets the user.
+        """
+        raise NotImplementedError
+
+    def version(self, user_id):
+        """ Returns the stored version of the session, None if unknown.
+        """
+        raise NotImplementedError
+
+    def lock(self, user_id):
+        """ Returns a context manager holding the per-user lock.
+        """
+        raise NotImplementedError
+
+    def keys(self):
+        """ Returns the IDs of the stored users.
+        """
+        raise NotImplementedError
+
+    def restore(self, items):
+        """ Stores many sessions at once, e.g. from a snapshot.
+        Args:
+            items: (user_id, state JSON text) pairs.
+        Returns:
+            The number of sessions stored.
+        """
+        count = 0
+        for user_id, state in items:
+            self.save(user_id, json.loads(state))
+            count += 1
+        return count
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class _StripedLocks:
+    """ A fixed pool of thread locks indexed by user ID.
+    """
+    def __init__(self, stripes=LOCK_STRIPES):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def index(self, user_id):
+        """ Returns the stripe of the user.
+        """
+        return crc32(user_id.encode()) % len(self._locks)
+
+    def get(self, user_id):
+        """ Returns the lock of the user.
+        """
+        return self._locks[self.index(user_id)]
+
+
+class MemoryBackend(SessionBackend):
+    """ Keeps compact session states in the process, zlib compressed.
+    Up to max_bytes of states stay in memory, the least recently stored
+    ones beyond that are spilled to a local SQLite file, so idle
+    sessions do not grow the process without bound.
+    Args:
+        spill_path (str): The spill file, the process ID is appended. A
+            temporary file, removed at exit, when None.
+        max_bytes (int): Bytes of stored states kept in memory.
+    """
+    def __init__(self, spill_path=None, max_bytes=64 << 20):
+        self.spill_path = spill_path
+        self.max_bytes = max_bytes
+        self._guard = threading.Lock()
+        # user_id -> 压缩后的状态（restore 写入的是未压缩的 JSON），
+        # 按写入先后排列，最早的先写到磁盘
+        self._states = OrderedDict()
+        self._bytes = 0
+        self._spill = None
+        self._versions = {}
+        self._locks = _StripedLocks()
+
+    def _open_spill(self):
+        if self._spill is None:
+            path = self.spill_path
+            directory = None
+            if path is None:
+                directory = tempfile.mkdtemp(prefix='npc-sessions-')
+                path = os.path.join(directory, 'spill.db')
+            path = f'{path}.{os.getpid()}'
+            if os.path.exists(path):
+                os.remove(path)
+            # 只在这个进程中使用，调用方持有 self._guard
+            conn = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=OFF')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE spill '
+                         '(user_id TEXT PRIMARY KEY, data BLOB)')
+            self._spill = conn
+            atexit.register(self._close_spill, directory)
+        return self._spill
+
+    def _close_spill(self, directory):
+        with self._guard:
+            spill, self._spill = self._spill, None
+        if spill is not None:
+            spill.close()
+        if directory is not None:
+            shutil.rmtree(directory, True)
+
+    def _get(self, user_id):
+        data = self._states.get(user_id)
+        if data is None and self._spill is not None:
+            row = self._spill.execute(
+                'SELECT data FROM spill WHERE user_id = ?',
+                (user_id,)).fetchone()
+            data = row[0] if row is not None else None
+        return data
+
+    def _discard(self, user_id):
+        data = self._states.pop(user_id, None)
+        if data is not None:
+            self._bytes -= len(data)
+        elif self._spill is not None:
+            self._spill.execute('DELETE FROM spill WHERE user_id = ?',
+                                (user_id,))
+
+    def _put(self, user_id, data):
+        self._discard(user_id)
+        self._states[user_id] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes and len(self._states) > 1:
+            key, old = self._states.popitem(last=False)
+            self._bytes -= len(old)
+            self._open_spill().execute(
+                'INSERT OR REPLACE INTO spill VALUES (?, ?)', (key, old))
+
+    def load(self, user_id):
+        with self._guard:
+            data = self._get(user_id)
+        if data is None:
+            return None
+        if not data.startswith(b'{'):
+            data = zlib.decompress(data)
+        return json.loads(data.decode())
+
+    def save(self, user_id, state):
+        data = zlib.compress(json.dumps(state, ensure_ascii=False,
+                                        separators=(',', ':')).encode())
+        with self._guard:
+            self._put(user_id, data)
+            version = self._versions.get(user_id, 0) + 1
+            self._versions[user_id] = version
+        return version
+
+    def delete(self, user_id):
+        with self._guard:
+            self._discard(user_id)
+            self._versions.pop(user_id, None)
+
+    def version(self, user_id):
+        return self._versions.get(user_id)
+
+    @contextmanager
+    def lock(self, user_id):
+        with self._locks.get(user_id):
+            yield
+
+    def keys(self):
+        with self._guard:
+            keys = list(self._states)
+            if self._spill is not None:
+                keys += [row[0] for row in self._spill.execute(
+                    'SELECT user_id FROM spill')]
+        return keys
+
+    def restore(self, items):
+        count = 0
+        for user_id, state in items:
+            # 快照中的 JSON 原样保存，用到时才解析，下次保存时才压缩
+            data = state.encode()
+            with self._guard:
+                self._put(user_id, data)
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            count += 1
+        return count
+
+    def __len__(self):
+        with self._guard:
+            spilled = 0 if self._spill is None else self._spill.execute(
+                'SELECT COUNT(*) FROM spill').fetchone()[0]
+            return len(self._states) + spilled
+
+    @classmethod
+    def from_env(cls):
+        """ Reads NPC_SESSION_SPILL and NPC_SESSION_SPILL_MEMORY.
+        """
+        return cls(spill_path=os.getenv('NPC_SESSION_SPILL') or None,
+                   max_bytes=int(os.getenv('NPC_SESSION_SPILL_MEMORY',
+                                           str(64 << 20))))
+
+
+class SQLiteBackend(SessionBackend):
+    """ Stores sessions in a SQLite database in WAL mode.
+    Every worker process opens its own connections. Per-user locks are
+    striped byte-range locks on a lock file next to the database, so
+    they hold across processes on the same host.
+    Args:
+        path (str): The database file.
+        timeout (float): Seconds to wait for a busy database.
+    """
+    shared = True
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._locks = _StripedLocks()
+        self._lock_file = None
+        self._lock_pid = None
+        self._lock_file_guard = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                curr_npc TEXT NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS npc_states (
+                user_id TEXT NOT NULL,
+                npc_name TEXT NOT NULL,
+                task_status TEXT,
+                config_str TEXT,
+                history BLOB NOT NULL,
+                messages BLOB NOT NULL,
+                summary TEXT,
+                epoch TEXT,
+                log BLOB,
+                PRIMARY KEY (user_id, npc_name)
+            );
+        ''')
+        columns = {row[1] for row in conn.execute(
+            'PRAGMA table_info(npc_states)')}
+        for column, column_type in (('summary', 'TEXT'), ('epoch', 'TEXT'),
+                                    ('log', 'BLOB')):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE npc_states '
+                             f'ADD COLUMN {column} {column_type}')
+
+    @staticmethod
+    def _pack(value):
+        return zlib.compress(json.dumps(value, ensure_ascii=False,
+                                        separators=(',', ':')).encode())
+
+    @staticmethod
+    def _unpack(data):
+        return json.loads(zlib.decompress(data).decode())
+
+    def load(self, user_id):
+        conn = self._connect()
+        row = conn.execute('SELECT curr_npc FROM sessions WHERE user_id = ?',
+                           (user_id,)).fetchone()
+        if row is None:
+            return None
+        npcs = {}
+        for (name, task_status, config_str, history, messages,
+             summary, epoch, log) in conn.execute(
+                 'SELECT npc_name, task_status, config_str, history, '
+                 'messages, summary, epoch, log FROM npc_states '
+                 'WHERE user_id = ?',
+                 (user_id,)):
+            npc = npcs[name] = {
+                'npc_name': name,
+                'config_str': config_str,
+                'task_status': task_status,
+                'summary': summary or '',
+                'epoch': epoch,
+            }
+            if log is not None:
+                npc['log'] = self._unpack(log)
+            else:
+                # 消息日志之前的格式
+                npc['history'] = self._unpack(history)
+                npc['messages'] = self._unpack(messages)
+        return {'curr_npc': row[0], 'npcs': npcs}
+
+    def _write(self, conn, user_id, state):
+        """ Writes a session inside the caller's transaction.
+        Returns:
+            The new version of the session.
+        """
+        rows = [(user_id, name, npc['task_status'], npc['config_str'],
+                 self._pack(npc.get('history', [])),
+                 self._pack(npc.get('messages', [])),
+                 npc.get('summary', ''), npc.get('epoch'),
+                 self._pack(npc['log']) if 'log' in npc else None)
+                for name, npc in state['npcs'].items()]
+        row = conn.execute(
+            'SELECT version FROM sessions WHERE user_id = ?',
+            (user_id,)).fetchone()
+        version = (row[0] if row else 0) + 1
+        conn.execute(
+            'INSERT OR REPLACE INTO sessions '
+            '(user_id, version, curr_npc, updated) VALUES (?, ?, ?, ?)',
+            (user_id, version, state['curr_npc'], time.time()))
+        conn.executemany(
+            'INSERT OR REPLACE INTO npc_states (user_id, npc_name, '
+            'task_status, config_str, history, messages, summary, '
+            'epoch, log) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return version
+
+    def save(self, user_id, state):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = self._write(conn, user_id, state)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return version
+
+    def restore(self, items, batch=1000):
+        # 每个事务写入一批会话，比逐个提交快得多
+        conn = self._connect()
+        count = 0
+        items = iter(items)
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                written = 0
+                for user_id, state in items:
+                    self._write(conn, user_id, json.loads(state))
+                    written += 1
+                    if written == batch:
+                        break
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            count += written
+            if written < batch:
+                return count
+
+    def delete(self, user_id):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM npc_states WHERE user_id = ?',
+                         (user_id,))
+            conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def version(self, user_id):
+        row = self._connect().execute(
+            'SELECT version FROM sessions WHERE user_id = ?',
+            (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def _get_lock_file(self):
+        with self._lock_file_guard:
+            if self._lock_file is None or self._lock_pid != os.getpid():
+                # pylint: disable=consider-using-with
+                self._lock_file = open(self.path + '.lock', 'a+b')
+                self._lock_pid = os.getpid()
+            return self._lock_file
+
+    @contextmanager
+    def lock(self, user_id):
+        # 线程锁保证同一进程内的互斥，fcntl字节锁保证跨进程的互斥
+        stripe = self._locks.index(user_id)
+        with self._locks.get(user_id):
+            if fcntl is None:
+                yield
+                return
+            lock_file = self._get_lock_file()
+            fcntl.lockf(lock_file, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN, 1, stripe)
+
+    def keys(self):
+        return [row[0] for row in self._connect().execute(
+            'SELECT user_id FROM sessions')]
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+def create_backend(url=None):
+    """ Builds a backend from a URL.
+    Args:
+        url (str): 'memory' or 'sqlite:///path/to/sessions.db',
+            None means 'memory'.
+    Returns:
+        A SessionBackend.
+    """
+    if not url or url == 'memory':
+        return MemoryBackend.from_env()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    raise ValueError(f'unknown session backend: {url}')
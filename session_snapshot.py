@@ -0,0 +1,73 @@
+"""
+This file contains the snapshot format of all sessions, used to carry
+the conversations of a worker over a restart or redeploy.
+A snapshot is a JSON lines file, gzipped when the name ends in .gz:
+a header line, then one line per user of the form
+`"<user_id>"<TAB>{compact state}`, where the state is what
+app.dump_session returns. The user ID is split off without parsing the
+state, so an import only has to parse a state when its user comes back.
+"""
+import gzip
+import json
+import os
+import time
+
+FORMAT = 'npc-sessions'
+VERSION = 1
+
+
+def _open(path, mode, compressed):
+    if compressed:
+        return gzip.open(path, mode + 't', encoding='UTF-8', compresslevel=1)
+    return open(path, mode, encoding='UTF-8')
+
+
+def write_snapshot(path, items):
+    """ Writes sessions to a snapshot file.
+    The file is written next to the target and renamed over it once
+    complete, a reader never sees a partial snapshot.
+    Args:
+        path (str): The snapshot file.
+        items: (user_id, state) pairs, consumed as they are written.
+    Returns:
+        The number of sessions written.
+    """
+    partial = f'{path}.{os.getpid()}.partial'
+    count = 0
+    try:
+        with _open(partial, 'w', path.endswith('.gz')) as snapshot_file:
+            snapshot_file.write(json.dumps({
+                'format': FORMAT, 'version': VERSION,
+                'created': time.time()}) + '\n')
+            for user_id, state in items:
+                snapshot_file.write(
+                    json.dumps(user_id) + '\t' +
+                    json.dumps(state, ensure_ascii=False,
+                               separators=(',', ':')) + '\n')
+                count += 1
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return count
+
+
+def read_snapshot(path):
+    """ Reads the sessions of a snapshot file.
+    Args:
+        path (str): The snapshot file.
+    Yields:
+        (user_id, state JSON text) pairs, the states are left unparsed.
+    Raises:
+        ValueError: If the file is not a snapshot of a known version.
+    """
+    with _open(path, 'r', path.endswith('.gz')) as snapshot_file:
+        header = json.loads(snapshot_file.readline() or 'null')
+        if not isinstance(header, dict) or header.get('format') != FORMAT \
+                or header.get('version') != VERSION:
+            raise ValueError(f'{path} is not a session snapshot')
+        for line in snapshot_file:
+            user_id, _, state = line.rstrip('\n').partition('\t')
+            if state:
+                yield json.loads(user_id), state
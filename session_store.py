@@ -0,0 +1,340 @@
+"""
+This file contains a bounded in-memory session store.
+Live sessions are kept in LRU order in front of a SessionBackend.
+Idle or over-budget sessions are dropped from memory (and, for a
+process-local backend, saved there in their compact form first) and
+rehydrated from the backend on the next access.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from session_backend import MemoryBackend
+
+
+class _SharedLock:
+    """ A lock held either by one thread alone or by any number of
+    threads in shared mode, granted in the order the threads asked for
+    it: a /reset is not starved by a stream of turns, nor a turn by the
+    other turns of its conversation.
+    """
+    __slots__ = ('cond', 'readers', 'writer', 'queue', 'users')
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        # 按到达顺序等待的线程，[shared, granted]
+        self.queue = deque()
+        # 持有或等待这个锁的线程数，由 UserLocks._guard 保护
+        self.users = 0
+
+    def _take(self, shared):
+        if shared:
+            self.readers += 1
+        else:
+            self.writer = True
+
+    def _grant(self):
+        granted = False
+        while self.queue and not self.writer:
+            waiter = self.queue[0]
+            if not waiter[0] and self.readers:
+                break
+            self.queue.popleft()
+            self._take(waiter[0])
+            waiter[1] = granted = True
+        if granted:
+            self.cond.notify_all()
+
+    def _release(self, shared):
+        if shared:
+            self.readers -= 1
+        else:
+            self.writer = False
+        self._grant()
+
+    @contextmanager
+    def hold(self, shared):
+        """ Holds the lock, alone or in shared mode.
+        """
+        with self.cond:
+            if not self.queue and not self.writer and \
+                    (shared or not self.readers):
+                self._take(shared)
+            else:
+                waiter = [shared, False]
+                self.queue.append(waiter)
+                try:
+                    while not waiter[1]:
+                        self.cond.wait()
+                except BaseException:
+                    if waiter[1]:
+                        self._release(shared)
+                    else:
+                        self.queue.remove(waiter)
+                        self._grant()
+                    raise
+        try:
+            yield
+        finally:
+            with self.cond:
+                self._release(shared)
+
+
+class UserLocks:
+    """ One lock per key, e.g. a user ID, created on first use and
+    dropped once no thread holds or waits for it. Unlike the striped
+    backend locks, two keys never share a lock, so a request waiting
+    for the LLM only delays later requests for its own key.
+    """
+    def __init__(self):
+        self._guard = threading.Lock()
+        # key -> _SharedLock
+        self._locks = {}
+
+    @contextmanager
+    def hold(self, key, shared=False):
+        """ Holds the lock of the key.
+        Args:
+            key: The user ID, or any hashable key.
+            shared (bool): Hold it together with other shared holders,
+                still excluding the threads that hold it alone.
+        """
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = _SharedLock()
+            lock.users += 1
+        try:
+            with lock.hold(shared):
+                yield
+        finally:
+            with self._guard:
+                lock.users -= 1
+                if not lock.users:
+                    del self._locks[key]
+
+    def __len__(self):
+        with self._guard:
+            return len(self._locks)
+
+
+class SessionStore:
+    """ Bounded session store with idle TTL and LRU eviction.
+    Args:
+        dump (callable): Converts a live session to a JSON serializable state.
+        load (callable): Builds a live session from a state.
+        sizeof (callable): Estimates the memory used by a live session.
+        max_sessions (int): Maximum number of live sessions.
+        max_bytes (int): Memory budget for live sessions, None for no limit.
+        ttl (float): Idle seconds before a session is evicted,
+            None for no limit.
+        backend (SessionBackend): Where the compact sessions are kept.
+    """
+    def __init__(self, dump, load, sizeof, max_sessions=1000,
+                 max_bytes=None, ttl=None, backend=None):
+        self._dump = dump
+        self._load = load
+        self._sizeof = sizeof
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._lock = threading.RLock()
+        # user_id -> [session, last_access, size, version, pins]
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'rehydrations': 0,
+        }
+
+    def get(self, key, pin=False):
+        """ Returns the live session for the key, rehydrating it from the
+        backend when it is not in memory or another worker changed it.
+        The caller must hold backend.lock(key).
+        Args:
+            key (str): The user ID.
+            pin (bool): Keep the session in memory until unpin().
+        Returns:
+            The session, None if the key is unknown.
+        """
+        shared = self.backend.shared
+        version = self.backend.version(key) if shared else None
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and (not shared or entry[3] == version):
+                self.stats['hits'] += 1
+                self._entries.move_to_end(key)
+                entry[1] = now
+                # 会话在上次请求后可能变大，重新估算
+                size = self._sizeof(entry[0])
+                self._bytes += size - entry[2]
+                entry[2] = size
+                entry[4] += pin
+                self._evict(now, keep=key)
+                return entry[0]
+            self._remove(key)
+            self.stats['misses'] += 1
+        state = self.backend.load(key)
+        if state is None:
+            return None
+        sess = self._load(state)
+        if not shared:
+            self.backend.delete(key)
+        with self._lock:
+            self.stats['rehydrations'] += 1
+            self._insert(key, sess, time.monotonic(), version, pin)
+        return sess
+
+    def cached(self, key):
+        """ Returns the live session for the key without loading it or
+        counting an access, the caller need not hold backend.lock(key).
+        Returns:
+            The session, None if it is not in memory or another worker
+            changed it since.
+        """
+        version = self.backend.version(key) if self.backend.shared else None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.backend.shared and entry[3] != version):
+                return None
+            return entry[0]
+
+    def put(self, key, sess, pin=False):
+        """ Adds or replaces the live session for the key.
+        The caller must hold backend.lock(key).
+        Args:
+            key (str): The user ID.
+            sess: The live session.
+            pin (bool): See get().
+        """
+        with self._lock:
+            self._remove(key)
+            self._insert(key, sess, time.monotonic(), None, pin)
+        if not self.backend.shared:
+            self.backend.delete(key)
+
+    def unpin(self, key, sess):
+        """ Lets the session pinned by get() or put() be evicted again.
+        A request pins the session it works on: evicting it in the middle
+        of a turn would save a copy without the turn, another request of
+        the user would load that copy and the two would overwrite each
+        other's turns.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is sess:
+                entry[4] -= 1
+                if not entry[4]:
+                    self._evict(time.monotonic())
+
+    def commit(self, key, sess):
+        """ Makes the changes a request made to the session durable.
+        A shared backend gets every change, a process-local backend only
+        gets sessions that were evicted while the request was running.
+        The caller must hold backend.lock(key).
+        """
+        if self.backend.shared:
+            version = self.backend.save(key, self._dump(sess))
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] is sess:
+                    entry[3] = version
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is sess:
+                return
+        self.backend.save(key, self._dump(sess))
+
+    def pop(self, key):
+        """ Forgets the session for the key, live or stored.
+        The caller must hold backend.lock(key).
+        """
+        with self._lock:
+            self._remove(key)
+        self.backend.delete(key)
+
+    def peek(self, key):
+        """ Returns the compact state of the session for the key, live or
+        stored, without counting an access.
+        The caller must hold backend.lock(key).
+        Returns:
+            The state, None if the key is unknown.
+        """
+        if self.backend.shared:
+            # 共享后端保存了每一次修改，内存中的会话可能已经过时
+            return self.backend.load(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            sess = entry[0] if entry is not None else None
+        if sess is not None:
+            return self._dump(sess)
+        return self.backend.load(key)
+
+    def keys(self):
+        """ Returns the keys of the live sessions.
+        """
+        with self._lock:
+            return list(self._entries)
+
+    def sweep(self):
+        """ Evicts idle and over-budget sessions.
+        """
+        with self._lock:
+            self._evict(time.monotonic())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def live_bytes(self):
+        """ Estimated memory used by live sessions.
+        """
+        return self._bytes
+
+    def _insert(self, key, sess, now, version, pin=False):
+        size = self._sizeof(sess)
+        self._entries[key] = [sess, now, size, version, int(pin)]
+        self._bytes += size
+        self._evict(now, keep=key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+        return entry
+
+    def _evict(self, now, keep=None):
+        """ Evicts sessions from the LRU end while they are idle for
+        longer than the TTL or the store is over its budget. Pinned
+        sessions stay, the store may go over its budget until they are
+        unpinned.
+        """
+        victims = []
+        count, size = len(self._entries), self._bytes
+        for key, (_, last_access, entry_size, _, pins) in \
+                self._entries.items():
+            idle = self.ttl is not None and now - last_access > self.ttl
+            over = (count > self.max_sessions
+                    or (self.max_bytes is not None and size > self.max_bytes))
+            if not idle and not over:
+                break
+            if key == keep or pins:
+                continue
+            victims.append(key)
+            count -= 1
+            size -= entry_size
+        for key in victims:
+            sess = self._remove(key)[0]
+            if not self.backend.shared:
+                # 共享后端在每次请求后已经写入，这里只需要丢弃内存中的对象
+                self.backend.save(key, self._dump(sess))
+            self.stats['evictions'] += 1
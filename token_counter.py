@@ -0,0 +1,59 @@
+"""
+本地的token计数，用来在发送请求之前估算prompt大小
+有tiktoken时使用模型的编码，否则按字符粗略估算
+"""
+import math
+import os
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+ENCODING_NAME = os.getenv("NPC_TOKEN_ENCODING", "cl100k_base")
+# ChatML 中每条消息的额外开销（角色、分隔符）
+MESSAGE_TOKENS = 4
+_CJK = re.compile(r'[　-〿㐀-䶿一-鿿＀-￯]')
+
+
+@lru_cache(maxsize=None)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except (KeyError, ValueError):
+        return None
+
+
+def count_tokens(text):
+    """
+    count the tokens of a string
+    params:
+        text: text
+    return:
+        number of tokens
+    """
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # 中文大约一个字一个token，其余大约四个字符一个token
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def count_message_tokens(messages):
+    """
+    count the tokens of chat messages
+    params:
+        messages: langchain messages
+    return:
+        number of tokens
+    """
+    return sum(count_tokens(getattr(message, 'role', '')) +
+               count_tokens(message.content) + MESSAGE_TOKENS
+               for message in messages)